@@ -1,271 +1,4765 @@
+import copy
+import cProfile
+import gzip
+import hashlib
+import hmac
+import io
+import json
+import math
+import multiprocessing
 import os
+import pstats
+import random
 import re
+import socket
+import sqlite3
 import threading
 import time
+import unicodedata
 import uuid
+import zipfile
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from functools import lru_cache, partial, wraps
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote, urlparse
 
 from flask import (
     Flask,
+    Response,
+    g,
     render_template,
+    send_file,
     request,
     jsonify,
-    send_file,
+    stream_with_context,
+    url_for,
 )
+from werkzeug.http import parse_accept_header
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.wsgi import ClosingIterator
 import yt_dlp
 import logging
 
+import qrcode
+import qrcode.image.svg
+import requests
+from PIL import Image
+
+import postprocess
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
 # ---------------------------------------------------------
 # BASIC SETUP
 # ---------------------------------------------------------
 BASE_DIR = Path(__file__).resolve().parent
-DOWNLOAD_DIR = BASE_DIR / "downloads"
-DOWNLOAD_DIR.mkdir(exist_ok=True)
+DOWNLOAD_DIR = BASE_DIR / os.environ.get("DOWNLOAD_DIR", "downloads")
+DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
 COOKIES_PATH = BASE_DIR / "cookies.txt"
 
 app = Flask(__name__)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# "json": one JSON object per line (request id, phase timings, job fields) for log
+# pipelines; anything else is a logging format string
+LOG_FORMAT = os.environ.get("LOG_FORMAT") or "%(asctime)s - %(levelname)s - %(message)s"
+# yt-dlp's own output ([debug] lines, format tables, progress) is dropped unless set
+YTDLP_VERBOSE = os.environ.get("YTDLP_VERBOSE", "0").lower() in ("1", "true", "yes")
+
+# id of the request being served, for log records (set by RequestTiming)
+REQUEST_ID: ContextVar[str | None] = ContextVar("request_id", default=None)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """JSON log lines; a dict passed as extra={"fields": {...}} is merged into the object."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        request_id = REQUEST_ID.get()
+        if request_id:
+            entry["request_id"] = request_id
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(
+    JsonLogFormatter() if LOG_FORMAT.lower() == "json" else logging.Formatter(LOG_FORMAT)
 )
+logging.basicConfig(level=LOG_LEVEL, handlers=[_log_handler])
 logger = logging.getLogger("ytdownloadx")
+# passed to yt-dlp as its logger: its screen output arrives at DEBUG, warnings at WARNING
+YTDLP_LOGGER = logging.getLogger("ytdownloadx.ytdlp")
+YTDLP_LOGGER.setLevel(logging.DEBUG if YTDLP_VERBOSE else logging.WARNING)
 
-# global flag to fall back to simple options if something misbehaves
-USE_SIMPLE_VERSION = False
-
-# Files older than this (seconds) will be deleted by the cleanup thread
+# Files not accessed for this long (seconds) will be deleted by the cleanup thread
 DOWNLOAD_TTL_SECONDS = 60 * 30  # 30 minutes
 
+# Total size of finished files kept in DOWNLOAD_DIR; least recently used go first
+DOWNLOAD_DIR_QUOTA_BYTES = int(os.environ.get("DOWNLOAD_DIR_QUOTA_MB", "2048")) * 1024 * 1024
+
+# Threads a single ffmpeg postprocessor may use, so parallel jobs don't
+# oversubscribe the CPU
+FFMPEG_THREADS = max(1, int(os.environ.get("FFMPEG_THREADS", "2")))
+
+# Size of the background download pool (see .env.example)
+MAX_CONCURRENT_DOWNLOADS = max(1, int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", "3")))
+
+# Playlist ZIP batches: entries downloaded at once per batch, and batch size cap
+PLAYLIST_ZIP_CONCURRENCY = int(os.environ.get("PLAYLIST_ZIP_CONCURRENCY", str(MAX_CONCURRENT_DOWNLOADS)))
+MAX_BATCH_ENTRIES = 200
+# ZIP streams held open at once per worker (each keeps a request thread for the whole playlist)
+BATCH_ZIP_LIMIT = int(os.environ.get("BATCH_ZIP_LIMIT", "2"))
+
 # ---------------------------------------------------------
-# HELPERS
+# METRICS
 # ---------------------------------------------------------
+#
+# Prometheus metrics served on /metrics. Under gunicorn, PROMETHEUS_MULTIPROC_DIR
+# is set by gunicorn.conf.py and every worker writes its samples there, so a
+# scrape of any worker returns the sum over all of them.
 
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
 
-def safe_download_name(title: str, ext: str) -> str:
+EXTRACT_SECONDS = Histogram(
+    "ytdownloadx_extract_seconds",
+    "yt-dlp extract_info latency",
+    ["phase", "strategy"],
+    buckets=(0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60),
+)
+DOWNLOAD_BYTES_PER_SECOND = Histogram(
+    "ytdownloadx_download_bytes_per_second",
+    "Average transfer rate of a download from the origin",
+    buckets=(64e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6, 16e6, 32e6, 64e6, 128e6),
+)
+DOWNLOAD_BYTES = Counter("ytdownloadx_download_bytes", "Bytes downloaded from origins")
+POSTPROCESS_SECONDS = Histogram(
+    "ytdownloadx_postprocess_seconds",
+    "Duration of ffmpeg postprocessing steps",
+    ["step"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300),
+)
+SEND_SECONDS = Histogram(
+    "ytdownloadx_send_seconds",
+    "Time to send a file response to the client",
+    ["route"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 300),
+)
+# stage: fetch (yt-dlp download slots) or postprocess (ffmpeg processes)
+QUEUE_DEPTH = Gauge(
+    "ytdownloadx_queue_depth",
+    "Download jobs waiting for a free slot",
+    ["stage"],
+    multiprocess_mode="livesum",
+)
+ACTIVE_JOBS = Gauge(
+    "ytdownloadx_active_jobs",
+    "Download jobs currently running",
+    ["stage"],
+    multiprocess_mode="livesum",
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "ytdownloadx_queue_wait_seconds",
+    "Time a job waited for a free slot",
+    ["stage"],
+    buckets=(0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600),
+)
+for _stage in ("fetch", "postprocess"):
+    QUEUE_DEPTH.labels(_stage)
+    ACTIVE_JOBS.labels(_stage)
+CACHE_REQUESTS = Counter(
+    "ytdownloadx_cache_requests",
+    "Cache lookups by cache and result (hit ratio = hit / all)",
+    ["cache", "result"],
+)
+ERRORS = Counter("ytdownloadx_errors", "Errors by error code", ["code"])
+JOBS_RESUMED = Counter("ytdownloadx_jobs_resumed", "Interrupted jobs picked up again by a worker")
+STRATEGY_REQUESTS = Counter(
+    "ytdownloadx_strategy_requests",
+    "yt-dlp attempts by site, strategy and outcome",
+    ["site", "strategy", "outcome"],
+)
+BREAKER_STATE = Gauge(
+    "ytdownloadx_breaker_state",
+    "Circuit breaker of the enhanced strategy per site (0 closed, 1 half-open, 2 open)",
+    ["site"],
+    multiprocess_mode="mostrecent",
+)
+BREAKER_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+YDL_SETUP_SECONDS = Histogram(
+    "ytdownloadx_ydl_setup_seconds",
+    "Time to get a ready YoutubeDL for a request (source: pool or new)",
+    ["source"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+STARTUP_SECONDS = Gauge(
+    "ytdownloadx_startup_seconds",
+    "Startup cost by phase (import, warm_extractors, warm_pool, worker_ready)",
+    ["phase"],
+    multiprocess_mode="max",
+)
+
+
+def observe_send(resp: Response, route: str) -> Response:
+    """Record how long the response body takes to reach the client."""
+    started = time.perf_counter()
+    resp.call_on_close(lambda: SEND_SECONDS.labels(route).observe(time.perf_counter() - started))
+    return resp
+
+
+# ---------------------------------------------------------
+# REQUEST TIMING AND PROFILING
+# ---------------------------------------------------------
+#
+# Each request gets a RequestTiming: code serving it adds phases with
+# timed("extract") / note_timing(), and the response carries them in a
+# Server-Timing header (browser devtools show it) plus one log line with the
+# phases and the time spent sending the body. With ADMIN_TOKEN set, admins can
+# have a request profiled (X-Profile: 1) or sample a share of all requests;
+# cProfile output is kept in PROFILE_DIR and downloaded from /admin/profiles.
+
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "1") != "0"
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+PROFILE_DIR = Path(os.environ.get("PROFILE_DIR") or DOWNLOAD_DIR / "profiles")
+# share of requests profiled until an admin changes it (POST /admin/profiling)
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))
+PROFILE_RATE_REFRESH = 5  # seconds a worker reuses the shared sample rate
+# logged at DEBUG: scraped / polled too often to be worth a line each
+QUIET_PATHS = ("/metrics", "/api/health", "/static/")
+
+REQUEST_TIMINGS: ContextVar[dict | None] = ContextVar("request_timings", default=None)
+REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+PROFILE_NAME_RE = re.compile(r"^[A-Za-z0-9_.-]+\.prof$")
+
+
+def note_timing(phase: str, seconds: float) -> None:
+    """Add seconds to a phase of the current request (no-op outside requests)."""
+    timings = REQUEST_TIMINGS.get()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timed(phase: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        note_timing(phase, time.perf_counter() - started)
+
+
+def note_job_timings(job: dict) -> None:
+    """Report a job's download phases (setup, extract, fetch, Merger, ...) with the request."""
+    for phase, seconds in (job.get("timings") or {}).items():
+        if isinstance(seconds, (int, float)):
+            note_timing(f"job-{phase}", seconds)
+
+
+class RequestTiming:
+    """Id and phase timings of one request, made current for the code serving it."""
+
+    def __init__(self, request_id: str | None = None):
+        self.request_id = request_id if request_id and REQUEST_ID_RE.match(request_id) else uuid.uuid4().hex[:16]
+        self.timings: dict[str, float] = {}
+        self.started = time.perf_counter()
+        REQUEST_ID.set(self.request_id)
+        REQUEST_TIMINGS.set(self.timings)
+
+    def headers(self) -> dict:
+        headers = {"X-Request-ID": self.request_id}
+        if SERVER_TIMING:
+            phases = {**self.timings, "total": time.perf_counter() - self.started}
+            headers["Server-Timing"] = ", ".join(
+                f"{re.sub(r'[^A-Za-z0-9_.-]', '_', name)};dur={seconds * 1000:.1f}"
+                for name, seconds in phases.items()
+            )
+        return headers
+
+    def log(self, method: str, path: str, status: int, sent_at: float | None = None) -> None:
+        """One line per request; sent_at (when the body started) adds the send phase."""
+        now = time.perf_counter()
+        phases = {name: round(seconds * 1000, 1) for name, seconds in self.timings.items()}
+        if sent_at is not None:
+            phases["send"] = round((now - sent_at) * 1000, 1)
+        total = round((now - self.started) * 1000, 1)
+        level = logging.DEBUG if path.startswith(QUIET_PATHS) else logging.INFO
+        logger.log(
+            level,
+            "%s %s %s %.1fms %s",
+            method, path, status, total, " ".join(f"{k}={v}" for k, v in phases.items()),
+            extra={
+                "fields": {
+                    "request_id": self.request_id,
+                    "method": method,
+                    "path": path,
+                    "status": status,
+                    "duration_ms": total,
+                    "phases_ms": phases,
+                }
+            },
+        )
+
+
+def is_admin(token: str | None) -> bool:
+    return bool(ADMIN_TOKEN and token) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+_PROFILE_RATE = {"rate": PROFILE_SAMPLE_RATE, "read_at": 0.0}
+
+
+def profile_sample_rate() -> float:
+    """Share of requests to profile; set for all workers through STATE_STORE."""
+    now = time.monotonic()
+    if now - _PROFILE_RATE["read_at"] > PROFILE_RATE_REFRESH:
+        stored = STATE_STORE.get("settings", "profile_sample_rate")
+        _PROFILE_RATE.update(rate=PROFILE_SAMPLE_RATE if stored is None else stored, read_at=now)
+    return _PROFILE_RATE["rate"]
+
+
+def should_profile(profile_header: str | None, admin_token: str | None) -> bool:
+    if not ADMIN_TOKEN:
+        return False
+    if profile_header == "1" and is_admin(admin_token):
+        return True
+    rate = profile_sample_rate()
+    return rate > 0 and random.random() < rate
+
+
+def start_profiler() -> cProfile.Profile | None:
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiler is active on this thread
+        return None
+    return profiler
+
+
+def save_profile(profiler: cProfile.Profile, label: str) -> str:
+    """Write a profile to PROFILE_DIR (keeping the newest PROFILE_KEEP); returns its name."""
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    slug = re.sub(r"[^A-Za-z0-9]+", "-", label).strip("-")[:60]
+    name = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}_{slug}_{uuid.uuid4().hex[:6]}.prof"
+    profiler.dump_stats(PROFILE_DIR / name)
+    for old in sorted(PROFILE_DIR.glob("*.prof"), key=lambda p: p.stat().st_mtime)[:-PROFILE_KEEP]:
+        old.unlink(missing_ok=True)
+    logger.info("Saved profile %s", name)
+    return name
+
+
+def profiled(fn, label: str):
+    """Wrap fn so its next call runs under cProfile (used for jobs of profiled requests)."""
+
+    @wraps(fn)
+    def run(*args, **kwargs):
+        profiler = start_profiler()
+        if profiler is None:
+            return fn(*args, **kwargs)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.disable()
+            save_profile(profiler, label)
+
+    return run
+
+
+def list_profiles() -> list[dict]:
+    if not PROFILE_DIR.exists():
+        return []
+    files = sorted(PROFILE_DIR.glob("*.prof"), key=lambda p: p.stat().st_mtime, reverse=True)
+    return [
+        {
+            "name": p.name,
+            "bytes": p.stat().st_size,
+            "created": datetime.fromtimestamp(p.stat().st_mtime, timezone.utc).isoformat(),
+        }
+        for p in files
+    ]
+
+
+def profile_summary(path: Path, limit: int = 40) -> str:
+    """pstats report of a profile: top functions by cumulative time."""
+    out = io.StringIO()
+    pstats.Stats(str(path), stream=out).sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+
+# ---------------------------------------------------------
+# SHARED STATE
+# ---------------------------------------------------------
+#
+# gunicorn runs several worker processes, so anything a request may need from
+# another worker (job status, in-flight downloads, playlist batches, metadata
+# cache entries, the simple-mode flag) goes through STATE_STORE. The default
+# backend is a SQLite file next to the downloads, shared by the workers of one
+# node; STATE_BACKEND=redis shares it between nodes.
+
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "sqlite").lower()
+STATE_DB_PATH = Path(os.environ.get("STATE_DB_PATH") or DOWNLOAD_DIR / "state.sqlite3")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+# Running jobs are written to the store at most this often (seconds); status
+# changes are written immediately. Workers following another worker's job
+# poll the store at the same interval.
+STATE_SYNC_INTERVAL = float(os.environ.get("STATE_SYNC_INTERVAL", "0.5"))
+
+
+class StateStore(ABC):
     """
-    Build a *HTTP-header-safe* download filename.
+    Key/value store for state shared between workers.
 
-    - Removes weird characters (/, ?, :, etc.)
-    - Keeps only letters, numbers, spaces, dash, underscore and dot
-    - Ensures we always return something ASCII-ish
+    Values are JSON-serialisable and grouped by namespace ("jobs", "flags", ...);
+    entries written with a ttl disappear after that many seconds.
     """
-    if not title:
-        base = "video"
-    else:
-        # Replace disallowed chars with underscore
-        base = "".join(
-            c if c.isalnum() or c in " .-_"
-            else "_"
-            for c in title
+
+    @abstractmethod
+    def get(self, namespace: str, key: str): ...
+
+    @abstractmethod
+    def set(self, namespace: str, key: str, value, ttl: float | None = None) -> None: ...
+
+    @abstractmethod
+    def add(self, namespace: str, key: str, value, ttl: float | None = None) -> bool:
+        """Set key only if it is absent; True if this call created it."""
+
+    @abstractmethod
+    def delete(self, namespace: str, key: str) -> None: ...
+
+    @abstractmethod
+    def items(self, namespace: str) -> list[tuple[str, object]]:
+        """All live (key, value) pairs of a namespace; meant for small ones."""
+
+    @abstractmethod
+    def update(self, namespace: str, key: str, fn, ttl: float | None = None):
+        """Atomically replace a value (None if absent) with fn(value); returns the new value."""
+
+    def purge_expired(self) -> None:
+        pass
+
+
+class SQLiteStateStore(StateStore):
+    """Default backend: one SQLite file (WAL) used by every worker on the node."""
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._connect()
+        # a connection must not cross a fork (gunicorn --preload imports us in the master)
+        os.register_at_fork(after_in_child=self._connect)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS state (
+                    namespace  TEXT NOT NULL,
+                    key        TEXT NOT NULL,
+                    value      TEXT NOT NULL,
+                    expires_at REAL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """
+            )
+
+    def _connect(self) -> None:
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+    @staticmethod
+    def _expiry(ttl: float | None) -> float | None:
+        return time.time() + ttl if ttl else None
+
+    def get(self, namespace: str, key: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM state WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            ).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return json.loads(row[0])
+
+    def set(self, namespace: str, key: str, value, ttl: float | None = None) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value), self._expiry(ttl)),
+            )
+
+    def add(self, namespace: str, key: str, value, ttl: float | None = None) -> bool:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM state WHERE namespace = ? AND key = ? AND expires_at < ?",
+                (namespace, key, time.time()),
+            )
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO state VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value), self._expiry(ttl)),
+            )
+            return cursor.rowcount == 1
+
+    def delete(self, namespace: str, key: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def items(self, namespace: str) -> list[tuple[str, object]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value FROM state WHERE namespace = ? AND (expires_at IS NULL OR expires_at >= ?)",
+                (namespace, time.time()),
+            ).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def update(self, namespace: str, key: str, fn, ttl: float | None = None):
+        with self._lock, self._conn:
+            # take the write lock up front, so other workers cannot read in between
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM state WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            ).fetchone()
+            current = None
+            if row is not None and (row[1] is None or row[1] >= time.time()):
+                current = json.loads(row[0])
+            value = fn(current)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value), self._expiry(ttl)),
+            )
+            return value
+
+    def purge_expired(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM state WHERE expires_at < ?", (time.time(),))
+
+
+class RedisStateStore(StateStore):
+    """
+    Redis backend for multi-node deployments.
+
+    Takes any client with redis-py's get/set(nx, ex)/delete/scan_iter (and
+    transaction for update), so tests can pass a local stand-in instead of a
+    server.
+    """
+
+    def __init__(self, client, prefix: str = "ytdownloadx:"):
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}{namespace}:{key}"
+
+    @staticmethod
+    def _ex(ttl: float | None) -> int | None:
+        return max(1, int(ttl)) if ttl else None
+
+    def get(self, namespace: str, key: str):
+        raw = self.client.get(self._key(namespace, key))
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, namespace: str, key: str, value, ttl: float | None = None) -> None:
+        self.client.set(self._key(namespace, key), json.dumps(value), ex=self._ex(ttl))
+
+    def add(self, namespace: str, key: str, value, ttl: float | None = None) -> bool:
+        return bool(
+            self.client.set(self._key(namespace, key), json.dumps(value), nx=True, ex=self._ex(ttl))
         )
-        # Collapse multiple underscores/spaces
-        base = re.sub(r"[_\s]+", " ", base).strip(" .-_")
-        if not base:
-            base = "video"
 
-    if not ext:
-        ext = "mp4"
+    def delete(self, namespace: str, key: str) -> None:
+        self.client.delete(self._key(namespace, key))
 
-    return f"{base}.{ext}"
+    def items(self, namespace: str) -> list[tuple[str, object]]:
+        prefix = self._key(namespace, "")
+        result = []
+        for name in self.client.scan_iter(match=f"{prefix}*"):
+            name = name.decode() if isinstance(name, bytes) else name
+            raw = self.client.get(name)
+            if raw is not None:  # expired or deleted since the scan
+                result.append((name[len(prefix):], json.loads(raw)))
+        return result
 
+    def update(self, namespace: str, key: str, fn, ttl: float | None = None):
+        name = self._key(namespace, key)
 
-def base_ydl_opts() -> dict:
-    """Common yt-dlp options used for both metadata and download."""
-    opts: dict = {
-        "verbose": True,
-        "ignoreerrors": True,
-        "retries": 5,
-        "fragment_retries": 5,
-        "skip_unavailable_fragments": True,
-        "source_address": "0.0.0.0",
-        "geo_bypass": True,
-        "geo_bypass_country": "US",
-        "http_headers": {
-            "User-Agent": (
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                "AppleWebKit/537.36 (KHTML, like Gecko) "
-                "Chrome/139.0.0.0 Safari/537.36"
-            ),
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-            "Accept-Language": "en-us,en;q=0.5",
-            "Sec-Fetch-Mode": "navigate",
-        },
-        "noplaylist": False,  # we want playlist metadata
-    }
+        def apply(pipe):
+            raw = pipe.get(name)
+            value = fn(json.loads(raw) if raw is not None else None)
+            pipe.multi()
+            pipe.set(name, json.dumps(value), ex=self._ex(ttl))
+            return value
 
-    if COOKIES_PATH.exists():
-        opts["cookiefile"] = str(COOKIES_PATH)
+        # WATCH name; retried if another client changes it before EXEC
+        return self.client.transaction(apply, name, value_from_callable=True)
 
-    return opts
 
+def make_state_store() -> StateStore:
+    if STATE_BACKEND == "redis":
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("STATE_BACKEND=redis needs the 'redis' package") from e
+        logger.info("Using Redis state store at %s", REDIS_URL)
+        return RedisStateStore(redis.Redis.from_url(REDIS_URL))
+    return SQLiteStateStore(STATE_DB_PATH)
 
-def get_ydl_opts_enhanced(
-    download: bool = False, format_id: str | None = None, is_audio: bool = False
-) -> tuple[dict, str | None]:
+
+STATE_STORE = make_state_store()
+
+
+# ---------------------------------------------------------
+# ADMISSION CONTROL
+# ---------------------------------------------------------
+#
+# Each client (a known API key, else the IP address) gets a token bucket of
+# RATE_LIMIT requests per minute on the expensive routes (metadata, downloads),
+# kept in STATE_STORE so all workers draw from the same bucket. Download jobs
+# are queued per client and served round-robin (FairScheduler), so one client
+# queueing a whole playlist only gets every other slot. Past the queue limits
+# requests are shed early with 429 (this client) or 503 (everyone), both with
+# Retry-After; downloads are shed before metadata requests, and download
+# threads run at a lower CPU priority than request threads.
+
+RATE_LIMIT = float(os.environ.get("RATE_LIMIT", "30"))  # requests per minute per client, 0 = off
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", "0")) or max(1, int(RATE_LIMIT))
+# Keys in X-API-Key that identify a client (and share nothing with its IP); others are ignored
+API_KEYS = {k.strip() for k in os.environ.get("API_KEYS", "").split(",") if k.strip()}
+# Reverse proxies in front of the app (X-Forwarded-For hops to trust for the client IP)
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", "0"))
+
+# Shedding thresholds (per worker process)
+DOWNLOAD_QUEUE_LIMIT = int(os.environ.get("DOWNLOAD_QUEUE_LIMIT", str(MAX_CONCURRENT_DOWNLOADS * 20)))
+CLIENT_QUEUE_LIMIT = int(os.environ.get("CLIENT_QUEUE_LIMIT", "20"))
+METADATA_INFLIGHT_LIMIT = int(os.environ.get("METADATA_INFLIGHT_LIMIT", "32"))
+SHED_RETRY_AFTER = 5
+# Niceness added to download threads, so metadata requests win the CPU
+DOWNLOAD_THREAD_NICE = int(os.environ.get("DOWNLOAD_THREAD_NICE", "5"))
+
+REJECTED_REQUESTS = Counter(
+    "ytdownloadx_rejected_requests", "Requests refused by admission control", ["route", "reason"]
+)
+
+if TRUSTED_PROXY_HOPS:
+    # x_proto / x_host too, so absolute links (QR codes) use the public scheme and host
+    app.wsgi_app = ProxyFix(
+        app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS, x_host=TRUSTED_PROXY_HOPS
+    )
+
+
+class Overloaded(Exception):
+    """Raised when a bounded resource is full; answered with 503 + Retry-After."""
+
+
+class TokenBucket:
+    """Token bucket per client, stored as [tokens, timestamp] in a StateStore."""
+
+    def __init__(self, store: StateStore, per_minute: float, burst: int):
+        self.store = store
+        self.rate = per_minute / 60
+        self.burst = burst
+
+    def take(self, client: str, cost: float = 1.0) -> float:
+        """Take cost tokens; returns 0 if granted, else seconds until they would be."""
+        now = time.time()
+        delay = 0.0
+
+        def refill(state):
+            nonlocal delay
+            tokens, stamp = state or (self.burst, now)
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            if tokens >= cost:
+                tokens -= cost
+                delay = 0.0
+            else:
+                delay = (cost - tokens) / self.rate
+            return [tokens, now]
+
+        # an untouched bucket is full again after burst / rate seconds
+        self.store.update("ratelimit", client, refill, ttl=self.burst / self.rate)
+        return delay
+
+
+RATE_LIMITER = TokenBucket(STATE_STORE, RATE_LIMIT, RATE_LIMIT_BURST) if RATE_LIMIT > 0 else None
+
+
+class InflightLimit:
+    """Counts concurrent calls; slot() raises Overloaded past the limit."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.current = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self):
+        with self._lock:
+            if self.current >= self.limit:
+                raise Overloaded()
+            self.current += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.current -= 1
+
+
+METADATA_INFLIGHT = InflightLimit(METADATA_INFLIGHT_LIMIT)
+
+
+def lower_thread_priority(nice: int) -> None:
+    """Raise the calling thread's niceness (Linux schedules threads individually)."""
+    try:
+        tid = threading.get_native_id()
+        os.setpriority(os.PRIO_PROCESS, tid, os.getpriority(os.PRIO_PROCESS, tid) + nice)
+    except (AttributeError, OSError):  # not Linux, or not permitted
+        pass
+
+
+class FairScheduler:
     """
-    Enhanced yt-dlp configuration.
+    Fixed pool of threads serving per-client FIFO queues round-robin.
 
-    Returns (opts, download_id). For metadata, download_id is None.
+    submit(client, fn, *args) queues a call; a free thread takes the next call
+    of the client at the front of the rotation and moves that client to the
+    back. Threads are started on first use in each process (forked gunicorn
+    workers get their own).
     """
-    global USE_SIMPLE_VERSION
-    opts = base_ydl_opts()
 
-    if not download:
-        # metadata only
-        opts.update(
-            {
-                "skip_download": True,
-                "simulate": True,
-                "forcejson": True,
-                "extract_flat": False,
-                "quiet": False,
-                "no_warnings": False,
-                "listformats": True,
-                "outtmpl": str(DOWNLOAD_DIR / "%(id)s.%(ext)s"),
+    def __init__(self, workers: int, name: str, nice: int = 0):
+        self.workers = workers
+        self.name = name
+        self.nice = nice
+        self._cond = threading.Condition()
+        self._queues: OrderedDict[str, deque] = OrderedDict()
+        self._pid: int | None = None
+        self.running = 0
+
+    def _start(self) -> None:
+        # caller holds self._cond
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._queues.clear()
+        self.running = 0
+        for n in range(self.workers):
+            threading.Thread(target=self._work, name=f"{self.name}-{n}", daemon=True).start()
+
+    def submit(self, client: str, fn, *args) -> None:
+        with self._cond:
+            self._start()
+            self._queues.setdefault(client, deque()).append((fn, args))
+            self._cond.notify()
+
+    def _take(self):
+        with self._cond:
+            while not self._queues:
+                self._cond.wait()
+            client, queue = next(iter(self._queues.items()))
+            call = queue.popleft()
+            if queue:
+                self._queues.move_to_end(client)
+            else:
+                del self._queues[client]
+            self.running += 1
+            return call
+
+    def _work(self) -> None:
+        lower_thread_priority(self.nice)
+        while True:
+            fn, args = self._take()
+            try:
+                fn(*args)
+            except Exception:  # noqa: BLE001
+                logger.exception("%s task failed", self.name)
+            finally:
+                with self._cond:
+                    self.running -= 1
+
+    def pending(self, client: str | None = None) -> int:
+        with self._cond:
+            if client is not None:
+                return len(self._queues.get(client, ()))
+            return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "running": self.running,
+                "queued": sum(len(queue) for queue in self._queues.values()),
+                "clients": len(self._queues),
             }
-        )
-        return opts, None
 
-    # actual download
-    download_id = uuid.uuid4().hex
-    outtmpl = str(DOWNLOAD_DIR / f"{download_id}_%(title).100s.%(ext)s")
-    opts["outtmpl"] = outtmpl
 
-    # Choose format
-    if is_audio:
-        # best audio; convert to mp3
-        opts["format"] = "bestaudio/best"
-        opts["postprocessors"] = [
-            {
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "mp3",
-                "preferredquality": "192",
-            }
-        ]
-    else:
-        if format_id and format_id != "best":
-            # specific video format selected by frontend
-            opts["format"] = f"{format_id}+bestaudio/best"
+def client_key(api_key: str | None, address: str | None) -> str:
+    """Rate limiting / fair queueing identity of a request."""
+    if api_key and api_key in API_KEYS:
+        return "key:" + hashlib.sha1(api_key.encode("utf-8")).hexdigest()[:16]
+    return f"ip:{address or 'unknown'}"
+
+
+def request_client() -> str:
+    return client_key(request.headers.get("X-API-Key"), request.remote_addr)
+
+
+def rejection(route: str, status: int, error: str, retry_after: float) -> tuple[int, dict, dict]:
+    REJECTED_REQUESTS.labels(route, error).inc()
+    retry_after = max(1, math.ceil(retry_after))
+    return status, {"error": error, "retry_after": retry_after}, {"Retry-After": str(retry_after)}
+
+
+def admit(client: str, route: str, cost: int = 1) -> tuple[int, dict, dict] | None:
+    """
+    Admission check for a "metadata" or "download" request: None to go ahead,
+    else (status, error body, headers) to answer with. Batches cost one token
+    per item (at most a full bucket).
+    """
+    if route == "download":
+        if DOWNLOAD_EXECUTOR.pending() >= DOWNLOAD_QUEUE_LIMIT:
+            return rejection(route, 503, "SERVER_BUSY", SHED_RETRY_AFTER)
+        if DOWNLOAD_EXECUTOR.pending(client) >= CLIENT_QUEUE_LIMIT:
+            return rejection(route, 429, "TOO_MANY_JOBS", SHED_RETRY_AFTER)
+    if RATE_LIMITER:
+        delay = RATE_LIMITER.take(client, min(cost, RATE_LIMITER.burst))
+        if delay > 0:
+            return rejection(route, 429, "RATE_LIMITED", delay)
+    return None
+
+
+def admission_refused(route: str, cost: int = 1):
+    """
+    admit() for the current Flask request: the response to answer with, or
+    None to go ahead. Routes call it once the input is valid, so a request
+    answered with 400 never costs a token.
+    """
+    with timed("admission"):
+        refused = admit(request_client(), route, cost)
+    if refused:
+        status, body, headers = refused
+        return jsonify(body), status, headers
+    return None
+
+
+# ---------------------------------------------------------
+# BANDWIDTH
+# ---------------------------------------------------------
+#
+# Two BandwidthGovernors pace the bytes this host moves: INGRESS the downloads
+# yt-dlp fetches from origins, EGRESS the files sent to clients. Each splits
+# its limit (bytes/s, per host) between the transfers running right now by
+# traffic class weight: "interactive" (a single download someone is waiting
+# for) gets BANDWIDTH_INTERACTIVE_WEIGHT shares, "bulk" (playlist ZIP
+# entries) BANDWIDTH_BULK_WEIGHT. Allocations are re-balanced every second: a
+# transfer that doesn't use its share (slow origin or client) keeps what it
+# uses plus headroom, the rest goes to the others. Gunicorn workers of one
+# host split the limit by their active weight through STATE_STORE. Limits
+# use yt-dlp's --limit-rate syntax ("50M"); 0 (default) turns pacing off.
+
+BANDWIDTH_INGRESS_LIMIT = yt_dlp.utils.parse_bytes(os.environ.get("BANDWIDTH_INGRESS_LIMIT") or "0") or 0
+BANDWIDTH_EGRESS_LIMIT = yt_dlp.utils.parse_bytes(os.environ.get("BANDWIDTH_EGRESS_LIMIT") or "0") or 0
+# Caps for a single download job / a single response, also bytes/s (0 = only the aggregate)
+BANDWIDTH_JOB_LIMIT = yt_dlp.utils.parse_bytes(os.environ.get("BANDWIDTH_JOB_LIMIT") or "0") or 0
+BANDWIDTH_RESPONSE_LIMIT = yt_dlp.utils.parse_bytes(os.environ.get("BANDWIDTH_RESPONSE_LIMIT") or "0") or 0
+TRAFFIC_CLASS_WEIGHTS = {
+    "interactive": float(os.environ.get("BANDWIDTH_INTERACTIVE_WEIGHT", "4")),
+    "bulk": float(os.environ.get("BANDWIDTH_BULK_WEIGHT", "1")),
+}
+BANDWIDTH_REBALANCE_SECONDS = 1.0
+BANDWIDTH_BURST_SECONDS = 0.5  # a paced transfer may run this far ahead of its rate
+BANDWIDTH_MIN_RATE = 16 * 1024  # floor of an allocation, so no transfer stalls completely
+BANDWIDTH_IDLE_RATIO = 0.8  # using less than this much of the allocation frees the rest
+BANDWIDTH_HEADROOM = 1.25  # a transfer that frees bandwidth keeps this much more than it uses
+
+BANDWIDTH_ALLOCATED = Gauge(
+    "ytdownloadx_bandwidth_allocated_bytes_per_second",
+    "Bandwidth allocated to running transfers",
+    ["direction", "traffic_class"],
+    multiprocess_mode="livesum",
+)
+BANDWIDTH_BYTES = Counter(
+    "ytdownloadx_bandwidth_bytes", "Bytes moved by paced transfers", ["direction", "traffic_class"]
+)
+BANDWIDTH_THROTTLED_SECONDS = Counter(
+    "ytdownloadx_bandwidth_throttled_seconds",
+    "Time paced transfers were held back",
+    ["direction", "traffic_class"],
+)
+
+
+def weighted_shares(capacity: float, demands: list[tuple[float, float]]) -> list[float]:
+    """
+    Split capacity between (weight, demand) pairs by weight, max-min fair: a
+    demand below its weighted share is met in full and what it leaves over is
+    split between the others again.
+    """
+    shares = [0.0] * len(demands)
+    if capacity == math.inf:
+        return [demand for _, demand in demands]
+    pending = {i for i, (weight, demand) in enumerate(demands) if weight > 0 and demand > 0}
+    left = capacity
+    while pending and left > 1e-6:
+        total = sum(demands[i][0] for i in pending)
+        met = {i for i in pending if demands[i][1] - shares[i] <= left * demands[i][0] / total}
+        if not met:
+            for i in pending:
+                shares[i] += left * demands[i][0] / total
+            break
+        for i in met:
+            left -= demands[i][1] - shares[i]
+            shares[i] = demands[i][1]
+        pending -= met
+    return shares
+
+
+class BandwidthGovernor:
+    """
+    Paces the transfers of one direction to a shared limit.
+
+    stream(traffic_class) registers a transfer; reserve() books bytes against
+    its allocation and returns how long to wait before moving them (consume()
+    sleeps that long). A thread per process measures what every transfer
+    actually moves and re-balances the allocations once a second.
+    """
+
+    def __init__(self, name: str, limit: float, stream_max: float = 0, store: StateStore | None = None):
+        self.name = name
+        self.limit = limit
+        self.stream_max = stream_max
+        self.store = store
+        self.share = float(limit) if limit else math.inf  # this process's part of the limit
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._streams: dict[str, dict] = {}
+        self._pid: int | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.limit > 0 or self.stream_max > 0
+
+    @contextmanager
+    def stream(self, traffic_class: str, stream_id: str | None = None):
+        """Register a transfer for the duration of the block; yields its id."""
+        stream_id = stream_id or uuid.uuid4().hex
+        if not self.enabled:
+            yield stream_id
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._start()
+            self._streams[stream_id] = {
+                "class": traffic_class if traffic_class in TRAFFIC_CLASS_WEIGHTS else "interactive",
+                "rate": math.inf,
+                "ready_at": now - BANDWIDTH_BURST_SECONDS,
+                "bytes": 0,
+                "since": now,
+                "used": None,
+                "held": False,
+                "busy": True,
+            }
+            self._allocate()
+        self._wake.set()
+        try:
+            yield stream_id
+        finally:
+            with self._lock:
+                self._streams.pop(stream_id, None)
+                self._allocate()
+
+    def promote(self, stream_id: str, traffic_class: str = "interactive") -> None:
+        """Move a running transfer to another traffic class."""
+        with self._lock:
+            if stream_id in self._streams:
+                self._streams[stream_id]["class"] = traffic_class
+                self._allocate()
+
+    def reserve(self, stream_id: str, nbytes: int) -> float:
+        """Book nbytes for a transfer; returns the seconds to wait before sending them."""
+        if not self.enabled or nbytes <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                return 0.0
+            stream["bytes"] += nbytes
+            rate = stream["rate"]
+            if rate == math.inf:
+                delay = 0.0
+            else:
+                stream["ready_at"] = max(stream["ready_at"], now - BANDWIDTH_BURST_SECONDS) + nbytes / rate
+                delay = max(0.0, stream["ready_at"] - now)
+                stream["held"] = stream["held"] or delay > 0
+            traffic_class = stream["class"]
+        BANDWIDTH_BYTES.labels(self.name, traffic_class).inc(nbytes)
+        if delay:
+            BANDWIDTH_THROTTLED_SECONDS.labels(self.name, traffic_class).inc(delay)
+        return delay
+
+    def consume(self, stream_id: str, nbytes: int) -> None:
+        """reserve() and wait; for threads moving the bytes themselves."""
+        delay = self.reserve(stream_id, nbytes)
+        if delay:
+            time.sleep(delay)
+
+    def rebalance(self) -> None:
+        """Refresh this process's share of the limit and every transfer's allocation."""
+        self._refresh_share()
+        now = time.monotonic()
+        with self._lock:
+            for stream in self._streams.values():
+                elapsed = now - stream["since"]
+                if elapsed >= BANDWIDTH_REBALANCE_SECONDS / 2:
+                    stream["used"] = stream["bytes"] / elapsed
+                    # held back, or still waiting out a large block: it wants more
+                    stream["busy"] = stream["held"] or stream["ready_at"] > now
+                    stream["bytes"], stream["since"], stream["held"] = 0, now, False
+            self._allocate()
+
+    def allocation_hint(self, traffic_class: str) -> float:
+        """What a new transfer of traffic_class would get now (for proxies pacing on our behalf)."""
+        with self._lock:
+            weight = TRAFFIC_CLASS_WEIGHTS.get(traffic_class, 1.0)
+            total = weight + sum(TRAFFIC_CLASS_WEIGHTS[s["class"]] for s in self._streams.values())
+            rate = self.share * weight / total
+        if self.stream_max:
+            rate = min(rate, self.stream_max)
+        return max(rate, BANDWIDTH_MIN_RATE)
+
+    def stats(self) -> dict:
+        with self._lock:
+            streams = [
+                {
+                    "id": stream_id,
+                    "traffic_class": stream["class"],
+                    "allocated": round(stream["rate"]) if stream["rate"] != math.inf else None,
+                    "rate": round(stream["used"]) if stream["used"] is not None else None,
+                }
+                for stream_id, stream in self._streams.items()
+            ]
+        return {
+            "enabled": self.enabled,
+            "limit": self.limit or None,
+            "stream_max": self.stream_max or None,
+            "process_share": round(self.share) if self.share != math.inf else None,
+            "streams": streams,
+        }
+
+    def _start(self) -> None:
+        # caller holds self._lock; forked workers start their own balancer
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._wake = threading.Event()
+        threading.Thread(target=self._balance, name=f"bandwidth-{self.name}", daemon=True).start()
+
+    def _balance(self) -> None:
+        while True:
+            if not self._streams:
+                self._refresh_share()  # hands our part back to the other workers
+                self._wake.wait()
+                self._wake.clear()
+            time.sleep(BANDWIDTH_REBALANCE_SECONDS)
+            try:
+                self.rebalance()
+            except Exception as e:  # noqa: BLE001
+                logger.error("Bandwidth %s rebalance error: %s", self.name, e)
+
+    def _refresh_share(self) -> None:
+        """Publish this process's active weight; its share is its part of the host's total."""
+        if not self.limit or self.store is None:
+            return
+        with self._lock:
+            weight = sum(TRAFFIC_CLASS_WEIGHTS[s["class"]] for s in self._streams.values())
+        prefix = f"{self.name}:{socket.gethostname()}:"
+        key = f"{prefix}{os.getpid()}"
+        if weight:
+            self.store.set("bandwidth", key, weight, ttl=BANDWIDTH_REBALANCE_SECONDS * 5)
+        else:
+            self.store.delete("bandwidth", key)
+        total = sum(float(v) for k, v in self.store.items("bandwidth") if k.startswith(prefix) and k != key)
+        self.share = self.limit * weight / (weight + total) if weight else float(self.limit)
+
+    def _allocate(self) -> None:
+        # caller holds self._lock
+        streams = list(self._streams.values())
+        demands = []
+        for stream in streams:
+            used, rate = stream["used"], stream["rate"]
+            if used is None or rate == math.inf or stream["busy"] or used >= rate * BANDWIDTH_IDLE_RATIO:
+                demand = math.inf
+            else:
+                demand = max(used * BANDWIDTH_HEADROOM, BANDWIDTH_MIN_RATE)
+            if self.stream_max:
+                demand = min(demand, self.stream_max)
+            demands.append((TRAFFIC_CLASS_WEIGHTS[stream["class"]], demand))
+
+        rates = weighted_shares(self.share, demands)
+        left = self.share - sum(rates)
+        if left > 1e-6 and left != math.inf:
+            # nobody wants more right now: hand out the rest anyway, so a
+            # transfer that speeds up doesn't wait for the next re-balance
+            ceiling = self.stream_max or math.inf
+            extra = weighted_shares(left, [(weight, ceiling - rate) for (weight, _), rate in zip(demands, rates)])
+            rates = [rate + more for rate, more in zip(rates, extra)]
+
+        allocated = dict.fromkeys(TRAFFIC_CLASS_WEIGHTS, 0.0)
+        for stream, rate in zip(streams, rates):
+            stream["rate"] = max(rate, BANDWIDTH_MIN_RATE) if rate != math.inf else math.inf
+            if stream["rate"] != math.inf:
+                allocated[stream["class"]] += stream["rate"]
+        for traffic_class, rate in allocated.items():
+            BANDWIDTH_ALLOCATED.labels(self.name, traffic_class).set(rate)
+
+
+INGRESS = BandwidthGovernor("ingress", BANDWIDTH_INGRESS_LIMIT, BANDWIDTH_JOB_LIMIT, STATE_STORE)
+EGRESS = BandwidthGovernor("egress", BANDWIDTH_EGRESS_LIMIT, BANDWIDTH_RESPONSE_LIMIT, STATE_STORE)
+
+
+def throttled(chunks, governor: BandwidthGovernor, traffic_class: str):
+    """Pace a response body (an iterable of bytes) through governor."""
+    if not governor.enabled:
+        return chunks
+
+    def generate():
+        try:
+            with governor.stream(traffic_class) as stream_id:
+                for chunk in chunks:
+                    governor.consume(stream_id, len(chunk))
+                    yield chunk
+        finally:
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+
+    return generate()
+
+
+def ingress_hook(job_id: str, seen: dict, d: dict) -> None:
+    """
+    yt-dlp progress hook pacing a download through INGRESS. It runs in the
+    download thread after every block, so waiting here slows the download.
+    """
+    if d.get("status") != "downloading":
+        return
+    name = d.get("tmpfilename") or d.get("filename")
+    done = d.get("downloaded_bytes") or 0
+    previous = seen.get(name)
+    seen[name] = done
+    # the first report of a file may include bytes of an earlier (resumed) run
+    if previous is not None and done > previous:
+        INGRESS.consume(job_id, done - previous)
+
+
+# ---------------------------------------------------------
+# IMAGES (THUMBNAILS, QR CODES)
+# ---------------------------------------------------------
+#
+# Metadata responses point thumbnails at /img/thumb/<key>/<width>.webp instead
+# of the upstream CDN. The source URL is registered in STATE_STORE under key
+# when the metadata is built (so the endpoint only ever fetches URLs that came
+# out of an extraction); the first request fetches it once and writes every
+# width in THUMBNAIL_WIDTHS as WebP. QR codes for /files/<id> links are drawn
+# locally. Both live in a size-bounded directory and are sent with long-lived
+# Cache-Control, since a URL's image never changes.
+
+IMAGE_CACHE_DIR = Path(os.environ.get("IMAGE_CACHE_DIR") or DOWNLOAD_DIR / "images")
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_MB", "100")) * 1024 * 1024
+IMAGE_MAX_AGE = int(os.environ.get("IMAGE_MAX_AGE", str(30 * 24 * 3600)))
+THUMBNAIL_WIDTHS = tuple(
+    sorted(int(w) for w in os.environ.get("THUMBNAIL_WIDTHS", "160,320,640").split(",") if w.strip())
+)
+THUMBNAIL_QUALITY = 75  # WebP
+THUMBNAIL_SOURCE_TTL = 7 * 24 * 3600  # outlives metadata cache entries that link to it
+THUMBNAIL_SOURCE_MAX_BYTES = 8 * 1024 * 1024
+THUMBNAIL_FETCH_TIMEOUT = 10
+THUMBNAIL_FAILURE_TTL = 60  # a source that failed is not fetched again for this long
+# Public origin for absolute links (QR codes); default: the request's host
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "").rstrip("/")
+
+THUMBNAIL_KEY_RE = re.compile(r"^[0-9a-f]{20}$")
+QR_FORMATS = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+class ImageCache:
+    """
+    Directory of generated images bounded to max_bytes; when it grows past
+    that, the least recently used files (by mtime, bumped on reads) are removed.
+    Writes are atomic, so workers can share the directory.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._bytes: int | None = None  # estimate; recounted when trimming
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name: str) -> bytes | None:
+        path = self.directory / name
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, name: str, data: bytes) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp = self.directory / f".{name}.{os.getpid()}.{threading.get_ident()}"
+        tmp.write_bytes(data)
+        os.replace(tmp, self.directory / name)
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._usage()
+            else:
+                self._bytes += len(data)
+            if self._bytes > self.max_bytes:
+                self._bytes = self._trim()
+
+    def _files(self) -> list[os.DirEntry]:
+        try:
+            return [e for e in os.scandir(self.directory) if e.is_file() and not e.name.startswith(".")]
+        except FileNotFoundError:
+            return []
+
+    def _usage(self) -> int:
+        return sum(e.stat().st_size for e in self._files())
+
+    def _trim(self) -> int:
+        """Delete oldest files until the directory is at 90% of the limit; returns its size."""
+        files = sorted(self._files(), key=lambda e: e.stat().st_mtime)
+        total = sum(e.stat().st_size for e in files)
+        for entry in files:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.unlink(entry.path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        return total
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+IMAGE_CACHE = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+
+# per-process single flight for thumbnail sources: key -> [lock, threads using it]
+_THUMBNAIL_LOCKS: dict[str, list] = {}
+_THUMBNAIL_LOCKS_GUARD = threading.Lock()
+
+
+def thumbnail_url(src: str | None, width: int) -> str | None:
+    """Register a thumbnail source and return its local URL at (the next size up from) width."""
+    if not src or urlparse(src).scheme not in ("http", "https"):
+        return src
+    key = hashlib.sha1(src.encode("utf-8")).hexdigest()[:20]
+    STATE_STORE.set("thumbnails", key, src, ttl=THUMBNAIL_SOURCE_TTL)
+    width = next((w for w in THUMBNAIL_WIDTHS if w >= width), THUMBNAIL_WIDTHS[-1])
+    return f"/img/thumb/{key}/{width}.webp"
+
+
+def fetch_image(src: str) -> bytes:
+    """Download a source image, refusing anything larger than THUMBNAIL_SOURCE_MAX_BYTES."""
+    with requests.get(src, stream=True, timeout=THUMBNAIL_FETCH_TIMEOUT) as resp:
+        resp.raise_for_status()
+        data = bytearray()
+        for chunk in resp.iter_content(64 * 1024):
+            data += chunk
+            if len(data) > THUMBNAIL_SOURCE_MAX_BYTES:
+                raise ValueError(f"thumbnail larger than {THUMBNAIL_SOURCE_MAX_BYTES} bytes")
+    return bytes(data)
+
+
+def resize_webp(data: bytes, widths: tuple[int, ...]) -> dict[int, bytes]:
+    """Encode an image as WebP at each width (never upscaled)."""
+    with Image.open(io.BytesIO(data)) as img:
+        img = img.convert("RGBA" if img.mode in ("RGBA", "LA", "P") else "RGB")
+        out = {}
+        for width in widths:
+            w = min(width, img.width)
+            resized = img.resize((w, max(1, round(img.height * w / img.width))), Image.LANCZOS)
+            buf = io.BytesIO()
+            resized.save(buf, "WEBP", quality=THUMBNAIL_QUALITY, method=4)
+            out[width] = buf.getvalue()
+    return out
+
+
+def load_thumbnail(key: str, width: int) -> bytes | None:
+    """WebP thumbnail from IMAGE_CACHE, made from the registered source on a miss (None if unknown)."""
+    name = f"thumb_{key}_{width}.webp"
+    data = IMAGE_CACHE.get(name)
+    if data is not None:
+        return data
+
+    with _THUMBNAIL_LOCKS_GUARD:
+        entry = _THUMBNAIL_LOCKS.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            data = IMAGE_CACHE.get(name)  # made while we waited
+            if data is not None:
+                return data
+            failed = STATE_STORE.get("thumbnail_failures", key)
+            if failed is not None:
+                raise RuntimeError(f"source failed recently: {failed}")
+            src = STATE_STORE.get("thumbnails", key)
+            if src is None:
+                return None
+            started = time.perf_counter()
+            try:
+                sizes = resize_webp(fetch_image(src), THUMBNAIL_WIDTHS)
+            except Exception as e:
+                STATE_STORE.set("thumbnail_failures", key, str(e)[:200], ttl=THUMBNAIL_FAILURE_TTL)
+                raise
+            for w, encoded in sizes.items():
+                IMAGE_CACHE.put(f"thumb_{key}_{w}.webp", encoded)
+            logger.info("Thumbnail %s cached in %.3fs", key, time.perf_counter() - started)
+            return sizes[width]
+    finally:
+        # the lock goes once nobody holds or waits for it, so waiters share one fetch
+        with _THUMBNAIL_LOCKS_GUARD:
+            entry[1] -= 1
+            if not entry[1]:
+                _THUMBNAIL_LOCKS.pop(key, None)
+
+
+def resolve_base_url() -> str:
+    """Public origin for absolute links: PUBLIC_BASE_URL, else the request's scheme and host."""
+    if PUBLIC_BASE_URL:
+        return PUBLIC_BASE_URL
+    return request.host_url.rstrip("/")
+
+
+def generate_qr_code(data: str, fmt: str = "png", box_size: int = 6, border: int = 2) -> bytes:
+    """QR code of data as PNG or SVG bytes."""
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=box_size, border=border)
+    qr.add_data(data)
+    qr.make(fit=True)
+    if fmt == "svg":
+        img = qr.make_image(image_factory=qrcode.image.svg.SvgPathImage)
+    else:
+        img = qr.make_image(fill_color="black", back_color="white")
+    buf = io.BytesIO()
+    img.save(buf)
+    return buf.getvalue()
+
+
+def image_response(data: bytes, mimetype: str) -> Response:
+    """Long-lived cacheable image; compress_response handles If-None-Match."""
+    resp = app.response_class(data, mimetype=mimetype)
+    resp.set_etag(content_etag(data))
+    resp.headers["Cache-Control"] = f"public, max-age={IMAGE_MAX_AGE}, immutable"
+    return resp
+
+
+# ---------------------------------------------------------
+# STRATEGY SELECTION
+# ---------------------------------------------------------
+#
+# yt-dlp runs with either the "enhanced" options (best quality, merges) or the
+# "simple" ones (single progressive file). Each site (extractor) has its own
+# circuit breaker on the enhanced strategy: when its error rate over a rolling
+# window gets too high the site is served with the simple strategy, and after
+# a cooldown one request probes enhanced again (half-open) to close it.
+# Breaker state lives in STATE_STORE, so all workers see the same state.
+
+STRATEGIES = ("enhanced", "simple")
+
+BREAKER_WINDOW_SECONDS = int(os.environ.get("BREAKER_WINDOW_SECONDS", "300"))
+BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", "4"))
+BREAKER_ERROR_RATE = float(os.environ.get("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_COOLDOWN_SECONDS = int(os.environ.get("BREAKER_COOLDOWN_SECONDS", "60"))
+BREAKER_MAX_EVENTS = 100
+
+# Attempts per download job / metadata request, with full-jitter backoff
+DOWNLOAD_ATTEMPTS = int(os.environ.get("DOWNLOAD_ATTEMPTS", "3"))
+METADATA_ATTEMPTS = 2
+RETRY_BACKOFF_BASE = 1.0
+RETRY_BACKOFF_CAP = 8.0
+
+
+class CircuitBreaker:
+    """
+    Per-site circuit breaker for the enhanced strategy.
+
+    closed    -> enhanced is used; opens when, within the window, at least
+                 min_calls enhanced attempts ran and error_rate of them failed
+    open      -> simple is used until cooldown has passed
+    half_open -> one request probes enhanced; success closes, failure reopens
+    """
+
+    def __init__(
+        self,
+        store: StateStore,
+        window: int = BREAKER_WINDOW_SECONDS,
+        min_calls: int = BREAKER_MIN_CALLS,
+        error_rate: float = BREAKER_ERROR_RATE,
+        cooldown: float = BREAKER_COOLDOWN_SECONDS,
+    ):
+        self.store = store
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        # per-process counters: (site, strategy, outcome) -> requests
+        self.served: dict[tuple[str, str, str], int] = {}
+
+    def _windowed(self, record: dict | None) -> dict:
+        """A stored record (None if absent) with only the events inside the window."""
+        record = record or {
+            "state": "closed",
+            "opened_at": None,
+            "events": {strategy: [] for strategy in STRATEGIES},
+        }
+        cutoff = time.time() - self.window
+        for strategy, events in record["events"].items():
+            record["events"][strategy] = [e for e in events if e[0] >= cutoff][-BREAKER_MAX_EVENTS:]
+        return record
+
+    def _load(self, site: str) -> dict:
+        return self._windowed(self.store.get("breaker", site))
+
+    def _update(self, site: str, fn) -> dict:
+        """
+        Atomic read-modify-write of a site's record, so workers never write back
+        a stale copy. fn may run more than once (store retries): no side effects.
+        """
+        return self.store.update(
+            "breaker", site, lambda record: fn(self._windowed(record)), ttl=max(self.window, self.cooldown) * 2
+        )
+
+    def _rate(self, events: list) -> float | None:
+        return round(sum(1 for _, ok in events if not ok) / len(events), 3) if events else None
+
+    def state(self, site: str) -> str:
+        """Current breaker state, without claiming a probe."""
+        return self._load(site)["state"]
+
+    def choose(self, site: str) -> tuple[str, bool]:
+        """Return (strategy, probe) for the next request to a site."""
+        record = self._load(site)
+        if record["state"] == "closed":
+            return "enhanced", False
+
+        # open past its cooldown, or half-open with a probe that never reported
+        # back (the probe claim expires after one cooldown)
+        cooled_down = time.time() - record["opened_at"] >= self.cooldown
+        if not (record["state"] == "half_open" or cooled_down):
+            return "simple", False
+        if not self.store.add("breaker_probe", site, True, ttl=self.cooldown):
+            return "simple", False
+
+        def to_half_open(current):
+            if current["state"] != "closed":
+                current["state"] = "half_open"
+            return current
+
+        record = self._update(site, to_half_open)
+        BREAKER_STATE.labels(site).set(BREAKER_STATE_VALUES[record["state"]])
+        if record["state"] == "closed":
+            # another worker closed the circuit since we read it
+            self.store.delete("breaker_probe", site)
+            return "enhanced", False
+        logger.info("Circuit for %s half-open, probing enhanced strategy", site)
+        return "enhanced", True
+
+    def record(self, site: str, strategy: str, ok: bool) -> None:
+        """Record the outcome of one attempt and open / close the circuit."""
+        key = (site, strategy, "ok" if ok else "error")
+        with self._lock:
+            self.served[key] = self.served.get(key, 0) + 1
+        STRATEGY_REQUESTS.labels(*key).inc()
+
+        now = time.time()
+        previous = None
+
+        def apply(record):
+            nonlocal previous
+            previous = record["state"]
+            record["events"].setdefault(strategy, []).append([now, ok])
+            if strategy != "enhanced":
+                return record
+            if record["state"] == "half_open":
+                if ok:
+                    record.update(state="closed", opened_at=None)
+                    record["events"]["enhanced"] = []
+                else:
+                    record.update(state="open", opened_at=now)
+            elif record["state"] == "closed" and not ok:
+                events = record["events"]["enhanced"]
+                if len(events) >= self.min_calls and self._rate(events) >= self.error_rate:
+                    record.update(state="open", opened_at=now)
+            return record
+
+        record = self._update(site, apply)
+        BREAKER_STATE.labels(site).set(BREAKER_STATE_VALUES[record["state"]])
+        if previous == "half_open" and strategy == "enhanced":
+            self.store.delete("breaker_probe", site)
+            if record["state"] == "closed":
+                logger.info("Circuit for %s closed, enhanced strategy recovered", site)
+            else:
+                logger.warning("Circuit for %s re-opened after failed probe", site)
+        elif previous == "closed" and record["state"] == "open":
+            events = record["events"]["enhanced"]
+            logger.warning(
+                "Circuit for %s opened (enhanced error rate %.0f%% over %d calls), using simple strategy",
+                site,
+                self._rate(events) * 100,
+                len(events),
+            )
+
+    def snapshot(self) -> dict:
+        """Breaker state, rolling error rates and served counts per site seen by this worker."""
+        with self._lock:
+            sites = sorted({site for site, _, _ in self.served})
+            served = dict(self.served)
+        result = {}
+        for site in sites:
+            record = self._load(site)
+            result[site] = {
+                "state": record["state"],
+                "strategies": {
+                    strategy: {
+                        "error_rate": self._rate(record["events"].get(strategy, [])),
+                        "ok": served.get((site, strategy, "ok"), 0),
+                        "errors": served.get((site, strategy, "error"), 0),
+                    }
+                    for strategy in STRATEGIES
+                },
+            }
+        return result
+
+
+STRATEGY_BREAKER = CircuitBreaker(STATE_STORE)
+
+
+def is_expected_error(exc: BaseException) -> bool:
+    """
+    Errors about the video itself (private, removed, unsupported URL...).
+    No strategy fixes those, so they are neither retried nor held against one.
+    """
+    if isinstance(exc, yt_dlp.utils.DownloadError) and exc.exc_info:
+        exc = exc.exc_info[1]
+    return isinstance(exc, yt_dlp.utils.ExtractorError) and exc.expected
+
+
+def run_with_strategy(
+    url: str,
+    attempt,
+    attempts: int = DOWNLOAD_ATTEMPTS,
+    before_retry=None,
+    breaker: CircuitBreaker | None = None,
+):
+    """
+    Call attempt(strategy) for a URL and return (result, strategy).
+
+    Starts with the strategy the site's breaker picks, retries with jittered
+    exponential backoff and makes the last attempt (or every attempt after a
+    failed probe) with the simple strategy. before_retry(strategy, error) runs
+    before each retry. Overloaded (no free slot) is raised right away and
+    not held against the site.
+    """
+    breaker = breaker or STRATEGY_BREAKER
+    site = site_key(url)
+    first, probe = breaker.choose(site)
+    if first == "simple" or probe:
+        rest = ["simple"] * attempts
+    else:
+        rest = ["enhanced"] * (attempts - 2) + ["simple"]
+    plan = [first] + rest[: max(0, attempts - 1)]
+
+    error: Exception | None = None
+    for n, strategy in enumerate(plan):
+        if n:
+            delay = random.uniform(0, min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * 2 ** (n - 1)))
+            logger.warning(
+                "Retrying %s with %s strategy in %.1fs (attempt %d/%d): %s",
+                url, strategy, delay, n + 1, len(plan), error,
+            )
+            if before_retry:
+                before_retry(strategy, error)
+            time.sleep(delay)
+        try:
+            result = attempt(strategy)
+        except Overloaded:
+            raise
+        except Exception as e:  # noqa: BLE001
+            if is_expected_error(e):
+                # the site answered; the video just isn't available
+                breaker.record(site, strategy, ok=True)
+                raise
+            breaker.record(site, strategy, ok=False)
+            error = e
+            continue
+        breaker.record(site, strategy, ok=True)
+        return result, strategy
+
+    raise error
+
+
+# ---------------------------------------------------------
+# HELPERS
+# ---------------------------------------------------------
+
+
+def safe_download_name(title: str, ext: str) -> str:
+    """
+    Build a *HTTP-header-safe* download filename.
+
+    - Removes weird characters (/, ?, :, etc.)
+    - Keeps only letters, numbers, spaces, dash, underscore and dot
+    - Ensures we always return something ASCII-ish
+    """
+    if not title:
+        base = "video"
+    else:
+        # Replace disallowed chars with underscore
+        base = "".join(
+            c if c.isalnum() or c in " .-_"
+            else "_"
+            for c in title
+        )
+        # Collapse multiple underscores/spaces
+        base = re.sub(r"[_\s]+", " ", base).strip(" .-_")
+        if not base:
+            base = "video"
+
+    if not ext:
+        ext = "mp4"
+
+    return f"{base}.{ext}"
+
+
+def media_mimetype(ext: str) -> str:
+    """Content-Type for a downloaded file extension."""
+    return {
+        "mp3": "audio/mpeg",
+        "m4a": "audio/mp4",
+        "webm": "video/webm",
+        "mkv": "video/x-matroska",
+    }.get((ext or "").lower(), "video/mp4")
+
+
+def attachment_headers(download_name: str) -> dict:
+    """Content-Disposition parameters for a download name (same rules as send_file)."""
+    try:
+        download_name.encode("ascii")
+        return {"filename": download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", download_name).encode("ascii", "ignore").decode("ascii")
+        quoted = quote(download_name, safe="!#$&+^`|~")
+        return {"filename": simple, "filename*": f"UTF-8''{quoted}"}
+
+
+def base_ydl_opts() -> dict:
+    """Common yt-dlp options used for both metadata and download."""
+    opts: dict = {
+        # yt-dlp output goes to YTDLP_LOGGER; [debug] lines and progress only with YTDLP_VERBOSE
+        "logger": YTDLP_LOGGER,
+        "verbose": YTDLP_VERBOSE,
+        "noprogress": not YTDLP_VERBOSE,
+        # errors must raise: retries and the circuit breaker depend on them
+        "ignoreerrors": False,
+        "retries": 5,
+        "fragment_retries": 5,
+        "skip_unavailable_fragments": True,
+        # pick up .part files / fragments left by an interrupted job (see RESUMABLE JOBS)
+        "continuedl": True,
+        "source_address": "0.0.0.0",
+        "geo_bypass": True,
+        "geo_bypass_country": "US",
+        "http_headers": {
+            "User-Agent": (
+                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+                "AppleWebKit/537.36 (KHTML, like Gecko) "
+                "Chrome/139.0.0.0 Safari/537.36"
+            ),
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+            "Accept-Language": "en-us,en;q=0.5",
+            "Sec-Fetch-Mode": "navigate",
+        },
+        "noplaylist": False,  # we want playlist metadata
+        # keep local mtime = download time, the cleanup TTL is based on it
+        "updatetime": False,
+    }
+
+    if COOKIES_PATH.exists():
+        opts["cookiefile"] = str(COOKIES_PATH)
+
+    return opts
+
+
+def ffmpeg_thread_args() -> dict:
+    """yt-dlp postprocessor_args that cap ffmpeg's thread count."""
+    threads = ["-threads", str(FFMPEG_THREADS)]
+    return {"videoconvertor": threads, "extractaudio": threads, "merger": threads}
+
+
+def get_format_selector(kind: str, format_id: str | None = None, simple: bool = False) -> str:
+    """
+    yt-dlp format selector for a download.
+
+    kind is "mp3", "m4a" (original audio, no conversion) or "mp4"; format_id
+    is the id picked in the resolution dropdown ("best" / None for automatic).
+    Simple mode avoids merging.
+    """
+    if kind == "mp3":
+        # best audio; converted to mp3 afterwards
+        return "bestaudio/best"
+
+    if kind == "m4a":
+        return "bestaudio[ext=m4a]/bestaudio/best"
+
+    if format_id and format_id != "best":
+        # specific video format selected by frontend; m4a audio keeps the merge mp4
+        if simple:
+            return format_id
+        return f"{format_id}+bestaudio[ext=m4a]/{format_id}+bestaudio/best"
+
+    if simple:
+        return "best[height<=1080][ext=mp4]/best[height<=1080]/best"
+    return "bestvideo*+bestaudio/best"
+
+
+def get_ydl_opts_enhanced(
+    download: bool = False,
+    format_id: str | None = None,
+    kind: str = "mp4",
+    download_id: str | None = None,
+) -> tuple[dict, str | None]:
+    """
+    Enhanced yt-dlp configuration.
+
+    Returns (opts, download_id). For metadata, download_id is None. Passing
+    the download_id of an interrupted download writes to the same files.
+    """
+    opts = base_ydl_opts()
+
+    if not download:
+        # metadata only
+        opts.update(
+            {
+                "skip_download": True,
+                "simulate": True,
+                # playlists: list entries only, formats are resolved per video on demand
+                "extract_flat": "in_playlist",
+                "quiet": not YTDLP_VERBOSE,
+                "no_warnings": False,
+                # both print straight to stdout (a format table, the whole info dict)
+                "forcejson": YTDLP_VERBOSE,
+                "listformats": YTDLP_VERBOSE,
+                "outtmpl": str(DOWNLOAD_DIR / "%(id)s.%(ext)s"),
+            }
+        )
+        return opts, None
+
+    # actual download
+    download_id = download_id or uuid.uuid4().hex
+    outtmpl = str(DOWNLOAD_DIR / f"{download_id}_%(title).100s.%(ext)s")
+    opts["outtmpl"] = outtmpl
+
+    # Choose format
+    opts["format"] = get_format_selector(kind, format_id)
+    # same resolution/fps first, then prefer mp4/m4a so merges are a stream copy
+    opts["format_sort"] = ["res", "fps", "ext:mp4:m4a"]
+    opts["postprocessor_args"] = ffmpeg_thread_args()
+    # mp3 conversion, remux and transcode run afterwards on POSTPROCESS_STAGE
+    if kind == "mp4":
+        # merge straight into mp4 when the codecs allow it (a stream copy)
+        opts["merge_output_format"] = "mp4/mkv"
+
+    logger.debug("Using ENHANCED yt-dlp options")
+    return opts, download_id
+
+
+def get_ydl_opts_simple(
+    download: bool = False,
+    format_id: str | None = None,
+    kind: str = "mp4",
+    download_id: str | None = None,
+) -> tuple[dict, str | None]:
+    """
+    Very simple fallback options if enhanced mode fails for some user.
+    """
+    opts = base_ydl_opts()
+    opts["http_headers"]["User-Agent"] = (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/120.0 Safari/537.36"
+    )
+
+    if not download:
+        opts.update(
+            {
+                "skip_download": True,
+                "simulate": True,
+                # playlists: list entries only, formats are resolved per video on demand
+                "extract_flat": "in_playlist",
+                "quiet": not YTDLP_VERBOSE,
+                "no_warnings": False,
+                # both print straight to stdout (a format table, the whole info dict)
+                "forcejson": YTDLP_VERBOSE,
+                "listformats": YTDLP_VERBOSE,
+                "outtmpl": str(DOWNLOAD_DIR / "%(id)s.%(ext)s"),
+            }
+        )
+        return opts, None
+
+    download_id = download_id or uuid.uuid4().hex
+    outtmpl = str(DOWNLOAD_DIR / f"{download_id}_%(title).100s.%(ext)s")
+    opts["outtmpl"] = outtmpl
+
+    opts["format"] = get_format_selector(kind, format_id, simple=True)
+    opts["postprocessor_args"] = ffmpeg_thread_args()
+    # mp3 conversion, remux and transcode run afterwards on POSTPROCESS_STAGE
+    if kind == "mp4":
+        # merge straight into mp4 when the codecs allow it (a stream copy)
+        opts["merge_output_format"] = "mp4/mkv"
+
+    logger.debug("Using SIMPLE yt-dlp options")
+    return opts, download_id
+
+
+def final_opts(
+    download: bool = False,
+    format_id: str | None = None,
+    kind: str = "mp4",
+    strategy: str = "enhanced",
+    download_id: str | None = None,
+) -> tuple[dict, str | None]:
+    """
+    Options for a strategy ("enhanced" or "simple", see run_with_strategy).
+    """
+    if strategy == "simple":
+        return get_ydl_opts_simple(download=download, format_id=format_id, kind=kind, download_id=download_id)
+    return get_ydl_opts_enhanced(download=download, format_id=format_id, kind=kind, download_id=download_id)
+
+
+def extract_formats_for_frontend(formats: list[dict]) -> list[dict]:
+    """
+    Convert yt-dlp 'formats' list to a trimmed version for the resolution dropdown.
+    """
+    cleaned: list[dict] = []
+    seen_ids: set[str] = set()
+
+    for f in formats or []:
+        fmt_id = str(f.get("format_id") or f.get("id") or "")
+        if not fmt_id or fmt_id in seen_ids:
+            continue
+
+        # skip weird text formats like "mhtml"
+        if f.get("ext") == "mhtml":
+            continue
+
+        item = {
+            "format_id": fmt_id,
+            "ext": f.get("ext"),
+            "height": f.get("height"),
+            "width": f.get("width"),
+            "fps": f.get("fps"),
+            "tbr": f.get("tbr"),
+            "vcodec": f.get("vcodec"),
+            "acodec": f.get("acodec"),
+            "resolution": f.get("resolution"),
+            "quality": f.get("quality"),
+            "filesize": f.get("filesize") or f.get("filesize_approx"),
+        }
+        cleaned.append(item)
+        seen_ids.add(fmt_id)
+
+    return cleaned
+
+
+# codec families (see codec_family) under the names users know them by
+CODEC_CLASSES = {
+    "avc1": "h264",
+    "avc3": "h264",
+    "hvc1": "h265",
+    "hev1": "h265",
+    "hevc": "h265",
+    "vp09": "vp9",
+    "av01": "av1",
+    "mp4a": "aac",
+}
+
+
+def codec_class(codec: str | None) -> str | None:
+    family = codec_family(codec)
+    return CODEC_CLASSES.get(family, family)
+
+
+def estimated_size(f: dict, duration: float | None) -> int | None:
+    """A format's file size: reported by the site, else bitrate x duration."""
+    if f.get("filesize"):
+        return int(f["filesize"])
+    if f.get("tbr") and duration:
+        return int(f["tbr"] * 1000 / 8 * duration)
+    return None
+
+
+def quality_ladder(formats: list[dict], duration: float | None) -> dict:
+    """
+    Summarise extract_formats_for_frontend() output as a quality ladder:
+    one video rung per height / fps / codec class and one audio rung per
+    codec class / bitrate, each the largest format of its group. Sizes of
+    video-only rungs include the audio stream the download is merged with.
+    """
+    videos: dict[tuple, tuple] = {}
+    audios: dict[tuple, tuple] = {}
+
+    for f in formats:
+        vcodec, acodec = codec_class(f.get("vcodec")), codec_class(f.get("acodec"))
+        size = estimated_size(f, duration)
+        if vcodec and f.get("height"):
+            key = (f["height"], round(f.get("fps") or 0), vcodec)
+            group = videos
+        elif acodec and not vcodec:
+            key = (acodec, round((f.get("tbr") or 0) / 16) * 16)
+            group = audios
+        else:
+            continue
+        if key not in group or (size or 0) > (group[key][1] or 0):
+            group[key] = (f, size)
+
+    # get_format_selector merges video-only formats with m4a audio when there is some
+    merge_audio = max(
+        (size or 0 for f, size in audios.values() if f.get("ext") == "m4a"), default=0
+    ) or max((size or 0 for f, size in audios.values()), default=0)
+
+    video_rungs = []
+    for (height, fps, codec), (f, size) in videos.items():
+        if size and codec_class(f.get("acodec")) is None:
+            size += merge_audio
+        video_rungs.append(
+            {
+                "format_id": f["format_id"],
+                "label": f"{height}p{fps if fps > 30 else ''}",
+                "height": height,
+                "fps": fps or None,
+                "codec": codec,
+                "ext": f.get("ext"),
+                "filesize": size,
+            }
+        )
+
+    audio_rungs = [
+        {
+            "format_id": f["format_id"],
+            "label": f"{kbps} kbps" if kbps else codec,
+            "abr": kbps or None,
+            "codec": codec,
+            "ext": f.get("ext"),
+            "filesize": size,
+        }
+        for (codec, kbps), (f, size) in audios.items()
+    ]
+
+    video_rungs.sort(key=lambda r: (r["height"], r["fps"] or 0, r["codec"] == "h264"), reverse=True)
+    audio_rungs.sort(key=lambda r: r["abr"] or 0, reverse=True)
+    return {"video": video_rungs, "audio": audio_rungs}
+
+
+def locate_downloaded_file(info: dict) -> Path | None:
+    """
+    Find the final file yt-dlp produced for a download.
+
+    yt-dlp reports the post-processed path in requested_downloads; _filename
+    is the pre-processing name for older versions.
+    """
+    for item in info.get("requested_downloads") or []:
+        path = item.get("filepath")
+        if path and Path(path).exists():
+            return Path(path)
+
+    file_path = info.get("_filename")
+    if file_path and Path(file_path).exists():
+        return Path(file_path)
+
+    return None
+
+
+# ---------------------------------------------------------
+# YT-DLP CONTEXT POOL
+# ---------------------------------------------------------
+#
+# A new YoutubeDL registers ~1800 extractors (~70 ms) and parses cookies.txt,
+# and the first extraction in a process compiles every extractor's URL regex
+# (~0.5 s). Contexts are therefore kept per option profile and reused; only
+# the per-request options (output template, format, hooks) change between
+# leases. warm_up() pays the one-off costs at import, so with gunicorn
+# --preload (gunicorn.conf.py) they are paid once by the master and every
+# forked or recycled worker starts warm.
+
+YDL_POOL_SIZE = int(os.environ.get("YDL_POOL_SIZE", "4"))  # idle contexts kept per profile
+YDL_MAX_USES = int(os.environ.get("YDL_MAX_USES", "50"))  # then the context is rebuilt
+YDL_PREWARM = int(os.environ.get("YDL_PREWARM", "2"))  # contexts built at startup per profile
+
+# options that may differ between leases of the same context
+LEASE_OPTS = (
+    "outtmpl",
+    "format",
+    "progress_hooks",
+    "postprocessor_hooks",
+    "cookiefile",
+    "download_ranges",
+    "force_keyframes_at_cuts",
+)
+
+
+class YDLContext:
+    """A pooled YoutubeDL plus the hooks of the request currently using it."""
+
+    def __init__(self, opts: dict, cookiejar):
+        self.progress_hooks: list = []
+        self.postprocessor_hooks: list = []
+        self.uses = 0
+        self.cookiejar = cookiejar
+        # YoutubeDL keeps (and mutates) the dict it is given: never share one
+        self.ydl = yt_dlp.YoutubeDL(copy.deepcopy(opts))
+        # set before the first request builds the HTTP handlers around it
+        self.ydl.cookiejar = cookiejar
+        self.ydl.add_progress_hook(self._on_progress)
+        self.ydl.add_postprocessor_hook(self._on_postprocessor)
+        self.base_params = dict(self.ydl.params)
+
+    def _on_progress(self, d: dict) -> None:
+        for hook in self.progress_hooks:
+            hook(d)
+
+    def _on_postprocessor(self, d: dict) -> None:
+        for hook in self.postprocessor_hooks:
+            hook(d)
+
+    def prepare(self, opts: dict) -> None:
+        """Apply the per-request options of a lease."""
+        self.uses += 1
+        self.progress_hooks = list(opts.get("progress_hooks") or [])
+        self.postprocessor_hooks = list(opts.get("postprocessor_hooks") or [])
+        if "outtmpl" in opts:
+            self.ydl.params["outtmpl"] = {**self.base_params["outtmpl"], "default": opts["outtmpl"]}
+        if opts.get("format"):
+            self.ydl.params["format"] = opts["format"]
+            self.ydl.format_selector = self.ydl.build_format_selector(opts["format"])
+        for name in ("download_ranges", "force_keyframes_at_cuts"):
+            if name in opts:
+                self.ydl.params[name] = opts[name]
+
+    def reset(self) -> None:
+        """Drop what a lease changed (hooks, params like fixup) before reuse."""
+        self.progress_hooks = []
+        self.postprocessor_hooks = []
+        self.ydl.params.clear()
+        self.ydl.params.update(self.base_params)
+
+    def close(self) -> None:
+        try:
+            self.ydl.close()
+        except Exception as e:  # noqa: BLE001
+            logger.warning("Closing yt-dlp context failed: %s", e)
+
+
+class YDLPool:
+    """
+    Reusable YoutubeDL contexts keyed by option profile (strategy, metadata
+    or download, kind). A context serves one request at a time; one that
+    raised is closed instead of returned, as is one used max_uses times.
+    cookies.txt is parsed once per process and shared by all contexts.
+    """
+
+    def __init__(self, size: int, max_uses: int):
+        self.size = size
+        self.max_uses = max_uses
+        self._idle: dict[str, list[YDLContext]] = {}
+        self._lock = threading.Lock()
+        self._cookiejar = None
+        self._cookies_mtime: float | None = None
+        self.created = 0
+        self.reused = 0
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def profile(opts: dict) -> str:
+        return json.dumps(
+            {k: v for k, v in opts.items() if k not in LEASE_OPTS}, sort_keys=True, default=str
+        )
+
+    def cookiejar(self):
+        """The shared cookie jar; re-read when cookies.txt changes."""
+        try:
+            mtime = COOKIES_PATH.stat().st_mtime
+        except FileNotFoundError:
+            mtime = None
+        with self._lock:
+            if self._cookiejar is None or mtime != self._cookies_mtime:
+                jar = yt_dlp.cookies.YoutubeDLCookieJar(str(COOKIES_PATH) if mtime else None)
+                if mtime is not None:
+                    jar.load()
+                self._cookiejar, self._cookies_mtime = jar, mtime
+            return self._cookiejar
+
+    def _take(self, key: str, cookiejar) -> YDLContext | None:
+        stale = []
+        ctx = None
+        with self._lock:
+            idle = self._idle.get(key) or []
+            while idle:
+                candidate = idle.pop()
+                if candidate.cookiejar is cookiejar:
+                    ctx = candidate
+                    break
+                stale.append(candidate)
+        for old in stale:
+            old.close()
+        return ctx
+
+    def _give_back(self, key: str, ctx: YDLContext) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(ctx)
+                return
+        ctx.close()
+
+    def prewarm(self, opts: dict, count: int) -> None:
+        """Build up to `count` idle contexts for the profile of `opts`."""
+        key = self.profile(opts)
+        cookiejar = self.cookiejar()
+        base = {k: v for k, v in opts.items() if k not in LEASE_OPTS}
+        with self._lock:
+            missing = min(count, self.size) - len(self._idle.get(key, []))
+        for _ in range(missing):
+            ctx = YDLContext(base, cookiejar)
+            self.created += 1
+            self._give_back(key, ctx)
+
+    @contextmanager
+    def lease(self, opts: dict):
+        """
+        Yield a YoutubeDL configured with `opts`; use instead of
+        `with yt_dlp.YoutubeDL(opts) as ydl`.
+        """
+        started = time.perf_counter()
+        key = self.profile(opts)
+        cookiejar = self.cookiejar()
+        ctx = self._take(key, cookiejar)
+        if ctx is None:
+            base = {k: v for k, v in opts.items() if k not in LEASE_OPTS}
+            ctx = YDLContext(base, cookiejar)
+            self.created += 1
+            source = "new"
+        else:
+            self.reused += 1
+            source = "pool"
+        ctx.prepare(opts)
+        YDL_SETUP_SECONDS.labels(source).observe(time.perf_counter() - started)
+
+        ok = False
+        try:
+            yield ctx.ydl
+            ok = True
+        finally:
+            ctx.reset()
+            if ok and ctx.uses < self.max_uses:
+                self._give_back(key, ctx)
+            else:
+                ctx.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            idle = sum(len(contexts) for contexts in self._idle.values())
+            profiles = len(self._idle)
+        return {"idle": idle, "profiles": profiles, "created": self.created, "reused": self.reused}
+
+
+YDL_POOL = YDLPool(YDL_POOL_SIZE, YDL_MAX_USES)
+STARTUP_TIMINGS: dict = {}
+
+
+def process_uptime() -> float | None:
+    """Seconds since this process started (Linux /proc), None elsewhere."""
+    try:
+        start_ticks = int(Path("/proc/self/stat").read_text().rsplit(")", 1)[1].split()[19])
+        uptime = float(Path("/proc/uptime").read_text().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(uptime - start_ticks / os.sysconf("SC_CLK_TCK"), 3)
+
+
+def record_startup(phase: str, seconds: float | None) -> None:
+    if seconds is None:
+        return
+    STARTUP_TIMINGS[phase] = round(seconds, 3)
+    STARTUP_SECONDS.labels(phase).set(seconds)
+
+
+def warm_up() -> None:
+    """
+    Pay yt-dlp's one-off costs before the first request: import the lazily
+    loaded postprocessors, compile the URL regex of every extractor and
+    pre-build pooled contexts for metadata and mp4 downloads.
+    """
+    record_startup("import", process_uptime())
+
+    started = time.perf_counter()
+    import yt_dlp.postprocessor  # noqa: F401  (the merger imports it lazily)
+
+    for ie in yt_dlp.extractor.gen_extractor_classes():
+        ie.suitable("https://warmup.invalid/")
+    record_startup("warm_extractors", time.perf_counter() - started)
+
+    started = time.perf_counter()
+    try:
+        YDL_POOL.prewarm(final_opts(download=False)[0], YDL_PREWARM)
+        YDL_POOL.prewarm(final_opts(download=True, kind="mp4")[0], YDL_PREWARM)
+    except Exception as e:  # noqa: BLE001
+        logger.warning("yt-dlp context prewarm failed: %s", e)
+    record_startup("warm_pool", time.perf_counter() - started)
+    logger.info("yt-dlp warm-up done: %s", STARTUP_TIMINGS)
+
+
+# ---------------------------------------------------------
+# MP4 PIPELINE
+# ---------------------------------------------------------
+#
+# Video downloads must end up as .mp4. In order of cost:
+#   none      - yt-dlp already merged/downloaded an mp4
+#   remux     - codecs fit in mp4, just copy the streams into a new container
+#   transcode - last resort, re-encode with FFMPEG_THREADS threads
+# remux and transcode run on POSTPROCESS_STAGE.
+
+# ffmpeg can stream-copy these into mp4 (codec family, as in "avc1.640028")
+MP4_VIDEO_CODECS = {"avc1", "avc3", "h264", "hevc", "hvc1", "hev1", "h265", "av01", "av1", "vp09", "vp9"}
+MP4_AUDIO_CODECS = {"mp4a", "aac", "mp3", "ac-3", "ec-3", "opus", "alac"}
+
+
+def codec_family(codec: str | None) -> str | None:
+    if not codec or codec == "none":
+        return None
+    return codec.split(".")[0].lower()
+
+
+def plan_mp4_pipeline(info: dict, file_path: Path) -> str:
+    """Pick the cheapest way to get file_path into mp4: none, remux or transcode."""
+    if file_path.suffix.lower() == ".mp4":
+        return "none"
+
+    formats = info.get("requested_formats") or [info]
+    vcodecs = {codec_family(f.get("vcodec")) for f in formats} - {None}
+    acodecs = {codec_family(f.get("acodec")) for f in formats} - {None}
+
+    if vcodecs <= MP4_VIDEO_CODECS and acodecs <= MP4_AUDIO_CODECS:
+        return "remux"
+    return "transcode"
+
+
+# ---------------------------------------------------------
+# POSTPROCESS STAGE
+# ---------------------------------------------------------
+#
+# Downloads run in two stages. The fetch stage (DOWNLOAD_EXECUTOR threads)
+# only waits on the network: yt-dlp downloads and, for split formats, merges
+# with a stream copy. CPU-bound ffmpeg work - mp3 encoding, remux, transcode -
+# is queued here and runs in worker processes (postprocess.py), at most
+# POSTPROCESS_WORKERS at a time with FFMPEG_THREADS threads each, so a
+# transcode neither holds a download slot nor oversubscribes the cores.
+#
+# The queue is shortest-job-first on an estimate of the ffmpeg cost; waiting
+# lowers a job's cost by POSTPROCESS_AGING seconds per second, so a long
+# transcode still gets its turn while short audio jobs keep arriving.
+
+
+def available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        return os.cpu_count() or 1
+
+
+POSTPROCESS_WORKERS = int(os.environ.get("POSTPROCESS_WORKERS", "0")) or max(
+    1, available_cpus() // FFMPEG_THREADS
+)
+POSTPROCESS_AGING = float(os.environ.get("POSTPROCESS_AGING", "0.5"))
+
+MP3_QUALITY = "192"
+
+
+def estimate_postprocess_seconds(step: str, info: dict, file_path: Path) -> float:
+    """
+    Rough ffmpeg cost of a step, only used to order the postprocess queue:
+    a remux is bound by file size, encoding by duration and frame size.
+    """
+    size = file_path.stat().st_size
+    duration = info.get("duration") or size * 8 / ((info.get("tbr") or 1000) * 1000)
+    if step == "remux":
+        return size / 200e6
+    if step == "audio":
+        return duration / 40
+    pixels = (info.get("width") or 1280) * (info.get("height") or 720)
+    return duration * pixels / (1280 * 720) / 2
+
+
+def plan_postprocess(info: dict, file_path: Path, kind: str) -> tuple | None:
+    """(function, args, estimated seconds) of the ffmpeg step a download needs, or None."""
+    if kind == "mp3":
+        args = (str(file_path), "mp3", MP3_QUALITY, ffmpeg_thread_args())
+        return postprocess.extract_audio, args, estimate_postprocess_seconds("audio", info, file_path)
+    if kind == "mp4":
+        pipeline = plan_mp4_pipeline(info, file_path)
+        if pipeline == "none":
+            return None
+        # a failed remux falls back to a transcode
+        steps = ["remux", "transcode"] if pipeline == "remux" else ["transcode"]
+        args = (str(file_path), steps, ffmpeg_thread_args())
+        return postprocess.to_mp4, args, estimate_postprocess_seconds(pipeline, info, file_path)
+    return None
+
+
+class PostprocessStage:
+    """
+    Shortest-job-first queue in front of a process pool.
+
+    submit() returns at once; one slot thread per pool process picks the
+    cheapest queued task (after aging), runs it in the pool and calls
+    done(result, error, waited) with its outcome. The pool and threads are
+    created on first use in each process, so forked gunicorn workers get
+    their own.
+    """
+
+    def __init__(self, workers: int, aging: float):
+        self.workers = workers
+        self.aging = aging
+        self._cond = threading.Condition()
+        self._queue: list[dict] = []
+        self._pool: ProcessPoolExecutor | None = None
+        self._pid: int | None = None
+        self.running = 0
+        self.completed = 0
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # spawn: forking a threaded server is unsafe, and the workers only need postprocess.py
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _start(self) -> None:
+        # caller holds self._cond
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._queue = []
+        self._pool = self._new_pool()
+        for n in range(self.workers):
+            threading.Thread(target=self._slot, name=f"postprocess-{n}", daemon=True).start()
+
+    def submit(self, job_id: str, fn, args: tuple, cost: float, done) -> None:
+        task = {
+            "job_id": job_id,
+            "fn": fn,
+            "args": args,
+            "cost": cost,
+            "queued_at": time.monotonic(),
+            "done": done,
+        }
+        with self._cond:
+            self._start()
+            self._queue.append(task)
+            QUEUE_DEPTH.labels("postprocess").inc()
+            self._cond.notify()
+
+    def _take(self) -> dict:
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            now = time.monotonic()
+            task = min(self._queue, key=lambda t: t["cost"] - self.aging * (now - t["queued_at"]))
+            self._queue.remove(task)
+            self.running += 1
+            QUEUE_DEPTH.labels("postprocess").dec()
+            return task
+
+    def _run(self, task: dict):
+        pool = self._pool
+        try:
+            return pool.submit(task["fn"], *task["args"]).result()
+        except BrokenProcessPool:
+            # a worker process died (e.g. OOM-killed ffmpeg parent); replace the pool
+            with self._cond:
+                if self._pool is pool:
+                    self._pool = self._new_pool()
+            raise
+
+    def _slot(self) -> None:
+        while True:
+            task = self._take()
+            waited = time.monotonic() - task["queued_at"]
+            QUEUE_WAIT_SECONDS.labels("postprocess").observe(waited)
+            ACTIVE_JOBS.labels("postprocess").inc()
+            result, error = None, None
+            try:
+                result = self._run(task)
+            except Exception as e:  # noqa: BLE001
+                error = e
+            finally:
+                ACTIVE_JOBS.labels("postprocess").dec()
+                with self._cond:
+                    self.running -= 1
+                    self.completed += 1
+            try:
+                task["done"](result, error, waited)
+            except Exception:  # noqa: BLE001
+                logger.exception("Postprocess callback failed for job %s", task["job_id"])
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "queued": len(self._queue),
+                "running": self.running,
+                "completed": self.completed,
+            }
+
+
+POSTPROCESS_STAGE = PostprocessStage(POSTPROCESS_WORKERS, POSTPROCESS_AGING)
+
+
+# ---------------------------------------------------------
+# METADATA + CACHE
+# ---------------------------------------------------------
+#
+# A handful of popular URLs make up most metadata traffic and every
+# extraction takes seconds, so responses are cached per canonical media id
+# (TTL + LRU) and concurrent requests for the same id share one extraction.
+
+METADATA_CACHE_TTL = int(os.environ.get("METADATA_CACHE_TTL", "600"))
+METADATA_CACHE_SIZE = int(os.environ.get("METADATA_CACHE_SIZE", "256"))
+
+# Playlist entries returned per /api/metadata page
+PLAYLIST_PAGE_SIZE = int(os.environ.get("PLAYLIST_PAGE_SIZE", "50"))
+PLAYLIST_PAGE_MAX = 500
+
+# Background extractions: a playlist's first video, the formats phase of
+# phase=basic requests (see TWO-PHASE METADATA)
+METADATA_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("METADATA_BACKGROUND_WORKERS", "4")), thread_name_prefix="metadata"
+)
+
+
+def build_metadata_response(info: dict) -> dict:
+    """Turn a yt-dlp info dict into the /api/metadata JSON payload."""
+    # Playlist (flat listing: entries carry id/title/url, no formats)
+    if info.get("_type") in {"playlist", "multi_video"} or info.get("entries"):
+        videos = []
+        for idx, entry in enumerate(info.get("entries") or [], start=1):
+            if not entry:
+                continue
+            thumbnails = entry.get("thumbnails") or []
+            videos.append(
+                {
+                    "id": entry.get("id"),
+                    "title": entry.get("title"),
+                    "duration": entry.get("duration"),
+                    "thumbnail": thumbnail_url(
+                        entry.get("thumbnail") or (thumbnails[-1].get("url") if thumbnails else None),
+                        320,
+                    ),
+                    "uploader": entry.get("uploader") or entry.get("channel"),
+                    "index": entry.get("playlist_index") or idx,
+                    "url": entry.get("webpage_url")
+                    or entry.get("url")
+                    or f"https://www.youtube.com/watch?v={entry.get('id')}",
+                }
+            )
+
+        return {
+            "success": True,
+            "kind": "playlist",
+            "playlist": {
+                "id": info.get("id"),
+                "title": info.get("title") or "Playlist",
+                "uploader": info.get("uploader") or info.get("channel"),
+                "video_count": len(videos),
+                "videos": videos,
+            },
+            # Resolution dropdown is filled from the first video on demand
+            # (POST /api/metadata with formats_url), see prefetch_playlist_formats.
+            "formats": [],
+            "formats_url": videos[0]["url"] if videos else None,
+        }
+
+    # Single video
+    video_info = {
+        "id": info.get("id"),
+        "title": info.get("title"),
+        "duration": info.get("duration"),
+        "thumbnail": thumbnail_url(info.get("thumbnail"), 640),
+        "uploader": info.get("uploader") or info.get("channel"),
+        "view_count": info.get("view_count"),
+        "like_count": info.get("like_count"),
+        "formats": extract_formats_for_frontend(info.get("formats")),
+    }
+
+    return {"success": True, "kind": "video", "video": video_info}
+
+
+def fetch_metadata(url: str) -> dict:
+    """Run a metadata extraction and build the response payload."""
+
+    def attempt(strategy: str) -> dict:
+        # a slot per attempt: retry backoffs don't count against METADATA_INFLIGHT
+        with METADATA_INFLIGHT.slot():
+            with timed("options"):
+                ydl_opts, _ = final_opts(download=False, strategy=strategy)
+            started = time.perf_counter()
+            with YDL_POOL.lease(ydl_opts) as ydl:
+                note_timing("ydl_setup", time.perf_counter() - started)
+                with timed("extract"):
+                    info = ydl.extract_info(url, download=False)
+        EXTRACT_SECONDS.labels("metadata", strategy).observe(time.perf_counter() - started)
+        if not info:
+            raise RuntimeError("yt-dlp returned no information for this URL")
+        return info
+
+    info, strategy = run_with_strategy(url, attempt, attempts=METADATA_ATTEMPTS)
+    logger.info("Metadata for %s served by %s strategy", url, strategy)
+    return build_metadata_response(info)
+
+
+def paginate_playlist(payload: dict, offset: int, limit: int) -> dict:
+    """Return a copy of a cached playlist payload holding one page of videos."""
+    playlist = payload["playlist"]
+    videos = playlist["videos"]
+    offset = max(0, offset)
+    limit = max(1, min(limit, PLAYLIST_PAGE_MAX))
+    next_offset = offset + limit if offset + limit < len(videos) else None
+
+    page = dict(payload)
+    page["playlist"] = {
+        **playlist,
+        "videos": videos[offset : offset + limit],
+        "offset": offset,
+        "limit": limit,
+        "next_offset": next_offset,
+    }
+    return page
+
+
+def prefetch_playlist_formats(payload: dict) -> None:
+    """Warm the metadata cache for the first playlist video in the background."""
+    url = payload.get("formats_url")
+    if not url:
+        return
+
+    def _warm():
+        try:
+            METADATA_CACHE.get_or_load(canonical_media_key(url), lambda: fetch_metadata(url))
+        except Exception as e:  # noqa: BLE001
+            logger.warning("Playlist format prefetch failed for %s: %s", url, e)
+
+    METADATA_EXECUTOR.submit(_warm)
+
+
+def metadata_page(payload: dict, hit: bool, offset: int, limit: int) -> dict:
+    """Count a metadata lookup and cut the requested page out of a playlist."""
+    CACHE_REQUESTS.labels("metadata", "hit" if hit else "miss").inc()
+    if payload["kind"] != "playlist":
+        return payload
+    if not hit:
+        prefetch_playlist_formats(payload)
+    return paginate_playlist(payload, offset=offset, limit=limit)
+
+
+# full: every format as extracted; compact: formats summarised as a quality ladder
+METADATA_VIEWS = ("full", "compact")
+# Cache-Control max-age of GET /api/metadata responses (browsers and CDNs)
+METADATA_HTTP_MAX_AGE = int(os.environ.get("METADATA_HTTP_MAX_AGE", "300"))
+
+
+def metadata_view_options(data) -> tuple[str, list[str] | None]:
+    """(view, fields) of a metadata request; ValueError if the view is unknown."""
+    view = data.get("view") or "full"
+    if view not in METADATA_VIEWS:
+        raise ValueError(view)
+    fields = data.get("fields") or None
+    if isinstance(fields, str):
+        fields = [name.strip() for name in fields.split(",") if name.strip()]
+    return view, fields
+
+
+def render_metadata(page: dict, view: str, fields: list[str] | None) -> dict:
+    """
+    Shape a metadata page for the client: the compact view replaces a video's
+    formats with quality_ladder(), and fields keeps only the named keys of the
+    video (or of each playlist entry).
+    """
+    if page["kind"] == "video":
+        video = page["video"]
+        if view == "compact":
+            video = {k: v for k, v in video.items() if k != "formats"}
+            video["ladder"] = quality_ladder(page["video"]["formats"], video.get("duration"))
+        if fields:
+            video = {k: v for k, v in video.items() if k in fields}
+        return {**page, "video": video}
+
+    if fields:
+        playlist = page["playlist"]
+        videos = [{k: v for k, v in entry.items() if k in fields} for entry in playlist["videos"]]
+        return {**page, "playlist": {**playlist, "videos": videos}}
+    return page
+
+
+def metadata_json(body: dict) -> bytes:
+    """Serialise a metadata response; the same body always gives the same bytes (and ETag)."""
+    return json.dumps(body, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def content_etag(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+@lru_cache(maxsize=2048)
+def canonical_media_key(url: str) -> str:
+    """
+    Cache key for a URL: "<extractor>:<media id>" when yt-dlp can tell the id
+    from the URL alone (youtu.be/X, watch?v=X&si=... -> Youtube:X), else the URL.
+    """
+    url = url.strip()
+    for ie in yt_dlp.extractor.gen_extractor_classes():
+        if ie.ie_key() == "Generic":
+            break
+        if ie.suitable(url):
+            temp_id = ie.get_temp_id(url)
+            if temp_id:
+                return f"{ie.ie_key()}:{temp_id}"
+            break
+    return f"url:{url}"
+
+
+def site_key(url: str) -> str:
+    """Circuit breaker key: the yt-dlp extractor ("Youtube") or the host name."""
+    key = canonical_media_key(url)
+    if key.startswith("url:"):
+        return urlparse(url.strip()).netloc.lower() or "generic"
+    return key.split(":", 1)[0]
+
+
+class MetadataCache:
+    """
+    Thread-safe TTL + LRU cache with single-flight loading.
+
+    get_or_load(key, loader) returns (value, hit). While one thread runs the
+    loader for a key, other threads asking for the same key wait for its
+    result instead of starting their own extraction. Failures are never cached.
+    """
+
+    def __init__(self, ttl: int, max_entries: int, store: StateStore | None = None):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.store = store
+
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _load_shared(self, key: str) -> tuple[float, dict] | None:
+        """Entry cached by another worker (or before a restart), if still fresh."""
+        if not self.store:
+            return None
+        stored = self.store.get("metadata", key)
+        if stored is None or time.time() - stored["stored_at"] > self.ttl:
+            return None
+        return stored["stored_at"], stored["value"]
+
+    def _save_shared(self, key: str, stored_at: float, value: dict) -> None:
+        if not self.store:
+            return
+        try:
+            self.store.set("metadata", key, {"stored_at": stored_at, "value": value}, ttl=self.ttl)
+        except Exception as e:  # noqa: BLE001
+            logger.warning("Could not share metadata cache entry: %s", e)
+
+    def _store(self, key: str, stored_at: float, value: dict) -> None:
+        # caller holds self._lock
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _fresh(self, key: str) -> dict | None:
+        # caller holds self._lock
+        entry = self._entries.get(key)
+        if entry and time.time() - entry[0] <= self.ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry:
+            del self._entries[key]
+        return None
+
+    def peek(self, key: str) -> dict | None:
+        """Fresh in-memory entry (counted as a hit); never blocks on the shared store."""
+        with self._lock:
+            return self._fresh(key)
+
+    def lookup(self, key: str) -> dict | None:
+        """Fresh entry from memory or the shared store; never loads, not counted."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry[0] <= self.ttl:
+                return entry[1]
+        entry = self._load_shared(key)
+        return entry[1] if entry else None
+
+    def get_or_load(self, key: str, loader) -> tuple[dict, bool]:
+        with self._lock:
+            value = self._fresh(key)
+            if value is not None:
+                return value, True
+
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            entry = self._load_shared(key)
+            hit = entry is not None
+            if hit:
+                stored_at, value = entry
+            else:
+                value = loader()
+                stored_at = time.time()
+                self._save_shared(key, stored_at, value)
+
+            with self._lock:
+                self._store(key, stored_at, value)
+                if hit:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                del self._inflight[key]
+            future.set_result(value)
+            return value, hit
+
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+
+    def prune(self) -> None:
+        """Drop expired entries from memory (the shared store expires its own)."""
+        now = time.time()
+        with self._lock:
+            for key, (stored_at, _) in list(self._entries.items()):
+                if now - stored_at > self.ttl:
+                    del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+METADATA_CACHE = MetadataCache(METADATA_CACHE_TTL, METADATA_CACHE_SIZE, STATE_STORE)
+
+
+# ---------------------------------------------------------
+# BATCH METADATA
+# ---------------------------------------------------------
+#
+# POST /api/metadata/batch resolves many URLs in one request. URLs naming the
+# same media (same canonical_media_key) are extracted once; up to
+# METADATA_BATCH_CONCURRENCY extractions of a batch run at a time on a shared
+# pool, and each result is streamed as an NDJSON line as soon as it is ready,
+# so a batch takes about as long as its slowest item instead of the sum.
+
+METADATA_BATCH_MAX = int(os.environ.get("METADATA_BATCH_MAX", "50"))
+METADATA_BATCH_CONCURRENCY = int(os.environ.get("METADATA_BATCH_CONCURRENCY", "4"))
+# Threads shared by all batches of this worker
+METADATA_BATCH_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("METADATA_BATCH_WORKERS", "8")), thread_name_prefix="metadata-batch"
+)
+
+
+def load_metadata_item(url: str, view: str, fields: list[str] | None) -> dict:
+    """One batch item: the /api/metadata body of url (first page of a playlist)."""
+    payload, hit = METADATA_CACHE.get_or_load(canonical_media_key(url), lambda: fetch_metadata(url))
+    page = metadata_page(payload, hit, 0, PLAYLIST_PAGE_SIZE)
+    return {"cached": hit, **render_metadata(page, view, fields)}
+
+
+def resolve_metadata_batch(
+    urls: list[str], view: str, fields: list[str] | None, concurrency: int = METADATA_BATCH_CONCURRENCY
+):
+    """
+    Yield {"index", "url", ...} for every url in completion order: the metadata
+    body, or "error" / "message" when that item failed. Items with the same
+    media key share one extraction.
+    """
+    groups: OrderedDict[str, list[tuple[int, str]]] = OrderedDict()
+    for index, url in enumerate(urls):
+        groups.setdefault(canonical_media_key(url), []).append((index, url))
+
+    queued = iter(groups.values())
+    running: dict[Future, list[tuple[int, str]]] = {}
+
+    def submit_next() -> None:
+        members = next(queued, None)
+        if members is not None:
+            future = METADATA_BATCH_EXECUTOR.submit(load_metadata_item, members[0][1], view, fields)
+            running[future] = members
+
+    for _ in range(max(1, concurrency)):
+        submit_next()
+    try:
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                members = running.pop(future)
+                submit_next()
+                try:
+                    result = future.result()
+                except Overloaded:
+                    result = {"error": "SERVER_BUSY", "retry_after": SHED_RETRY_AFTER}
+                except Exception as e:  # noqa: BLE001
+                    logger.warning("Batch metadata failed for %s: %s", members[0][1], e)
+                    ERRORS.labels("METADATA_FAILED").inc()
+                    result = {"error": "METADATA_FAILED", "message": str(e)}
+                for index, url in members:
+                    yield {"index": index, "url": url, **result}
+    finally:
+        # the client left: drop extractions that have not started
+        for future in running:
+            future.cancel()
+
+
+# ---------------------------------------------------------
+# TWO-PHASE METADATA
+# ---------------------------------------------------------
+#
+# A full extraction resolves every format (on YouTube: the player JS,
+# signature deciphering, DASH/HLS manifests) and takes seconds. With
+# phase=basic, /api/metadata first runs a light extraction (no player JS, no
+# manifests, no format processing) and answers with id, title, thumbnail,
+# duration and uploader, while the full extraction goes on in the background
+# into METADATA_CACHE. The client then receives the full response as one SSE
+# event from /api/metadata/events/<request id>, or polls
+# /api/metadata/formats/<request id>. Both only read STATE_STORE and the shared
+# cache, so any worker can answer them.
+
+METADATA_PHASES = ("full", "basic")
+# Seconds a formats phase may take before it is started again
+METADATA_FORMATS_TIMEOUT = int(os.environ.get("METADATA_FORMATS_TIMEOUT", "60"))
+# How often a formats event stream checks for the result
+METADATA_FORMATS_POLL_SECONDS = 0.25
+# yt-dlp arguments of the light extraction (others extractors just skip format processing)
+BASIC_EXTRACTOR_ARGS = {"youtube": {"player_skip": ["js", "configs"], "skip": ["dash", "hls", "translated_subs"]}}
+
+
+def fetch_basic_metadata(url: str) -> dict | None:
+    """
+    {"id", "title", "thumbnail", "duration", "uploader"} of a single video from
+    a light extraction, or None when that does not work out (a playlist, an
+    extractor that needs the full run, an error): the caller then falls back
+    to the full extraction, which has its own retries.
+    """
+    strategy = "simple" if STRATEGY_BREAKER.state(site_key(url)) != "closed" else "enhanced"
+    with timed("options"):
+        ydl_opts, _ = final_opts(download=False, strategy=strategy)
+        ydl_opts["extractor_args"] = BASIC_EXTRACTOR_ARGS
+    try:
+        with METADATA_INFLIGHT.slot():
+            started = time.perf_counter()
+            with YDL_POOL.lease(ydl_opts) as ydl:
+                note_timing("ydl_setup", time.perf_counter() - started)
+                with timed("extract_basic"):
+                    info = ydl.extract_info(url, download=False, process=False)
+            EXTRACT_SECONDS.labels("metadata_basic", strategy).observe(time.perf_counter() - started)
+    except Overloaded:
+        raise
+    except Exception as e:  # noqa: BLE001
+        logger.info("Basic metadata unavailable for %s, using a full extraction: %s", url, e)
+        return None
+
+    if not info or info.get("_type", "video") != "video" or not info.get("title"):
+        return None
+    thumbnails = [t for t in info.get("thumbnails") or [] if t.get("url")]
+    thumbnail = info.get("thumbnail") or (
+        max(thumbnails, key=lambda t: (t.get("preference") or 0, t.get("width") or 0))["url"] if thumbnails else None
+    )
+    return {
+        "id": info.get("id"),
+        "title": info.get("title"),
+        "thumbnail": thumbnail_url(thumbnail, 640),
+        "duration": info.get("duration"),
+        "uploader": info.get("uploader") or info.get("channel"),
+    }
+
+
+def load_formats(url: str, key: str) -> None:
+    """Background full extraction of a formats phase; a failure is kept for the client."""
+    try:
+        METADATA_CACHE.get_or_load(key, lambda: fetch_metadata(url))
+        STATE_STORE.delete("formats", key)
+    except Exception as e:  # noqa: BLE001
+        logger.warning("Formats phase failed for %s: %s", url, e)
+        ERRORS.labels("METADATA_FAILED").inc()
+        message = "Server busy" if isinstance(e, Overloaded) else str(e)
+        STATE_STORE.set("formats", key, {"status": "error", "message": message}, ttl=METADATA_FORMATS_TIMEOUT)
+
+
+def start_formats_phase(url: str, key: str) -> None:
+    """Run the full extraction of key in the background, unless some worker already does."""
+    if STATE_STORE.add("formats", key, {"status": "pending"}, ttl=METADATA_FORMATS_TIMEOUT):
+        METADATA_EXECUTOR.submit(load_formats, url, key)
+
+
+def basic_metadata(url: str, view: str, fields: list[str] | None, build_url=url_for) -> dict | None:
+    """
+    First-phase /api/metadata body for url, or None when the full response
+    should be sent right away (already cached, or no light extraction).
+    build_url(endpoint, **values) defaults to Flask's url_for.
+    """
+    key = canonical_media_key(url)
+    if METADATA_CACHE.lookup(key) is not None:
+        return None
+    video = fetch_basic_metadata(url)
+    if video is None:
+        return None
+
+    request_id = REQUEST_ID.get() or uuid.uuid4().hex[:16]
+    state = STATE_STORE.get("formats", key)
+    if state and state["status"] == "error":
+        # a new request tries again
+        STATE_STORE.delete("formats", key)
+    STATE_STORE.set(
+        "formats_requests",
+        request_id,
+        {"url": url, "key": key, "view": view, "fields": fields},
+        ttl=METADATA_CACHE_TTL,
+    )
+    start_formats_phase(url, key)
+    if fields:
+        video = {k: v for k, v in video.items() if k in fields}
+    return {
+        "success": True,
+        "kind": "video",
+        "phase": "basic",
+        "video": video,
+        "formats_pending": True,
+        "request_id": request_id,
+        "formats_url": build_url("metadata_formats", request_id=request_id),
+        "events_url": build_url("metadata_events", request_id=request_id),
+    }
+
+
+def formats_result(request_id: str) -> tuple[str, dict | None]:
+    """
+    State of the formats phase of a basic request: ("ready", full body),
+    ("error", error body), ("pending", None) or ("unknown", None) for an
+    unknown or expired request id.
+    """
+    record = STATE_STORE.get("formats_requests", request_id)
+    if record is None:
+        return "unknown", None
+    # the marker first: a load finishing in between is then found in the cache
+    state = STATE_STORE.get("formats", record["key"])
+    payload = METADATA_CACHE.lookup(record["key"])
+    if payload is not None:
+        page = paginate_playlist(payload, 0, PLAYLIST_PAGE_SIZE) if payload["kind"] == "playlist" else payload
+        return "ready", render_metadata(page, record["view"], record["fields"])
+    if state is None:
+        # the marker expired (or its worker died) before a result: start over
+        start_formats_phase(record["url"], record["key"])
+        return "pending", None
+    if state["status"] == "error":
+        return "error", {"error": "METADATA_FAILED", "message": state["message"]}
+    return "pending", None
+
+
+# ---------------------------------------------------------
+# DOWNLOAD MANIFEST
+# ---------------------------------------------------------
+#
+# SQLite index of finished files in DOWNLOAD_DIR. Lookups by download id or
+# cache key are primary-key / index hits, expiry walks the last_access index
+# and a disk quota evicts least recently used files. Nothing here lists the
+# downloads directory.
+#
+# Files being read by a response (sends, relays, batch ZIPs) are leased in the
+# same database, so every worker on the node sees them; expiry and the quota
+# skip leased files, the entry being added and the files of running jobs.
+# A lease that is never released (killed worker) lapses after
+# FILE_LEASE_SECONDS.
+
+FILE_LEASE_SECONDS = 6 * 3600
+
+
+class QuotaExceeded(Exception):
+    """A finished file is larger than the whole download quota."""
+
+
+class DownloadManifest:
+    """Index of finished downloads: id -> path, size, created and last access."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS downloads (
+            download_id TEXT PRIMARY KEY,
+            path        TEXT NOT NULL,
+            size        INTEGER NOT NULL,
+            created_at  REAL NOT NULL,
+            last_access REAL NOT NULL,
+            cache_key   TEXT,
+            title       TEXT,
+            filename    TEXT
+        );
+        CREATE INDEX IF NOT EXISTS downloads_last_access ON downloads (last_access);
+        CREATE INDEX IF NOT EXISTS downloads_cache_key ON downloads (cache_key);
+        CREATE TABLE IF NOT EXISTS leases (
+            token      TEXT PRIMARY KEY,
+            path       TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS leases_path ON leases (path);
+    """
+
+    def __init__(self, db_path: Path, quota_bytes: int = 0):
+        self.db_path = db_path
+        self.quota_bytes = quota_bytes
+        self._connect()
+        os.register_at_fork(after_in_child=self._connect)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(self.SCHEMA)
+
+    def _connect(self) -> None:
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+
+    def add(
+        self,
+        download_id: str,
+        path: Path,
+        cache_key: str | None = None,
+        title: str | None = None,
+        filename: str | None = None,
+        busy=None,
+    ) -> None:
+        """
+        Add a finished file and make room for it; the new entry itself is
+        never evicted. Raises QuotaExceeded if the file alone is over quota.
+        busy is passed on to enforce_quota.
+        """
+        size = path.stat().st_size
+        if 0 < self.quota_bytes < size:
+            raise QuotaExceeded(f"{size} bytes is more than the {self.quota_bytes} byte download quota")
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (download_id, str(path), size, now, now, cache_key, title, filename),
+            )
+        self.enforce_quota(keep={download_id}, busy=busy)
+
+    def _fetch(self, where: str, value: str, touch: bool) -> dict | None:
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                f"SELECT * FROM downloads WHERE {where} = ? ORDER BY last_access DESC LIMIT 1",
+                (value,),
+            ).fetchone()
+            if row is None:
+                return None
+            if not Path(row["path"]).exists():
+                self._conn.execute("DELETE FROM downloads WHERE download_id = ?", (row["download_id"],))
+                return None
+            if touch:
+                self._conn.execute(
+                    "UPDATE downloads SET last_access = ? WHERE download_id = ?",
+                    (time.time(), row["download_id"]),
+                )
+            return dict(row)
+
+    def get(self, download_id: str, touch: bool = True) -> dict | None:
+        """Entry for a download id (None if unknown or the file is gone)."""
+        return self._fetch("download_id", download_id, touch)
+
+    def find_by_cache_key(self, cache_key: str, touch: bool = True) -> dict | None:
+        """Most recent entry for a download cache key."""
+        return self._fetch("cache_key", cache_key, touch)
+
+    def remove(self, download_id: str) -> None:
+        """Forget an entry (the file is left alone)."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM downloads WHERE download_id = ?", (download_id,))
+
+    def hold(self, path: Path) -> str:
+        """Lease a file while it is read; returns the token for release()."""
+        token = uuid.uuid4().hex
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO leases VALUES (?, ?, ?)", (token, str(path), time.time() + FILE_LEASE_SECONDS)
+            )
+        return token
+
+    def release(self, token: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM leases WHERE token = ?", (token,))
+
+    @contextmanager
+    def held(self, path: Path):
+        token = self.hold(path)
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    def _unleased(self, sql: str, params: tuple = ()) -> list:
+        """
+        Rows of `SELECT download_id, path, size FROM downloads WHERE ...` (sql
+        continues after the WHERE) whose file is not leased. Caller holds self._lock.
+        """
+        now = time.time()
+        self._conn.execute("DELETE FROM leases WHERE expires_at < ?", (now,))
+        return self._conn.execute(
+            "SELECT download_id, path, size FROM downloads"
+            " WHERE path NOT IN (SELECT path FROM leases) AND " + sql,
+            params,
+        ).fetchall()
+
+    def _evict(self, rows) -> int:
+        # caller holds self._lock
+        freed = 0
+        for row in rows:
+            try:
+                Path(row["path"]).unlink(missing_ok=True)
+            except OSError as e:
+                logger.warning("Error removing %s: %s", row["path"], e)
+                continue
+            self._conn.execute("DELETE FROM downloads WHERE download_id = ?", (row["download_id"],))
+            freed += row["size"]
+            logger.info("Cleaning up file: %s", row["path"])
+        return freed
+
+    def expire(self, ttl_seconds: int, busy=None) -> None:
+        """
+        Delete files not accessed within ttl_seconds (uses the last_access index),
+        except leased ones and the download ids returned by busy().
+        """
+        cutoff = time.time() - ttl_seconds
+        with self._lock, self._conn:
+            rows = self._unleased("last_access < ? ORDER BY last_access", (cutoff,))
+        if not rows:
+            return
+        skip = busy() if busy else set()
+        with self._lock, self._conn:
+            self._evict([row for row in rows if row["download_id"] not in skip])
+
+    def enforce_quota(self, keep: set[str] = frozenset(), busy=None) -> None:
+        """
+        Evict least recently used files until the total size fits the quota.
+        Leased files, the download ids in keep and those returned by busy()
+        (only called when something has to go) are left alone.
+        """
+        if self.quota_bytes <= 0:
+            return
+        with self._lock:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM downloads").fetchone()[0]
+        if total <= self.quota_bytes:
+            return
+        skip = set(keep) | (busy() if busy else set())
+        with self._lock, self._conn:
+            excess = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM downloads").fetchone()[0]
+            excess -= self.quota_bytes
+            victims = []
+            for row in self._unleased("1 ORDER BY last_access"):
+                if excess <= 0:
+                    break
+                if row["download_id"] in skip:
+                    continue
+                victims.append(row)
+                excess -= row["size"]
+            self._evict(victims)
+
+    def reconcile(self, directory: Path, ttl_seconds: int, keep: set[str] = frozenset()) -> None:
+        """
+        One-off pass at startup: forget rows whose file is gone and delete
+        stale files the manifest does not know (e.g. left by a crash), except
+        those of the download ids in keep (interrupted jobs to be resumed).
+        """
+        cutoff = time.time() - ttl_seconds
+        with self._lock, self._conn:
+            known = set()
+            for row in self._conn.execute("SELECT download_id, path FROM downloads").fetchall():
+                if Path(row["path"]).exists():
+                    known.add(row["path"])
+                else:
+                    self._conn.execute("DELETE FROM downloads WHERE download_id = ?", (row["download_id"],))
+
+        for p in directory.iterdir():
+            if not p.is_file() or ".sqlite3" in p.name or str(p) in known:
+                continue
+            if p.name.split("_", 1)[0] in keep:
+                continue
+            try:
+                if p.stat().st_mtime < cutoff:
+                    logger.info("Removing untracked file: %s", p)
+                    p.unlink()
+            except OSError as e:
+                logger.warning("Error removing %s: %s", p, e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM downloads"
+            ).fetchone()
+        return {"files": count, "bytes": total, "quota_bytes": self.quota_bytes}
+
+
+DOWNLOAD_MANIFEST = DownloadManifest(DOWNLOAD_DIR / "manifest.sqlite3", DOWNLOAD_DIR_QUOTA_BYTES)
+
+
+def discard_files(paths) -> None:
+    """Delete the files (and .part leftovers) of a failed download."""
+    for path in paths:
+        for candidate in (Path(path), Path(f"{path}.part")):
+            try:
+                candidate.unlink(missing_ok=True)
+            except OSError as e:
+                logger.warning("Error removing %s: %s", candidate, e)
+
+
+# ---------------------------------------------------------
+# CLIPS
+# ---------------------------------------------------------
+#
+# /api/download takes an optional "start" / "end" (seconds or [HH:]MM:SS) or
+# a "chapter" name. They become yt-dlp's download_ranges: ffmpeg seeks into
+# the source and fetches only the fragments (or byte ranges) of the clip, and
+# mp3 conversion / remux afterwards only see the clip. Cuts are a stream copy
+# at the nearest keyframe unless CLIP_PRECISE_CUTS re-encodes the clip. A clip
+# is a download of its own: it has its own cache key.
+
+CLIP_PRECISE_CUTS = os.environ.get("CLIP_PRECISE_CUTS", "0") == "1"
+# Longest chapter name accepted in a clip request
+CLIP_CHAPTER_MAX = 200
+
+
+class ClipUnavailable(yt_dlp.utils.ExtractorError):
+    """The requested clip does not exist in this video (no such chapter, starts after the end)."""
+
+    def __init__(self, msg: str):
+        super().__init__(msg, expected=True)
+
+
+def parse_clip(data: dict) -> dict | None:
+    """
+    {"start", "end"} (seconds, either may be None) or {"chapter"} from a
+    download request, None for the whole media. ValueError when invalid.
+    """
+    chapter = str(data.get("chapter") or "").strip()
+    start, end = data.get("start"), data.get("end")
+    if chapter:
+        if start not in (None, "") or end not in (None, ""):
+            raise ValueError("chapter cannot be combined with start/end")
+        if len(chapter) > CLIP_CHAPTER_MAX:
+            raise ValueError("chapter name too long")
+        return {"chapter": chapter}
+
+    def seconds(value) -> float | None:
+        if value in (None, ""):
+            return None
+        parsed = value if isinstance(value, (int, float)) else yt_dlp.utils.parse_duration(str(value))
+        if parsed is None or not math.isfinite(parsed) or parsed < 0:
+            raise ValueError(f"invalid time: {value!r}")
+        return round(float(parsed), 3)
+
+    start, end = seconds(start), seconds(end)
+    if start is None and end is None:
+        return None
+    if end is not None and end <= (start or 0):
+        raise ValueError("end must be after start")
+    return {"start": start or 0.0, "end": end}
+
+
+def clip_spec(clip: dict) -> str:
+    """Canonical text of a clip, part of its download cache key."""
+    if "chapter" in clip:
+        return f"chapter:{clip['chapter'].casefold()}"
+    end = "" if clip["end"] is None else f"{clip['end']:g}"
+    return f"{clip['start']:g}-{end}"
+
+
+def clip_label(clip: dict) -> str:
+    """Human-readable clip, appended to the title of the downloaded file."""
+    if "chapter" in clip:
+        return clip["chapter"]
+
+    def hms(value: float) -> str:
+        minutes, secs = divmod(int(value), 60)
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours}h{minutes:02d}m{secs:02d}s" if hours else f"{minutes}m{secs:02d}s"
+
+    return f"{hms(clip['start'])}-{'end' if clip['end'] is None else hms(clip['end'])}"
+
+
+def clip_ydl_opts(clip: dict) -> dict:
+    """yt-dlp options that restrict a download to the clip (lease options, see YDLContext.prepare)."""
+    if "chapter" in clip:
+        ranges = yt_dlp.utils.download_range_func([re.compile(re.escape(clip["chapter"]), re.IGNORECASE)], [])
+    else:
+        ranges = yt_dlp.utils.download_range_func([], [(clip["start"], clip["end"] or math.inf)])
+    return {"download_ranges": ranges, "force_keyframes_at_cuts": CLIP_PRECISE_CUTS}
+
+
+def check_clip(ydl: yt_dlp.YoutubeDL, info: dict, clip: dict) -> None:
+    """Raise ClipUnavailable before downloading anything if the clip is not in the video."""
+    if info.get("_type", "video") != "video":
+        raise ClipUnavailable("Clips can only be cut from a single video")
+    if "chapter" in clip:
+        if not any(True for _ in ydl.params["download_ranges"](info, ydl)):
+            raise ClipUnavailable(f"No chapter matching {clip['chapter']!r}")
+    elif info.get("duration") and clip["start"] >= info["duration"]:
+        raise ClipUnavailable(f"The video is only {info['duration']:g} seconds long")
+
+
+# ---------------------------------------------------------
+# DOWNLOAD JOBS
+# ---------------------------------------------------------
+#
+# /api/download only enqueues a job and returns its id. The actual yt-dlp
+# work runs on a bounded thread pool so long videos never block a request
+# worker. Progress is published through /api/status/<job_id> (polling) and
+# /api/progress/<job_id> (Server-Sent Events).
+
+JOB_FINAL_STATES = {"completed", "error"}
+
+# mp4 = video, mp3 = converted audio, m4a = original audio stream (no ffmpeg)
+DOWNLOAD_KINDS = {"mp4", "mp3", "m4a"}
+
+STREAM_CHUNK_SIZE = 256 * 1024
+# How often a relay of a still-growing file checks for new bytes
+STREAM_POLL_SECONDS = 0.2
+
+# Jobs run by this worker. Every job is also mirrored to STATE_STORE, so
+# status, progress and file requests can be answered by any worker.
+JOBS: dict[str, dict] = {}
+# Condition doubles as the JOBS lock and as a wake-up for SSE streams
+JOBS_CONDITION = threading.Condition()
+# Called with the job id after every update_job (under JOBS_CONDITION, so
+# they must not block); the ASGI mode wakes its SSE streams this way.
+JOB_LISTENERS: list = []
+
+DOWNLOAD_EXECUTOR = FairScheduler(MAX_CONCURRENT_DOWNLOADS, "download", nice=DOWNLOAD_THREAD_NICE)
+
+# Finished files are found in DOWNLOAD_MANIFEST by their cache key
+# (media id, format selector, kind), see download_cache_key. Identical requests
+# that arrive while the first one is still running join it instead.
+# cache key -> [leader job id, follower job ids...]
+DOWNLOAD_INFLIGHT: dict[str, list[str]] = {}
+DOWNLOAD_CACHE_LOCK = threading.Lock()
+
+
+def create_job(
+    url: str,
+    kind: str,
+    format_id: str,
+    client: str = "anonymous",
+    clip: dict | None = None,
+    traffic_class: str = "interactive",
+) -> dict:
+    """Register a new queued job and return a copy of it."""
+    job_id = uuid.uuid4().hex
+    job = {
+        "job_id": job_id,
+        "client": client,
+        "url": url,
+        "kind": kind,
+        "format_id": format_id,
+        "clip": clip,
+        "traffic_class": traffic_class,
+        "status": "queued",
+        "progress": 0.0,
+        "downloaded_bytes": 0,
+        "total_bytes": None,
+        "speed": None,
+        "eta": None,
+        "title": None,
+        "filename": None,
+        "file_path": None,
+        "download_id": None,
+        "cache_key": None,
+        "cached": False,
+        "pipeline": None,
+        "strategy": None,
+        "timings": {},
+        "streamable": False,
+        "stream_path": None,
+        "error": None,
+        "message": None,
+        "resumes": 0,
+        "created_at": time.time(),
+        "updated_at": time.time(),
+        "version": 0,
+    }
+    with JOBS_CONDITION:
+        JOBS[job_id] = job
+        snapshot = shared_snapshot(job)
+    share_job(snapshot)
+    return dict(job)
+
+
+def shared_snapshot(job: dict) -> dict:
+    """Copy of a job for STATE_STORE; the caller holds JOBS_CONDITION."""
+    job["_shared_at"] = job["updated_at"]
+    return {k: v for k, v in job.items() if not k.startswith("_")}
+
+
+def share_job(snapshot: dict) -> None:
+    """
+    Mirror a job snapshot to STATE_STORE. Called without JOBS_CONDITION, so
+    writes of one job can race: a snapshot older than the stored version is
+    dropped.
+    """
+
+    def newer(stored):
+        if stored and stored.get("version", -1) > snapshot["version"]:
+            return stored
+        return snapshot
+
+    STATE_STORE.update("jobs", snapshot["job_id"], newer, ttl=DOWNLOAD_TTL_SECONDS)
+
+
+def update_job(job_id: str, **fields) -> None:
+    """Apply fields to a job and wake up anyone streaming its progress."""
+    snapshot = None
+    with JOBS_CONDITION:
+        job = JOBS.get(job_id)
+        if job is None:
+            return
+        status_changed = fields.get("status", job["status"]) != job["status"]
+        job.update(fields)
+        job["updated_at"] = time.time()
+        job["version"] += 1
+        JOBS_CONDITION.notify_all()
+        for listener in JOB_LISTENERS:
+            listener(job_id)
+
+        # progress ticks are throttled, status changes are shared right away
+        if status_changed or job["updated_at"] - job["_shared_at"] >= STATE_SYNC_INTERVAL:
+            snapshot = shared_snapshot(job)
+    if snapshot:
+        share_job(snapshot)
+
+
+def job_group(job_id: str) -> list[str]:
+    """A leader job plus every job coalesced onto its download."""
+    job = get_job(job_id)
+    key = job.get("cache_key") if job else None
+    with DOWNLOAD_CACHE_LOCK:
+        group = DOWNLOAD_INFLIGHT.get(key) if key else None
+        return list(group) if group and group[0] == job_id else [job_id]
+
+
+def update_job_group(job_id: str, **fields) -> None:
+    for member in job_group(job_id):
+        update_job(member, **fields)
+
+
+def get_local_job(job_id: str) -> dict | None:
+    """Snapshot of a job run by this worker (no state store I/O)."""
+    with JOBS_CONDITION:
+        job = JOBS.get(job_id)
+        return dict(job) if job else None
+
+
+def get_job(job_id: str) -> dict | None:
+    """Return a snapshot of a job (or None if unknown / expired)."""
+    job = get_local_job(job_id)
+    if job:
+        return job
+    # started by another worker
+    return STATE_STORE.get("jobs", job_id)
+
+
+def active_download_ids() -> set[str]:
+    """Download ids of jobs (of any worker) that are not finished yet."""
+    with JOBS_CONDITION:
+        active = {
+            job["download_id"]
+            for job in JOBS.values()
+            if job.get("download_id") and job["status"] not in JOB_FINAL_STATES
+        }
+    for _, job in STATE_STORE.items("jobs"):
+        if job.get("download_id") and job.get("status") not in JOB_FINAL_STATES:
+            active.add(job["download_id"])
+    return active
+
+
+def is_known_download(download_id: str) -> bool:
+    """True if download_id is in DOWNLOAD_MANIFEST or belongs to a job of this worker."""
+    if DOWNLOAD_MANIFEST.get(download_id, touch=False) is not None:
+        return True
+    with JOBS_CONDITION:
+        return any(job.get("download_id") == download_id for job in JOBS.values())
+
+
+def forget_job(job_id: str) -> None:
+    with JOBS_CONDITION:
+        JOBS.pop(job_id, None)
+    STATE_STORE.delete("jobs", job_id)
+
+
+def wait_for_job_update(job_id: str, last_version: int, timeout: float = 15) -> dict | None:
+    """
+    Block until a job's version differs from last_version (or timeout) and
+    return it. Local jobs wake us through JOBS_CONDITION, jobs of other
+    workers are polled from STATE_STORE (outside the condition).
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        job = get_local_job(job_id)
+        local = job is not None
+        if not local:
+            job = STATE_STORE.get("jobs", job_id)
+        remaining = deadline - time.monotonic()
+        if job is None or job["version"] != last_version or remaining <= 0:
+            return job
+        if not local:
+            time.sleep(min(STATE_SYNC_INTERVAL, remaining))
+            continue
+        with JOBS_CONDITION:
+            current = JOBS.get(job_id)
+            if current is not None and current["version"] == last_version:
+                JOBS_CONDITION.wait(min(STATE_SYNC_INTERVAL, remaining))
+
+
+def public_job(job: dict, build_url=url_for) -> dict:
+    """
+    Strip internal fields (paths, source url) before sending a job to clients.
+    build_url(endpoint, **values) defaults to Flask's url_for.
+    """
+    data = {
+        k: job.get(k)
+        for k in (
+            "job_id",
+            "status",
+            "progress",
+            "downloaded_bytes",
+            "total_bytes",
+            "speed",
+            "eta",
+            "title",
+            "filename",
+            "download_id",
+            "clip",
+            "traffic_class",
+            "cached",
+            "streamable",
+            "pipeline",
+            "strategy",
+            "timings",
+            "error",
+            "message",
+            "resumes",
+        )
+    }
+    ready = job.get("status") == "completed" or (
+        job.get("streamable") and job.get("status") != "error"
+    )
+    if ready and job.get("filename"):
+        data["download_url"] = build_url(
+            "download_job_file", job_id=job["job_id"], filename=job["filename"]
+        )
+    return data
+
+
+def progress_hook(job_id: str, d: dict) -> None:
+    """yt-dlp progress hook; bound to a job with functools.partial."""
+    status = d.get("status")
+
+    if status == "downloading":
+        downloaded = d.get("downloaded_bytes") or 0
+        total = d.get("total_bytes") or d.get("total_bytes_estimate")
+        progress = round(downloaded * 100 / total, 1) if total else None
+        fields = {
+            "status": "downloading",
+            "downloaded_bytes": downloaded,
+            "total_bytes": total,
+            "speed": d.get("speed"),
+            "eta": d.get("eta"),
+        }
+        if progress is not None:
+            fields["progress"] = min(progress, 99.0)
+        update_job_group(job_id, **fields)
+
+    elif status == "finished":
+        update_job_group(job_id, status="processing", progress=99.0, eta=0)
+
+
+def record_written_file(job_id: str, written: set, d: dict) -> None:
+    """
+    Progress hook remembering which files a download wrote, for cleanup on
+    failure; new ones are added to the job's partial file index as well.
+    """
+    new = [d[key] for key in ("tmpfilename", "filename") if d.get(key) and d[key] not in written]
+    if new:
+        written.update(new)
+        track_partial_files(job_id, paths=new)
+
+
+def postprocessor_hook(job_id: str, d: dict, timings: dict | None = None) -> None:
+    """Mark the job as processing while ffmpeg postprocessors run (and time them)."""
+    name = d.get("postprocessor") or "postprocess"
+    if name == "MoveFiles":
+        return
+    if d.get("status") == "started":
+        if timings is not None:
+            timings[f"_{name}"] = time.perf_counter()
+        update_job_group(job_id, status="processing")
+    elif d.get("status") == "finished" and timings is not None:
+        started = timings.pop(f"_{name}", None)
+        if started is not None:
+            timings[name] = round(time.perf_counter() - started, 3)
+            POSTPROCESS_SECONDS.labels(name).observe(timings[name])
+
+
+def finish_job_group(job_id: str, **fields) -> bool:
+    """
+    Publish the final state of a download to its leader job and all followers.
+
+    Successful results are added to DOWNLOAD_MANIFEST under the job's cache key;
+    a file too large for the download quota is deleted and the job fails
+    instead. Returns whether the job group completed.
+    """
+    job = get_job(job_id) or {}
+    key = job.get("cache_key")
+    members = [job_id]
+
+    if fields.get("status") == "completed" and job.get("download_id"):
+        served_key = key
+        if key and fields.get("strategy") == "simple":
+            # a simple fallback must not be served to later enhanced requests
+            selector = get_format_selector(job["kind"], job["format_id"], simple=True)
+            served_key = download_cache_key(job["url"], job["kind"], selector, job.get("clip"))
+        try:
+            DOWNLOAD_MANIFEST.add(
+                job["download_id"],
+                Path(fields["file_path"]),
+                cache_key=served_key,
+                title=fields["title"],
+                filename=fields["filename"],
+                busy=active_download_ids,
+            )
+        except QuotaExceeded as e:
+            logger.error("Job %s produced a file over the download quota: %s", job_id, e)
+            discard_files([fields["file_path"]])
+            ERRORS.labels("FILE_TOO_LARGE").inc()
+            fields = {"status": "error", "error": "FILE_TOO_LARGE", "message": str(e)}
+
+    with DOWNLOAD_CACHE_LOCK:
+        if key and DOWNLOAD_INFLIGHT.get(key, [None])[0] == job_id:
+            members = DOWNLOAD_INFLIGHT.pop(key)
+            STATE_STORE.delete("inflight", key)
+
+    for member in members:
+        update_job(member, **fields)
+    drop_resume_record(job_id)
+    STATE_STORE.delete("partials", job_id)  # finished or discarded, nothing left to collect
+    return fields["status"] == "completed"
+
+
+def is_streamable(info: dict, kind: str) -> bool:
+    """
+    True when the selected format lands on disk exactly as the client gets it:
+    one progressive stream, no merge, no ffmpeg (mp4 with audio+video, or m4a
+    passthrough). Such downloads can be relayed while they are still running.
+    """
+    if info.get("_type", "video") != "video" or info.get("requested_formats"):
+        return False
+    if kind == "m4a":
+        return True
+    if kind == "mp4":
+        return (
+            info.get("ext") == "mp4"
+            and info.get("vcodec") != "none"
+            and info.get("acodec") != "none"
+        )
+    return False
+
+
+def complete_download(
+    job_id: str, title: str, file_path: Path, pipeline: str, strategy: str, timings: dict, started: float
+) -> None:
+    """Publish a finished download (file in its final format) to the job group."""
+    timings["total"] = round(time.perf_counter() - started, 3)
+    ext = file_path.suffix.lstrip(".").lower() or "mp4"
+
+    completed = finish_job_group(
+        job_id,
+        status="completed",
+        progress=100.0,
+        eta=0,
+        title=title,
+        filename=safe_download_name(title, ext),
+        file_path=str(file_path),
+        pipeline=pipeline,
+        strategy=strategy,
+        message=None,
+        timings={k: v for k, v in timings.items() if not k.startswith("_")},
+    )
+    if not completed:
+        return
+    logger.info(
+        "Job %s finished via %s strategy, %s pipeline %s: %s",
+        job_id, strategy, pipeline, timings, file_path,
+        extra={
+            "fields": {
+                "job_id": job_id,
+                "strategy": strategy,
+                "pipeline": pipeline,
+                "timings": {k: v for k, v in timings.items() if not k.startswith("_")},
+            }
+        },
+    )
+
+
+def finish_postprocess(
+    job_id: str,
+    title: str,
+    source: Path,
+    strategy: str,
+    timings: dict,
+    started: float,
+    result: dict | None,
+    error: Exception | None,
+    waited: float,
+) -> None:
+    """POSTPROCESS_STAGE callback: complete the job or fail it."""
+    timings["postprocess_wait"] = round(waited, 3)
+    if error is not None:
+        logger.error("POSTPROCESS ERROR (job %s): %s", job_id, error)
+        discard_files([source])
+        ERRORS.labels("POSTPROCESS_FAILED").inc()
+        finish_job_group(job_id, status="error", error="POSTPROCESS_FAILED", message=str(error))
+        return
+
+    for step, seconds in result["timings"].items():
+        POSTPROCESS_SECONDS.labels(step).observe(seconds)
+    timings.update(result["timings"])
+    complete_download(job_id, title, Path(result["path"]), result["pipeline"], strategy, timings, started)
+
+
+def download_worker(
+    job_id: str, url: str, format_id: str, kind: str, resume_id: str | None = None
+) -> None:
+    """
+    Fetch stage of a job (executes on DOWNLOAD_EXECUTOR). ffmpeg conversions
+    are handed to POSTPROCESS_STAGE, which frees this download slot right away.
+
+    resume_id is the download_id of an interrupted run of this job: the first
+    attempt reuses its file names, so yt-dlp continues the partial files.
+    When the job has a clip (see parse_clip) only that part of the media is fetched.
+    """
+
+    QUEUE_DEPTH.labels("fetch").dec()
+    ACTIVE_JOBS.labels("fetch").inc()
+    queued = get_local_job(job_id)
+    if queued:
+        QUEUE_WAIT_SECONDS.labels("fetch").observe(max(0.0, time.time() - queued["created_at"]))
+    clip = (queued or {}).get("clip")
+    traffic_class = (queued or {}).get("traffic_class") or "interactive"
+    update_job_group(job_id, status="starting")
+    written: set[str] = set()
+    started = time.perf_counter()
+
+    def attempt(strategy: str):
+        nonlocal resume_id
+        attempt_started = time.perf_counter()
+        timings: dict = {}
+        ydl_opts, download_id = final_opts(
+            download=True, format_id=format_id, kind=kind, strategy=strategy, download_id=resume_id
+        )
+        if clip:
+            ydl_opts.update(clip_ydl_opts(clip))
+        timings["options"] = round(time.perf_counter() - attempt_started, 3)
+        resume_id = None  # retries start over, before_retry discarded the files
+        save_resume_record(job_id, download_id=download_id)
+        track_partial_files(job_id, download_id)
+        ydl_opts["progress_hooks"] = [
+            partial(progress_hook, job_id),
+            partial(record_written_file, job_id, written),
+        ]
+        if INGRESS.enabled:
+            ydl_opts["progress_hooks"].append(partial(ingress_hook, job_id, {}))
+        ydl_opts["postprocessor_hooks"] = [partial(postprocessor_hook, job_id, timings=timings)]
+        update_job_group(job_id, download_id=download_id, strategy=strategy)
+
+        with YDL_POOL.lease(ydl_opts) as ydl:
+            timings["setup"] = round(time.perf_counter() - attempt_started - timings["options"], 3)
+            # extract + select formats first, so we know whether the result
+            # can be streamed to the client before any byte is downloaded
+            info = ydl.extract_info(url, download=False)
+            timings["extract"] = round(
+                time.perf_counter() - attempt_started - timings["options"] - timings["setup"], 3
+            )
+            EXTRACT_SECONDS.labels("download", strategy).observe(timings["extract"])
+
+            if not info:
+                raise RuntimeError("yt-dlp returned no information for this URL")
+            if clip:
+                check_clip(ydl, info, clip)
+
+            # clips are written by ffmpeg under a temporary name, so they can't be relayed
+            if not clip and is_streamable(info, kind):
+                # what is on disk must be what was streamed, so no container fixups
+                ydl.params["fixup"] = "never"
+                title = info.get("title") or "video"
+                update_job_group(
+                    job_id,
+                    streamable=True,
+                    stream_path=ydl.prepare_filename(info),
+                    title=title,
+                    filename=safe_download_name(title, info.get("ext")),
+                )
+
+            info = ydl.process_ie_result(info, download=True)
+            timings["fetch"] = round(
+                time.perf_counter() - attempt_started - timings["options"] - timings["setup"] - timings["extract"],
+                3,
+            )
+
+            file_path = locate_downloaded_file(info)
+            if not file_path:
+                raise FileNotFoundError(f"Downloaded file not found for url={url}")
+            size = file_path.stat().st_size
+            DOWNLOAD_BYTES.inc(size)
+            if timings["fetch"] > 0:
+                DOWNLOAD_BYTES_PER_SECOND.observe(size / timings["fetch"])
+
+        return info, file_path, timings
+
+    def before_retry(strategy: str, error: Exception) -> None:
+        discard_files(written | set(partial_files(job_id)))
+        written.clear()
+        # a new attempt writes a new file; in-progress streams of the old one abort
+        update_job_group(
+            job_id,
+            status="starting",
+            progress=0.0,
+            downloaded_bytes=0,
+            streamable=False,
+            stream_path=None,
+            message=f"Retrying with {strategy} strategy: {error}",
+        )
+
+    try:
+        with INGRESS.stream(traffic_class, job_id):
+            (info, file_path, timings), strategy = run_with_strategy(
+                url, attempt, before_retry=before_retry
+            )
+        title = info.get("title") or "video"
+        if clip:
+            title = f"{title} ({clip_label(clip)})"
+            # the postprocess estimate should see the clip's duration
+            section = (info.get("requested_downloads") or [{}])[0]
+            info = {**info, "duration": section.get("duration") or info.get("duration")}
+
+        task = plan_postprocess(info, file_path, kind)
+        if task is None:
+            pipeline = "audio" if kind != "mp4" else "none"
+            complete_download(job_id, title, file_path, pipeline, strategy, timings, started)
+        else:
+            fn, args, cost = task
+            update_job_group(job_id, status="processing", progress=99.0, eta=0)
+            POSTPROCESS_STAGE.submit(
+                job_id,
+                fn,
+                args,
+                cost,
+                partial(finish_postprocess, job_id, title, file_path, strategy, timings, started),
+            )
+
+    except Exception as e:  # noqa: BLE001
+        logger.error("DOWNLOAD ERROR (job %s): %s", job_id, e)
+        discard_files(written | set(partial_files(job_id)))
+        if isinstance(e, ClipUnavailable):
+            error = "CLIP_UNAVAILABLE"
+        elif isinstance(e, FileNotFoundError):
+            error = "FILE_NOT_FOUND"
+        else:
+            error = "DOWNLOAD_FAILED"
+        ERRORS.labels(error).inc()
+        finish_job_group(job_id, status="error", error=error, message=str(e))
+
+    finally:
+        ACTIVE_JOBS.labels("fetch").dec()
+
+
+def download_cache_key(url: str, kind: str, selector: str, clip: dict | None = None) -> str:
+    """Content address of a download: media id + format selector + kind (+ clip)."""
+    raw = f"{canonical_media_key(url)}|{selector}|{kind}"
+    if clip:
+        raw += f"|{clip_spec(clip)}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def lookup_cached_download(key: str) -> dict | None:
+    """
+    Return a cached download if its file still exists.
+
+    A hit counts as an access, so popular results live for another TTL period.
+    """
+    entry = DOWNLOAD_MANIFEST.find_by_cache_key(key)
+    if entry is None:
+        return None
+    return {
+        "download_id": entry["download_id"],
+        "file_path": entry["path"],
+        "title": entry["title"],
+        "filename": entry["filename"],
+    }
+
+
+def claim_download(key: str, job_id: str) -> dict | None:
+    """
+    Register job_id as the job downloading `key` for all workers.
+
+    Returns None once claimed, or the job of another worker that is already
+    running this download.
+    """
+    while True:
+        if STATE_STORE.add("inflight", key, job_id, ttl=DOWNLOAD_TTL_SECONDS):
+            return None
+        owner = STATE_STORE.get("inflight", key)
+        job = get_job(owner) if owner else None
+        if job and job["status"] not in JOB_FINAL_STATES:
+            return job
+
+        # claim left behind by a worker that died mid-download: take it over
+        # only if nobody else has replaced it since we read it
+        def take_over(current):
+            return job_id if current == owner else current
+
+        if STATE_STORE.update("inflight", key, take_over, ttl=DOWNLOAD_TTL_SECONDS) == job_id:
+            return None
+        # another job took it over (or it was released): look again
+
+
+def enqueue_download(
+    url: str,
+    kind: str,
+    format_id: str,
+    client: str = "anonymous",
+    profile: bool = False,
+    clip: dict | None = None,
+    traffic_class: str = "interactive",
+) -> dict:
+    """
+    Create a job for a download request.
+
+    Cache hits complete immediately, requests matching a running download
+    follow that download (or get its job, if another worker runs it),
+    everything else is queued on DOWNLOAD_EXECUTOR under the client's name.
+    With profile, the job's fetch stage runs under cProfile (see save_profile);
+    clip (see parse_clip) downloads only part of the media; traffic_class
+    ("interactive" or "bulk") sets the job's INGRESS / EGRESS weight.
+    """
+    kind = kind if kind in DOWNLOAD_KINDS else "mp4"
+    simple = STRATEGY_BREAKER.state(site_key(url)) != "closed"
+    selector = get_format_selector(kind, format_id, simple=simple)
+    key = download_cache_key(url, kind, selector, clip)
+
+    job = create_job(url, kind, format_id, client, clip, traffic_class)
+    job_id = job["job_id"]
+
+    cached = lookup_cached_download(key)
+    CACHE_REQUESTS.labels("download", "hit" if cached else "miss").inc()
+    if cached:
+        logger.info("Download cache hit for %s (job %s)", url, job_id)
+        update_job(
+            job_id,
+            status="completed",
+            progress=100.0,
+            eta=0,
+            cached=True,
+            title=cached["title"],
+            filename=cached["filename"],
+            file_path=cached["file_path"],
+            download_id=cached["download_id"],
+        )
+        return get_job(job_id)
+
+    with DOWNLOAD_CACHE_LOCK:
+        group = DOWNLOAD_INFLIGHT.get(key)
+        running_elsewhere = None
+        if group:
+            group.append(job_id)
+            leader_id = group[0]
+        else:
+            leader_id = None
+            running_elsewhere = claim_download(key, job_id)
+            if running_elsewhere is None:
+                DOWNLOAD_INFLIGHT[key] = [job_id]
+        update_job(job_id, cache_key=key)
+
+    if running_elsewhere:
+        # another worker is fetching this file; hand out its job instead
+        logger.info("Download for %s already running as job %s", url, running_elsewhere["job_id"])
+        forget_job(job_id)
+        return running_elsewhere
+
+    if leader_id:
+        logger.info("Job %s joins running download %s", job_id, leader_id)
+        save_resume_record(leader_id, follower=job_id)
+        leader = get_job(leader_id) or {}
+        if traffic_class == "interactive" and leader.get("traffic_class") == "bulk":
+            # someone is waiting for this one now
+            update_job(leader_id, traffic_class="interactive")
+            INGRESS.promote(leader_id)
+        update_job(
+            job_id,
+            **{
+                k: leader.get(k)
+                for k in ("status", "progress", "downloaded_bytes", "total_bytes", "download_id")
+            },
+        )
+    else:
+        save_resume_record(job_id)
+        QUEUE_DEPTH.labels("fetch").inc()
+        worker = profiled(download_worker, f"job {job_id}") if profile else download_worker
+        DOWNLOAD_EXECUTOR.submit(client, worker, job_id, url, format_id, kind)
+
+    return get_job(job_id)
+
+
+def expire_jobs(now: float) -> None:
+    """Forget finished jobs older than the file TTL (STATE_STORE expires its copies)."""
+    with JOBS_CONDITION:
+        for job_id, job in list(JOBS.items()):
+            if job["status"] in JOB_FINAL_STATES and now - job["updated_at"] > DOWNLOAD_TTL_SECONDS:
+                del JOBS[job_id]
+
+
+# ---------------------------------------------------------
+# RESUMABLE JOBS
+# ---------------------------------------------------------
+#
+# A worker killed mid-download (gunicorn timeout, deploy, container restart)
+# used to strand its jobs and their .part files. Now every unfinished job has
+# a resume record in STATE_STORE ("resume": download id + coalesced followers)
+# and a lease ("leases") that its worker renews every JOB_LEASE_SECONDS / 3.
+# Every worker periodically looks for records whose lease has expired, claims
+# them and runs the job again under the same job id and download id: yt-dlp
+# (continuedl) continues the partial files and clients following the job id
+# (/api/status, /api/progress) see it carry on. The files a download writes
+# are indexed per job ("partials") as yt-dlp creates them; the index entries
+# of jobs that ended without cleaning up (worker killed, job given up) are
+# garbage-collected, so the download directory itself is never scanned.
+
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "20"))
+# a job that keeps taking its worker down is failed after this many resumes
+JOB_MAX_RESUMES = int(os.environ.get("JOB_MAX_RESUMES", "3"))
+# partial files of a job touched more recently than this are never collected
+PARTIAL_GRACE_SECONDS = 120
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def save_resume_record(job_id: str, download_id: str | None = None, follower: str | None = None) -> None:
+    """Create or update a job's resume record and take its lease."""
+    record = STATE_STORE.get("resume", job_id) or {"download_id": None, "followers": []}
+    if download_id:
+        record["download_id"] = download_id
+    if follower:
+        record["followers"].append(follower)
+    STATE_STORE.set("resume", job_id, record)
+    STATE_STORE.set("leases", job_id, WORKER_ID, ttl=JOB_LEASE_SECONDS)
+
+
+def drop_resume_record(job_id: str) -> None:
+    STATE_STORE.delete("resume", job_id)
+    STATE_STORE.delete("leases", job_id)
+
+
+def track_partial_files(job_id: str, download_id: str | None = None, paths=()) -> None:
+    """
+    Add paths to the job's partial file index; a new download_id (a retry)
+    starts a new entry, the files of the previous attempt were discarded.
+    """
+
+    def add(entry):
+        if entry is None or (download_id and entry["download_id"] != download_id):
+            entry = {"download_id": download_id, "paths": []}
+        entry["paths"] = sorted(set(entry["paths"]).union(paths))
+        entry["updated_at"] = time.time()
+        return entry
+
+    STATE_STORE.update("partials", job_id, add)
+
+
+def partial_files(job_id: str) -> list[str]:
+    return (STATE_STORE.get("partials", job_id) or {}).get("paths", [])
+
+
+def renew_leases() -> None:
+    """Keep the leases of this worker's unfinished jobs alive."""
+    with JOBS_CONDITION:
+        running = [job_id for job_id, job in JOBS.items() if job["status"] not in JOB_FINAL_STATES]
+    for job_id in running:
+        STATE_STORE.set("leases", job_id, WORKER_ID, ttl=JOB_LEASE_SECONDS)
+
+
+def resumable_download_ids() -> set[str]:
+    """download ids whose files belong to an unfinished job."""
+    return {record["download_id"] for _, record in STATE_STORE.items("resume") if record.get("download_id")}
+
+
+def resume_job(job: dict, record: dict) -> None:
+    """Adopt an interrupted job (and its followers) and queue it on this worker."""
+    job_id = job["job_id"]
+    resumes = job.get("resumes", 0) + 1
+    members = [job_id] + [f for f in record.get("followers", []) if f != job_id]
+
+    stored = {member: job if member == job_id else STATE_STORE.get("jobs", member) for member in members}
+    with JOBS_CONDITION:
+        for member, state in stored.items():
+            if state and state["status"] not in JOB_FINAL_STATES:
+                JOBS[member] = {**state, "_shared_at": 0.0}
+
+    if resumes > JOB_MAX_RESUMES:
+        logger.error("Job %s interrupted %d times, giving up", job_id, resumes - 1)
+        ERRORS.labels("INTERRUPTED").inc()
+        for member in members:
+            update_job(member, status="error", error="INTERRUPTED", message="The download was interrupted too often")
+        drop_resume_record(job_id)
+        return
+
+    key = job.get("cache_key")
+    if key:
+        with DOWNLOAD_CACHE_LOCK:
+            DOWNLOAD_INFLIGHT[key] = [m for m in members if m in JOBS]
+        STATE_STORE.set("inflight", key, job_id, ttl=DOWNLOAD_TTL_SECONDS)
+
+    logger.info("Resuming job %s (download %s, resume %d)", job_id, record.get("download_id"), resumes)
+    JOBS_RESUMED.inc()
+    update_job_group(
+        job_id,
+        status="queued",
+        resumes=resumes,
+        streamable=False,
+        stream_path=None,
+        message="Resuming interrupted download",
+    )
+    QUEUE_DEPTH.labels("fetch").inc()
+    DOWNLOAD_EXECUTOR.submit(
+        job.get("client", "anonymous"),
+        download_worker,
+        job_id,
+        job["url"],
+        job["format_id"],
+        job["kind"],
+        record.get("download_id"),
+    )
+
+
+def recover_jobs() -> int:
+    """Resume jobs whose worker stopped renewing their lease; returns how many."""
+    resumed = 0
+    for job_id, record in STATE_STORE.items("resume"):
+        if STATE_STORE.get("leases", job_id) is not None:
+            continue  # its worker is alive
+        local = get_local_job(job_id)
+        if local and local["status"] not in JOB_FINAL_STATES:
+            continue  # ours; renew_leases was late
+        job = STATE_STORE.get("jobs", job_id)
+        if not job or job["status"] in JOB_FINAL_STATES:
+            drop_resume_record(job_id)
+            continue
+        # only one worker may adopt it
+        if not STATE_STORE.add("leases", job_id, WORKER_ID, ttl=JOB_LEASE_SECONDS):
+            continue
+        resume_job(job, record)
+        resumed += 1
+    return resumed
+
+
+def collect_partial_files(now: float | None = None) -> int:
+    """
+    Delete the indexed files (partials, unmerged formats) of jobs that ended
+    and have no resume record; returns how many files were removed.
+    """
+    now = time.time() if now is None else now
+    resumable = {job_id for job_id, _ in STATE_STORE.items("resume")}
+    removed = 0
+    for job_id, entry in STATE_STORE.items("partials"):
+        if job_id in resumable or now - entry.get("updated_at", 0) < PARTIAL_GRACE_SECONDS:
+            continue
+        done = DOWNLOAD_MANIFEST.get(entry["download_id"], touch=False) if entry.get("download_id") else None
+        for path in entry.get("paths", []):
+            if done and Path(path) == Path(done["path"]):
+                continue  # it finished after all
+            for candidate in (Path(path), Path(f"{path}.part")):
+                try:
+                    if candidate.is_file():
+                        logger.info("Removing orphaned partial download: %s", candidate)
+                        candidate.unlink()
+                        removed += 1
+                except OSError as e:
+                    logger.warning("Error removing %s: %s", candidate, e)
+        STATE_STORE.delete("partials", job_id)
+    return removed
+
+
+def job_lease_worker() -> None:
+    while True:
+        try:
+            renew_leases()
+            recover_jobs()
+        except Exception as e:  # noqa: BLE001
+            logger.error("Job lease worker error: %s", e)
+        time.sleep(JOB_LEASE_SECONDS / 3)
+
+
+def growing_file_chunks(job_id: str, path: Path):
+    """
+    Yield the bytes of a file that yt-dlp is still writing; b"" means nothing
+    new yet, ask again after STREAM_POLL_SECONDS. Never sleeps itself, so the
+    WSGI relay (stream_growing_file) and the asyncio one can both drive it.
+
+    Reads `<path>.part` (or `path` once renamed; the open handle survives the
+    rename) and keeps following it until the job completes. Raising aborts the
+    HTTP response, so a failed or retried download is never delivered as a
+    short or mixed file.
+    """
+    download_id = (get_job(job_id) or {}).get("download_id")
+    part = Path(f"{path}.part")
+    fh = None
+    while fh is None:
+        for candidate in (part, path):
+            try:
+                fh = open(candidate, "rb")
+                break
+            except FileNotFoundError:
+                continue
+        if fh is None:
+            job = get_job(job_id)
+            if job is None or job["status"] == "error":
+                return
+            if job["status"] == "completed":
+                path, download_id = Path(job["file_path"]), job.get("download_id")
+                continue
+            yield b""
+
+    sent = 0
+    with fh, DOWNLOAD_MANIFEST.held(path):
+        while True:
+            chunk = fh.read(STREAM_CHUNK_SIZE)
+            if chunk:
+                sent += len(chunk)
+                yield chunk
+                continue
+
+            job = get_job(job_id)
+            if job is None or job["status"] == "error":
+                raise RuntimeError(f"download for job {job_id} failed while streaming")
+            if job.get("download_id") != download_id or os.fstat(fh.fileno()).st_size < sent:
+                raise RuntimeError(f"download for job {job_id} restarted while streaming")
+            if job["status"] == "completed":
+                # drain whatever was written between the last read and completion
+                while chunk := fh.read(STREAM_CHUNK_SIZE):
+                    yield chunk
+                return
+            yield b""
+
+
+def stream_growing_file(job_id: str, path: Path):
+    """Blocking relay of growing_file_chunks for WSGI responses."""
+    for chunk in growing_file_chunks(job_id, path):
+        if chunk:
+            yield chunk
+        else:
+            time.sleep(STREAM_POLL_SECONDS)
+
+
+# ---------------------------------------------------------
+# PLAYLIST ZIP BATCHES
+# ---------------------------------------------------------
+#
+# POST /api/playlist/download registers the selected entries as a batch;
+# GET /download/batch/<id>.zip downloads them in parallel (through the normal
+# job queue, so the download cache applies) and streams a stored ZIP whose
+# members are written in the order the downloads finish. Batches live in
+# STATE_STORE, so the ZIP can be requested from any worker, but only once.
+# Entries are only queued while the client is under CLIENT_QUEUE_LIMIT (and
+# the server under DOWNLOAD_QUEUE_LIMIT); the rest wait their turn. A ZIP
+# stream keeps its request thread until the last entry, so at most
+# BATCH_ZIP_LIMIT run per worker; more get 503 and can retry later.
+
+
+BATCH_QUEUE_POLL_SECONDS = 1
+BATCH_ZIP_INFLIGHT = InflightLimit(BATCH_ZIP_LIMIT)
+
+
+class _ZipChunks:
+    """Write-only file object collecting ZipFile output until it is yielded."""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def create_batch(
+    entries: list[dict], kind: str, format_id: str, concurrency: int, client: str = "anonymous"
+) -> dict:
+    batch_id = uuid.uuid4().hex
+    batch = {
+        "batch_id": batch_id,
+        "client": client,
+        "entries": entries,
+        "kind": kind,
+        "format_id": format_id,
+        "concurrency": concurrency,
+        "created_at": time.time(),
+    }
+    STATE_STORE.set("batches", batch_id, batch, ttl=DOWNLOAD_TTL_SECONDS)
+    return batch
+
+
+def wait_for_any_job(job_ids, timeout: float = 15) -> list[str]:
+    """Block until at least one of job_ids is finished; return the finished ones."""
+
+    def local_status(j):
+        # caller holds JOBS_CONDITION
+        job = JOBS.get(j)
+        return job["status"] if job else None
+
+    deadline = time.monotonic() + timeout
+    while True:
+        with JOBS_CONDITION:
+            statuses = {j: local_status(j) for j in job_ids}
+        # other workers' jobs are read from STATE_STORE, outside the condition
+        for j, status in statuses.items():
+            if status is None:
+                statuses[j] = (STATE_STORE.get("jobs", j) or {}).get("status", "error")
+        done = [j for j in job_ids if statuses[j] in JOB_FINAL_STATES]
+        remaining = deadline - time.monotonic()
+        if done or remaining <= 0:
+            return done
+        with JOBS_CONDITION:
+            # local jobs notify the condition; wait unless one finished meanwhile
+            if not any(local_status(j) in JOB_FINAL_STATES for j in job_ids):
+                JOBS_CONDITION.wait(min(STATE_SYNC_INTERVAL, remaining))
+
+
+def unique_zip_name(name: str, used: set[str]) -> str:
+    stem, dot, ext = name.rpartition(".")
+    candidate, n = name, 1
+    while candidate in used:
+        n += 1
+        candidate = f"{stem} ({n}){dot}{ext}" if dot else f"{name} ({n})"
+    used.add(candidate)
+    return candidate
+
+
+def stream_batch_zip(batch: dict):
+    """
+    Yield a ZIP (stored, no compression) of a batch as its downloads finish.
+
+    At most batch["concurrency"] entries are in flight; failed entries are
+    listed in manifest.json at the end of the archive.
+    """
+    out = _ZipChunks()
+    pending = deque(enumerate(batch["entries"], start=1))
+    running: dict[str, tuple[int, dict]] = {}
+    manifest: list[dict] = []
+    used_names: set[str] = set()
+
+    client = batch.get("client", "anonymous")
+
+    def queue_full() -> bool:
+        return (
+            DOWNLOAD_EXECUTOR.pending(client) >= CLIENT_QUEUE_LIMIT
+            or DOWNLOAD_EXECUTOR.pending() >= DOWNLOAD_QUEUE_LIMIT
+        )
+
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        while pending or running:
+            while pending and len(running) < batch["concurrency"] and not queue_full():
+                index, entry = pending.popleft()
+                job = enqueue_download(
+                    entry["url"],
+                    batch["kind"],
+                    batch["format_id"],
+                    client,
+                    traffic_class="bulk",
+                )
+                running[job["job_id"]] = (index, entry)
+            if not running:
+                time.sleep(BATCH_QUEUE_POLL_SECONDS)  # the client's queue is full
+                continue
+
+            for job_id in wait_for_any_job(list(running)):
+                index, entry = running.pop(job_id)
+                job = get_job(job_id) or {"status": "error", "error": "JOB_NOT_FOUND"}
+                record = {"index": index, "url": entry["url"], "title": entry.get("title")}
+
+                file_path = Path(job["file_path"]) if job.get("file_path") else None
+                if job["status"] != "completed" or not file_path or not file_path.exists():
+                    record.update(
+                        status="error",
+                        error=job.get("error") or "FILE_NOT_FOUND",
+                        message=job.get("message"),
+                    )
+                    manifest.append(record)
+                    continue
+
+                name = unique_zip_name(f"{index:03d} - {job['filename']}", used_names)
+                zinfo = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+                zinfo.compress_type = zipfile.ZIP_STORED
+                with DOWNLOAD_MANIFEST.held(file_path), open(file_path, "rb") as src, \
+                        zf.open(zinfo, "w", force_zip64=True) as dest:
+                    while chunk := src.read(STREAM_CHUNK_SIZE):
+                        dest.write(chunk)
+                        yield out.drain()
+
+                record.update(status="completed", file=name, size=file_path.stat().st_size)
+                manifest.append(record)
+                yield out.drain()
+
+        manifest.sort(key=lambda r: r["index"])
+        zf.writestr(
+            "manifest.json",
+            json.dumps(
+                {
+                    "batch_id": batch["batch_id"],
+                    "completed": sum(1 for r in manifest if r["status"] == "completed"),
+                    "failed": sum(1 for r in manifest if r["status"] == "error"),
+                    "entries": manifest,
+                },
+                indent=2,
+            ),
+        )
+
+    yield out.drain()
+
+
+# ---------------------------------------------------------
+# FILE DELIVERY
+# ---------------------------------------------------------
+#
+# How finished files reach the client (FILE_DELIVERY):
+#   sendfile          - the app sends them through wsgi.file_wrapper; gunicorn
+#                       turns that into sendfile(2), ranges included
+#   x-accel-redirect  - nginx sends them: the app only answers with headers and
+#                       an X-Accel-Redirect to the internal X_ACCEL_LOCATION
+#   x-sendfile        - same for Apache mod_xsendfile / lighttpd (absolute path)
+# With the proxy modes a slow client never holds a gunicorn thread; ranges and
+# conditional requests are then answered by the proxy. With an EGRESS limit
+# the app paces what it sends itself (no sendfile then); nginx is told the
+# rate with X-Accel-Limit-Rate, X-Sendfile has no way to pass one on.
+
+FILE_DELIVERY = os.environ.get("FILE_DELIVERY", "sendfile").lower()
+FILE_DELIVERY_MODES = ("sendfile", "x-accel-redirect", "x-sendfile")
+if FILE_DELIVERY not in FILE_DELIVERY_MODES:
+    raise RuntimeError(f"FILE_DELIVERY must be one of {', '.join(FILE_DELIVERY_MODES)}")
+X_ACCEL_LOCATION = "/" + os.environ.get("X_ACCEL_LOCATION", "/internal-downloads/").strip("/") + "/"
+
+MAX_RANGES = 16  # more ranges than this are answered with the whole file
+SEND_CHUNK_SIZE = 256 * 1024
+
+
+def file_etag(file_path: Path, stat: os.stat_result) -> str:
+    """Same ETag as werkzeug's send_file, so clients' cached validators stay valid."""
+    check = zlib.adler32(str(file_path).encode("utf-8")) & 0xFFFFFFFF
+    return f"{stat.st_mtime}-{stat.st_size}-{check}"
+
+
+RANGE_SPEC_RE = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+
+def requested_ranges(
+    header: str, if_range, size: int, etag: str, last_modified: datetime
+) -> list[tuple[int, int]] | None:
+    """
+    Byte ranges [(start, end_exclusive)] asked for by a Range header (with its
+    parsed If-Range), merged and sorted. None means "send the whole file"
+    (no/invalid Range header, If-Range mismatch, too many ranges); [] means
+    nothing is satisfiable (416).
+
+    Parsed here because werkzeug's parser rejects overlapping or unordered
+    ranges, which RFC 7233 allows.
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs:
+        return None
+
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and if_range.date != last_modified:
+        return None
+
+    specs = specs.split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        match = RANGE_SPEC_RE.match(spec)
+        if not match or match.groups() == ("", ""):
+            return None
+        first, last = match.groups()
+        if not first:  # suffix range: the last N bytes
+            start, stop = max(0, size - int(last)), size
         else:
-            # best 1080p or lower
-            opts["format"] = "bestvideo*+bestaudio/best"
+            start = int(first)
+            stop = size if not last else min(int(last) + 1, size)
+            if last and int(last) < start:
+                return None
+        if start < stop:
+            ranges.append((start, stop))
 
-        opts["postprocessors"] = [
-            {
-                "key": "FFmpegVideoConvertor",
-                "preferedformat": "mp4",
-            }
-        ]
+    merged: list[tuple[int, int]] = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged
 
-    logger.info("Using ENHANCED yt-dlp options")
-    return opts, download_id
 
+class SentFile(io.FileIO):
+    """File handed to wsgi.file_wrapper; runs on_close callbacks once the server closes it."""
 
-def get_ydl_opts_simple(
-    download: bool = False, format_id: str | None = None, is_audio: bool = False
-) -> tuple[dict, str | None]:
+    def __init__(self, path: Path):
+        super().__init__(path, "rb")
+        self.on_close: list = []
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        super().close()
+        for fn in self.on_close:
+            fn()
+
+
+def close_with_body(resp: Response) -> Response:
     """
-    Very simple fallback options if enhanced mode fails for some user.
+    Run resp's call_on_close callbacks (send timing, request log) when the server
+    closes the body: direct_passthrough bodies are handed over as they are, so
+    the server never calls resp.close() itself.
     """
-    opts = base_ydl_opts()
-    opts["http_headers"]["User-Agent"] = (
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-        "AppleWebKit/537.36 (KHTML, like Gecko) "
-        "Chrome/120.0 Safari/537.36"
-    )
-
-    if not download:
-        opts.update(
-            {
-                "skip_download": True,
-                "simulate": True,
-                "forcejson": True,
-                "extract_flat": False,
-                "quiet": False,
-                "no_warnings": False,
-                "listformats": True,
-                "outtmpl": str(DOWNLOAD_DIR / "%(id)s.%(ext)s"),
-            }
-        )
-        return opts, None
+    closed = False
 
-    download_id = uuid.uuid4().hex
-    outtmpl = str(DOWNLOAD_DIR / f"{download_id}_%(title).100s.%(ext)s")
-    opts["outtmpl"] = outtmpl
+    def close():
+        nonlocal closed
+        if not closed:
+            closed = True
+            resp.close()
 
-    if is_audio:
-        opts["format"] = "bestaudio/best"
-        opts["postprocessors"] = [
-            {
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "mp3",
-                "preferredquality": "192",
-            }
-        ]
+    body = resp.response
+    if isinstance(getattr(body, "filelike", None), SentFile):
+        body.filelike.on_close.append(close)  # keeps the file wrapper, so sendfile still applies
     else:
-        if format_id and format_id != "best":
-            opts["format"] = format_id
-        else:
-            opts["format"] = "best[height<=1080]/best"
+        resp.response = ClosingIterator(body, close)
+    return resp
 
-        opts["postprocessors"] = [
-            {
-                "key": "FFmpegVideoConvertor",
-                "preferedformat": "mp4",
-            }
-        ]
 
-    logger.info("Using SIMPLE yt-dlp options")
-    return opts, download_id
+def file_body(file_path: Path, start: int, length: int):
+    """
+    WSGI body for `length` bytes of a file from `start`. gunicorn sends a
+    wsgi.file_wrapper with sendfile(2) from the current offset, bounded by
+    Content-Length; other servers get a plain generator for partial reads.
+    Paced (EGRESS) responses always get the generator.
+    """
+    if request.method == "HEAD":
+        return []
+    wrapper = request.environ.get("wsgi.file_wrapper")
+    whole = start == 0 and length == file_path.stat().st_size
+    if wrapper and not EGRESS.enabled and (UNDER_GUNICORN or whole):
+        f = SentFile(file_path)
+        f.on_close.append(partial(DOWNLOAD_MANIFEST.release, DOWNLOAD_MANIFEST.hold(file_path)))
+        f.seek(start)
+        return wrapper(f, SEND_CHUNK_SIZE)
+    return file_chunks(file_path, start, length)
 
 
-def final_opts(
-    download: bool = False, format_id: str | None = None, is_audio: bool = False
-) -> tuple[dict, str | None]:
+def file_chunks(file_path: Path, start: int, length: int):
+    """Yield `length` bytes of a file from `start` in SEND_CHUNK_SIZE pieces."""
+    with DOWNLOAD_MANIFEST.held(file_path), open(file_path, "rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(SEND_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def multipart_body(file_path: Path, ranges: list, size: int, mimetype: str, boundary: str):
+    """multipart/byteranges body; returns (iterable, content length)."""
+    heads = [
+        (
+            f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+            f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n"
+        ).encode("ascii")
+        for start, stop in ranges
+    ]
+    tail = f"--{boundary}--\r\n".encode("ascii")
+    length = sum(len(h) + (stop - start) + 2 for h, (start, stop) in zip(heads, ranges)) + len(tail)
+
+    def generate():
+        with open(file_path, "rb") as f:
+            for head, (start, stop) in zip(heads, ranges):
+                yield head
+                f.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    chunk = f.read(min(SEND_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+                yield b"\r\n"
+        yield tail
+
+    return generate(), length
+
+
+def ranged_body(file_path: Path, ranges, size: int, mimetype: str, read) -> tuple[int, dict, object]:
     """
-    Decide which options to use (enhanced or simple) depending on global flag.
+    Status, headers and body answering the outcome of requested_ranges;
+    read(start, length) builds the body for one byte range.
     """
-    global USE_SIMPLE_VERSION
-    if USE_SIMPLE_VERSION:
-        return get_ydl_opts_simple(download=download, format_id=format_id, is_audio=is_audio)
-    return get_ydl_opts_enhanced(download=download, format_id=format_id, is_audio=is_audio)
+    if ranges is None:
+        return 200, {"Content-Length": str(size)}, read(0, size)
+    if not ranges:
+        return 416, {"Content-Range": f"bytes */{size}", "Content-Length": "0"}, []
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        headers = {"Content-Range": f"bytes {start}-{stop - 1}/{size}", "Content-Length": str(stop - start)}
+        return 206, headers, read(start, stop - start)
+    boundary = uuid.uuid4().hex
+    body, length = multipart_body(file_path, ranges, size, mimetype, boundary)
+    headers = {"Content-Type": f"multipart/byteranges; boundary={boundary}", "Content-Length": str(length)}
+    return 206, headers, body
 
 
-def extract_formats_for_frontend(formats: list[dict]) -> list[dict]:
+def proxy_delivery_headers(file_path: Path) -> dict | None:
+    """Header handing the file to the fronting proxy, or None for FILE_DELIVERY=sendfile."""
+    if FILE_DELIVERY == "x-accel-redirect":
+        relative = file_path.resolve().relative_to(DOWNLOAD_DIR.resolve()).as_posix()
+        headers = {"X-Accel-Redirect": X_ACCEL_LOCATION + quote(relative)}
+        if EGRESS.enabled:
+            headers["X-Accel-Limit-Rate"] = str(int(EGRESS.allocation_hint("interactive")))
+        return headers
+    if FILE_DELIVERY == "x-sendfile":
+        return {"X-Sendfile": str(file_path.resolve())}
+    return None
+
+
+def is_not_modified(if_none_match, if_modified_since: datetime | None, etag: str, last_modified: datetime) -> bool:
+    """Conditional GET check (If-None-Match wins over If-Modified-Since)."""
+    if if_none_match:
+        return if_none_match.contains(etag)
+    return if_modified_since is not None and if_modified_since >= last_modified
+
+
+def send_download(file_path: Path, download_name: str, mimetype: str) -> Response:
     """
-    Convert yt-dlp 'formats' list to a trimmed version for the resolution dropdown.
+    Send a finished file as an attachment with the configured FILE_DELIVERY.
+
+    Headers match send_file(as_attachment=True, conditional=True): ETag,
+    Last-Modified, Cache-Control: no-cache, Accept-Ranges. Single ranges get a
+    206 (sendfile under gunicorn), several a multipart/byteranges 206,
+    unsatisfiable ones a 416.
     """
-    cleaned: list[dict] = []
-    seen_ids: set[str] = set()
+    proxy_headers = proxy_delivery_headers(file_path)
+    if proxy_headers:
+        # the proxy reads the file itself and handles Range / If-* headers
+        resp = Response(mimetype=mimetype, headers=proxy_headers)
+        resp.headers.set("Content-Disposition", "attachment", **attachment_headers(download_name))
+        return resp
 
-    for f in formats or []:
-        fmt_id = str(f.get("format_id") or f.get("id") or "")
-        if not fmt_id or fmt_id in seen_ids:
-            continue
+    stat = file_path.stat()
+    size = stat.st_size
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+    etag = file_etag(file_path, stat)
 
-        # skip weird text formats like "mhtml"
-        if f.get("ext") == "mhtml":
-            continue
+    resp = Response(mimetype=mimetype, direct_passthrough=True)
+    resp.headers.set("Content-Disposition", "attachment", **attachment_headers(download_name))
+    resp.last_modified = stat.st_mtime
+    resp.cache_control.no_cache = True
+    resp.set_etag(etag)
+    resp.accept_ranges = "bytes"
 
-        item = {
-            "format_id": fmt_id,
-            "ext": f.get("ext"),
-            "height": f.get("height"),
-            "width": f.get("width"),
-            "fps": f.get("fps"),
-            "tbr": f.get("tbr"),
-            "vcodec": f.get("vcodec"),
-            "acodec": f.get("acodec"),
-            "resolution": f.get("resolution"),
-            "quality": f.get("quality"),
-        }
-        cleaned.append(item)
-        seen_ids.add(fmt_id)
+    if is_not_modified(request.if_none_match, request.if_modified_since, etag, last_modified):
+        resp.status_code = 304
+        return resp
 
-    return cleaned
+    ranges = requested_ranges(request.headers.get("Range", ""), request.if_range, size, etag, last_modified)
+    resp.status_code, headers, resp.response = ranged_body(
+        file_path, ranges, size, mimetype, partial(file_body, file_path)
+    )
+    resp.response = throttled(resp.response, EGRESS, "interactive")
+    resp.headers.update(headers)
+    return close_with_body(resp)
 
 
 # ---------------------------------------------------------
@@ -277,29 +4771,169 @@ def cleanup_downloads_worker():
     while True:
         try:
             now = time.time()
-            for path in DOWNLOAD_DIR.iterdir():
-                try:
-                    if not path.is_file():
-                        continue
-                    age = now - path.stat().st_mtime
-                    if age > DOWNLOAD_TTL_SECONDS:
-                        logger.info("Cleaning up old file: %s", path)
-                        path.unlink(missing_ok=True)
-                except Exception as e:  # noqa: BLE001
-                    logger.warning("Error cleaning file %s: %s", path, e)
+            DOWNLOAD_MANIFEST.expire(DOWNLOAD_TTL_SECONDS, busy=active_download_ids)
+            DOWNLOAD_MANIFEST.enforce_quota(busy=active_download_ids)
+            expire_jobs(now)
+            collect_partial_files()
+            METADATA_CACHE.prune()
+            STATE_STORE.purge_expired()
         except Exception as e:  # noqa: BLE001
             logger.error("Cleanup worker error: %s", e)
 
         time.sleep(600)  # every 10 minutes
 
 
-threading.Thread(target=cleanup_downloads_worker, daemon=True).start()
+# ---------------------------------------------------------
+# RESPONSE COMPRESSION
+# ---------------------------------------------------------
+#
+# JSON and HTML responses are compressed when the client accepts it: brotli
+# when the optional 'brotli' package is installed, else gzip. Both are
+# deterministic (gzip without a timestamp), so a strong ETag stays valid.
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "512"))
+COMPRESS_MIMETYPES = {
+    "application/json",
+    "text/html",
+    "text/plain",
+    "text/css",
+    "text/javascript",
+    "application/javascript",
+    "image/svg+xml",
+}
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # brotli's default (11) costs ~50x the CPU for a few % smaller JSON
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    """Preferred content coding the client accepts: "br", "gzip" or None."""
+    accepted = parse_accept_header(accept_encoding)
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted[encoding] > 0:
+            return encoding
+    return None
+
+
+def compress_body(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def encoded_etag(etag: str, encoding: str | None) -> str:
+    return f"{etag}-{encoding}" if encoding else etag
+
+
+# ---------------------------------------------------------
+# STARTUP
+# ---------------------------------------------------------
+#
+# Import-time work (reconcile, warm_up) runs once per import: in the gunicorn
+# master with --preload, so forked workers inherit it. Threads do not survive
+# a fork, so start_worker() runs per process: from gunicorn's post_fork hook,
+# or right here when not under gunicorn.
+
+UNDER_GUNICORN = "gunicorn" in os.environ.get("SERVER_SOFTWARE", "")
+_WORKER_PID: int | None = None
+_WORKER_LOCK = threading.Lock()
+
+
+def start_worker() -> None:
+    """Start this process's background threads (idempotent per process)."""
+    global _WORKER_PID
+    if _WORKER_PID == os.getpid():
+        return
+    with _WORKER_LOCK:
+        if _WORKER_PID == os.getpid():
+            return
+        _WORKER_PID = os.getpid()
+        threading.Thread(target=cleanup_downloads_worker, daemon=True).start()
+        threading.Thread(target=job_lease_worker, daemon=True).start()
+        record_startup("worker_ready", process_uptime())
+
+
+# postprocess workers are spawned; with `python app.py` each one re-imports
+# this file as __mp_main__ and must not repeat any of this
+if __name__ != "__mp_main__":
+    DOWNLOAD_MANIFEST.reconcile(DOWNLOAD_DIR, DOWNLOAD_TTL_SECONDS, keep=resumable_download_ids())
+    warm_up()
+    if not UNDER_GUNICORN:
+        start_worker()
 
 # ---------------------------------------------------------
 # ROUTES
 # ---------------------------------------------------------
 
 
+@app.before_request
+def ensure_worker_started():
+    # fallback for gunicorn configs without the post_fork hook
+    start_worker()
+
+
+@app.before_request
+def start_request_timing():
+    g.request_timing = RequestTiming(request.headers.get("X-Request-ID"))
+    g.profiler = None
+    if should_profile(request.headers.get("X-Profile"), request.headers.get("X-Admin-Token")):
+        g.profiler = start_profiler()
+
+
+# registered before compress_response, so it runs after it (and times compression)
+@app.after_request
+def finish_request_timing(resp: Response) -> Response:
+    timing = g.get("request_timing")
+    if timing is None:
+        return resp
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        resp.headers["X-Profile"] = save_profile(profiler, f"{request.method} {request.path}")
+    resp.headers.update(timing.headers())
+    method, path, status, sent_at = request.method, request.path, resp.status_code, time.perf_counter()
+    resp.call_on_close(lambda: timing.log(method, path, status, sent_at))
+    return resp
+
+
+@app.after_request
+def compress_response(resp: Response) -> Response:
+    """
+    Answer conditional GETs of responses that carry an ETag with 304, and
+    gzip / brotli-encode text responses the client accepts.
+    """
+    encoding = None
+    compressible = (
+        resp.mimetype in COMPRESS_MIMETYPES
+        and not resp.direct_passthrough
+        and not resp.is_streamed
+        and "Content-Encoding" not in resp.headers
+    )
+    if compressible:
+        resp.vary.add("Accept-Encoding")
+        if resp.status_code == 200 and (resp.content_length or 0) >= COMPRESS_MIN_BYTES:
+            encoding = negotiate_encoding(request.headers.get("Accept-Encoding", ""))
+
+    etag, weak = resp.get_etag()
+    if etag and encoding and not weak:
+        # a strong ETag names exact bytes, so each encoding gets its own
+        resp.set_etag(encoded_etag(etag, encoding))
+    if etag and request.method in ("GET", "HEAD"):
+        resp.make_conditional(request)
+
+    if encoding and resp.status_code == 200:
+        with timed("compress"):
+            resp.set_data(compress_body(resp.get_data(), encoding))
+        resp.headers["Content-Encoding"] = encoding
+    return resp
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -312,180 +4946,429 @@ def about():
     )
 
 
-@app.route("/api/health")
-def health():
+def health_payload() -> dict:
     try:
-        downloads_count = len([p for p in DOWNLOAD_DIR.iterdir() if p.is_file()])
+        manifest_stats = DOWNLOAD_MANIFEST.stats()
     except Exception:
-        downloads_count = 0
-    return jsonify(
-        {
-            "status": "ok",
-            "cookies_exists": COOKIES_PATH.exists(),
-            "downloads": downloads_count,
-        }
-    )
+        manifest_stats = {"files": 0, "bytes": 0}
+    return {
+        "status": "ok",
+        "cookies_exists": COOKIES_PATH.exists(),
+        "downloads": manifest_stats["files"],
+        "downloads_bytes": manifest_stats["bytes"],
+        "metadata_cache": METADATA_CACHE.stats(),
+        "strategies": STRATEGY_BREAKER.snapshot(),
+        "ydl_pool": YDL_POOL.stats(),
+        "postprocess": POSTPROCESS_STAGE.stats(),
+        "images": IMAGE_CACHE.stats(),
+        "fetch": DOWNLOAD_EXECUTOR.stats(),
+        "metadata_inflight": METADATA_INFLIGHT.current,
+        "bandwidth": {"ingress": INGRESS.stats(), "egress": EGRESS.stats()},
+        "startup": STARTUP_TIMINGS,
+    }
 
 
-@app.route("/api/metadata", methods=["POST"])
+@app.route("/api/health")
+def health():
+    return jsonify(health_payload())
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus metrics (summed over all gunicorn workers)."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+@app.route("/api/metadata", methods=["GET", "POST"])
 def metadata():
-    """Return video or playlist metadata."""
-    global USE_SIMPLE_VERSION
+    """
+    Return video or playlist metadata (served from METADATA_CACHE when possible).
+
+    GET takes the same parameters as the POST body in the query string and is
+    cacheable: a strong ETag over the body, conditional requests and a public
+    Cache-Control, so browsers and CDNs can keep it. With phase=basic, a video
+    that is not cached yet is answered from a light extraction first (see
+    TWO-PHASE METADATA); that response has "formats_pending" and is not cached.
+    """
 
     try:
-        data = request.get_json(force=True) or {}
-        url = data.get("url", "").strip()
+        if request.method == "GET":
+            data = request.args
+        else:
+            data = request.get_json(force=True) or {}
+        url = (data.get("url") or "").strip()
         if not url:
             return jsonify({"error": "URL_REQUIRED"}), 400
 
+        try:
+            offset = int(data.get("offset") or 0)
+            limit = int(data.get("limit") or PLAYLIST_PAGE_SIZE)
+        except (TypeError, ValueError):
+            return jsonify({"error": "INVALID_PAGINATION"}), 400
+        try:
+            view, fields = metadata_view_options(data)
+        except ValueError:
+            return jsonify({"error": "INVALID_VIEW"}), 400
+        phase = data.get("phase") or "full"
+        if phase not in METADATA_PHASES:
+            return jsonify({"error": "INVALID_PHASE"}), 400
+        if refused := admission_refused("metadata"):
+            return refused
+
         logger.info("Metadata request for URL: %s", url)
 
-        ydl_opts, _ = final_opts(download=False)
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
+        if phase == "basic":
+            body = basic_metadata(url, view, fields)
+            if body is not None:
+                resp = jsonify(body)
+                resp.headers["Cache-Control"] = "no-store"
+                return resp
 
-        # Playlist
-        if info.get("_type") in {"playlist", "multi_video"} or info.get("entries"):
-            entries = info.get("entries") or []
-            videos = []
-            for idx, entry in enumerate(entries, start=1):
-                if not entry:
-                    continue
-                videos.append(
-                    {
-                        "id": entry.get("id"),
-                        "title": entry.get("title"),
-                        "duration": entry.get("duration"),
-                        "thumbnail": entry.get("thumbnail"),
-                        "uploader": entry.get("uploader") or entry.get("channel"),
-                        "index": entry.get("playlist_index") or idx,
-                        "url": entry.get("webpage_url")
-                        or f"https://www.youtube.com/watch?v={entry.get('id')}",
-                    }
-                )
+        payload, hit = METADATA_CACHE.get_or_load(
+            canonical_media_key(url), lambda: fetch_metadata(url)
+        )
+        with timed("render"):
+            page = metadata_page(payload, hit, offset, limit)
+            body = metadata_json(render_metadata(page, view, fields))
 
-            # For playlist resolution dropdown, we use first non-empty entry with formats (if present)
-            playlist_formats = []
-            first_with_formats = next(
-                (e for e in entries if e and e.get("formats")), None
-            )
-            if first_with_formats:
-                playlist_formats = extract_formats_for_frontend(
-                    first_with_formats.get("formats")
-                )
+        # conditional GET and the encoded variant's ETag are handled by compress_response
+        resp = app.response_class(body, mimetype="application/json")
+        resp.set_etag(content_etag(body))
+        resp.headers["X-Cache"] = "HIT" if hit else "MISS"
+        if request.method == "GET":
+            resp.headers["Cache-Control"] = f"public, max-age={METADATA_HTTP_MAX_AGE}"
+        return resp
 
-            return jsonify(
-                {
-                    "success": True,
-                    "kind": "playlist",
-                    "playlist": {
-                        "id": info.get("id"),
-                        "title": info.get("title") or "Playlist",
-                        "uploader": info.get("uploader") or info.get("channel"),
-                        "video_count": len(videos),
-                        "videos": videos,
-                    },
-                    "formats": playlist_formats,
-                }
-            )
+    except Overloaded:
+        status, body, headers = rejection("metadata", 503, "SERVER_BUSY", SHED_RETRY_AFTER)
+        return jsonify(body), status, headers
+    except Exception as e:  # noqa: BLE001
+        logger.exception("METADATA ERROR: %s", e)
+        ERRORS.labels("METADATA_FAILED").inc()
+        return jsonify({"error": "METADATA_FAILED", "message": str(e)}), 500
 
-        # Single video
-        video_info = {
-            "id": info.get("id"),
-            "title": info.get("title"),
-            "duration": info.get("duration"),
-            "thumbnail": info.get("thumbnail"),
-            "uploader": info.get("uploader") or info.get("channel"),
-            "view_count": info.get("view_count"),
-            "like_count": info.get("like_count"),
-            "formats": extract_formats_for_frontend(info.get("formats")),
-        }
 
-        return jsonify({"success": True, "kind": "video", "video": video_info})
+@app.route("/api/metadata/formats/<request_id>")
+def metadata_formats(request_id: str):
+    """
+    Second phase of a phase=basic request, for polling clients: the full
+    metadata response once it is ready, 202 with Retry-After while not.
+    """
+    state, body = formats_result(request_id)
+    if state == "unknown":
+        return jsonify({"error": "REQUEST_NOT_FOUND"}), 404
+    if state == "pending":
+        return jsonify({"status": "pending", "retry_after": 1}), 202, {"Retry-After": "1"}
+    return jsonify(body), 500 if state == "error" else 200, {"Cache-Control": "no-store"}
 
-    except Exception as e:  # noqa: BLE001
-        logger.exception("METADATA ERROR: %s", e)
 
-        # If enhanced mode failed once, flip the switch and try simple next time
-        if not USE_SIMPLE_VERSION:
-            USE_SIMPLE_VERSION = True
-            logger.warning("Switching to SIMPLE yt-dlp mode due to metadata error.")
+@app.route("/api/metadata/events/<request_id>")
+def metadata_events(request_id: str):
+    """
+    Second phase of a phase=basic request as Server-Sent Events: one `formats`
+    event with the full metadata response (or an `error` event), then the
+    stream closes. It also closes after METADATA_FORMATS_TIMEOUT; clients then
+    poll /api/metadata/formats/<request_id>.
+    """
+    if formats_result(request_id)[0] == "unknown":
+        return jsonify({"error": "REQUEST_NOT_FOUND"}), 404
 
-        return jsonify({"error": "METADATA_FAILED", "message": str(e)}), 500
+    def generate():
+        deadline = time.monotonic() + METADATA_FORMATS_TIMEOUT
+        last_sent = 0.0  # a comment right away, so the client sees the stream open
+        while time.monotonic() < deadline:
+            state, body = formats_result(request_id)
+            if state == "ready":
+                yield f"event: formats\ndata: {json.dumps(body)}\n\n"
+                return
+            if state != "pending":
+                yield f"event: error\ndata: {json.dumps(body or {'error': 'REQUEST_NOT_FOUND'})}\n\n"
+                return
+            if time.monotonic() - last_sent >= 15:
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            time.sleep(METADATA_FORMATS_POLL_SECONDS)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/metadata/batch", methods=["POST"])
+def metadata_batch():
+    """
+    Resolve up to METADATA_BATCH_MAX URLs concurrently.
+
+    Body: {"urls": [...], "view", "fields"} (as for /api/metadata). Streams one
+    NDJSON line per URL as it completes, tagged with its index in the list;
+    a failed item carries "error" and does not stop the others.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    urls = data.get("urls")
+    if not isinstance(urls, list) or not urls:
+        return jsonify({"error": "URLS_REQUIRED"}), 400
+    if len(urls) > METADATA_BATCH_MAX:
+        return jsonify({"error": "TOO_MANY_URLS", "max": METADATA_BATCH_MAX}), 400
+    urls = [str(url or "").strip() for url in urls]
+    if not all(urls):
+        return jsonify({"error": "URL_REQUIRED"}), 400
+    try:
+        view, fields = metadata_view_options(data)
+    except ValueError:
+        return jsonify({"error": "INVALID_VIEW"}), 400
+
+    with timed("admission"):
+        refused = admit(request_client(), "metadata", cost=len(set(urls)))
+    if refused:
+        status, body, headers = refused
+        return jsonify(body), status, headers
+
+    logger.info("Batch metadata request for %d URLs", len(urls))
+
+    def generate():
+        for item in resolve_metadata_batch(urls, view, fields):
+            yield json.dumps(item, separators=(",", ":")) + "\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.route("/api/download", methods=["POST"])
 def download():
     """
-    Download a single video (normal or audio-only).
+    Queue a download of a single video (normal or audio-only), optionally
+    only a clip of it ("start"/"end" or "chapter", see parse_clip).
 
     The frontend calls this for:
       - single URLs
       - each selected video inside a playlist (one by one)
+
+    Returns 202 with a job id right away; follow it via /api/status/<job_id>
+    or /api/progress/<job_id> and fetch the result from download_url. 429/503
+    with Retry-After when the client or the server is over its limits.
     """
-    global USE_SIMPLE_VERSION
+    data = request.get_json(force=True) or {}
+    url = data.get("url", "").strip()
+    format_id = data.get("format_id") or data.get("resolution") or "best"
+    kind = (data.get("kind") or "mp4").lower()
 
+    if not url:
+        return jsonify({"error": "URL_REQUIRED"}), 400
     try:
-        data = request.get_json(force=True) or {}
-        url = data.get("url", "").strip()
-        format_id = data.get("format_id") or data.get("resolution") or "best"
-        kind = (data.get("kind") or "mp4").lower()
-        is_audio = kind == "mp3"
-
-        if not url:
-            return jsonify({"error": "URL_REQUIRED"}), 400
+        clip = parse_clip(data)
+    except ValueError as e:
+        return jsonify({"error": "INVALID_CLIP", "message": str(e)}), 400
+    if refused := admission_refused("download"):
+        return refused
 
-        logger.info("Download request: url=%s, kind=%s, format=%s", url, kind, format_id)
+    logger.info("Download request: url=%s, kind=%s, format=%s, clip=%s", url, kind, format_id, clip)
 
-        ydl_opts, download_id = final_opts(
-            download=True, format_id=format_id, is_audio=is_audio
+    with timed("enqueue"):
+        job = enqueue_download(
+            url, kind, format_id, request_client(), profile=g.get("profiler") is not None, clip=clip
         )
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
+    return (
+        jsonify(
+            {
+                "success": True,
+                "job_id": job["job_id"],
+                "status": job["status"],
+                "status_url": url_for("job_status", job_id=job["job_id"]),
+                "progress_url": url_for("job_progress", job_id=job["job_id"]),
+            }
+        ),
+        202,
+    )
+
 
-        # Determine downloaded file path
-        file_path = info.get("_filename")
-        if file_path:
-            file_path = Path(file_path)
-        else:
-            # fallback: find by download_id
-            candidates = list(DOWNLOAD_DIR.glob(f"{download_id}_*"))
-            file_path = candidates[0] if candidates else None
+@app.route("/api/status/<job_id>")
+def job_status(job_id: str):
+    """Current state of a download job (for polling clients)."""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "JOB_NOT_FOUND"}), 404
+    return jsonify(public_job(job))
 
-        if not file_path or not file_path.exists():
-            logger.error("Downloaded file not found for url=%s", url)
-            return jsonify({"error": "FILE_NOT_FOUND"}), 500
 
-        title = info.get("title") or "video"
-        ext = file_path.suffix.lstrip(".").lower() or ("mp3" if is_audio else "mp4")
-        download_name = safe_download_name(title, ext)
+@app.route("/api/progress/<job_id>")
+def job_progress(job_id: str):
+    """
+    Stream job updates as Server-Sent Events.
+
+    Sends one `data:` event per state change and closes the stream once the
+    job is completed or failed. Comment lines keep idle proxies from timing out.
+    """
+    if get_job(job_id) is None:
+        return jsonify({"error": "JOB_NOT_FOUND"}), 404
+
+    def generate():
+        last_version = -1
+        while True:
+            job = wait_for_job_update(job_id, last_version)
+
+            if job is None:
+                yield f"event: error\ndata: {json.dumps({'error': 'JOB_NOT_FOUND'})}\n\n"
+                return
+
+            if job["version"] == last_version:
+                yield ": keep-alive\n\n"
+                continue
+
+            last_version = job["version"]
+            yield f"data: {json.dumps(public_job(job))}\n\n"
+
+            if job["status"] in JOB_FINAL_STATES:
+                return
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/download/<job_id>/<path:filename>")
+def download_job_file(job_id: str, filename: str):
+    """
+    Send the finished file of a job.
 
-        logger.info("Sending file %s as %s", file_path, download_name)
+    `filename` is only there so browsers pick a nice name from the URL;
+    the real name comes from the job.
+    """
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "JOB_NOT_FOUND"}), 404
 
-        resp = send_file(
-            file_path,
-            as_attachment=True,
-            download_name=download_name,
-            mimetype="audio/mpeg" if ext == "mp3" else "video/mp4",
-            conditional=True,
+    if job["status"] != "completed" and job.get("streamable") and job["status"] != "error":
+        # relay bytes while yt-dlp is still downloading (chunked transfer)
+        download_name = job["filename"]
+        logger.info("Streaming in-progress job %s as %s", job_id, download_name)
+        resp = Response(
+            throttled(stream_growing_file(job_id, Path(job["stream_path"])), EGRESS, "interactive"),
+            mimetype=media_mimetype(Path(download_name).suffix.lstrip(".")),
+            headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
         )
+        resp.headers.set("Content-Disposition", "attachment", **attachment_headers(download_name))
+        if job.get("download_id"):
+            resp.headers["X-Download-Id"] = job["download_id"]
+        return observe_send(resp, "stream")
 
-        # expose a short id so frontend can build /files/<id> QR link
-        if download_id:
-            resp.headers["X-Download-Id"] = download_id
+    if job["status"] != "completed":
+        return jsonify({"error": "JOB_NOT_READY", "status": job["status"]}), 409
 
-        return resp
+    file_path = Path(job["file_path"])
+    if not file_path.exists():
+        ERRORS.labels("FILE_NOT_FOUND").inc()
+        return jsonify({"error": "FILE_NOT_FOUND"}), 404
+    if job.get("download_id"):
+        DOWNLOAD_MANIFEST.get(job["download_id"])  # count as an access
+
+    download_name = job["filename"]
+    logger.info("Sending file %s as %s", file_path, download_name)
+    note_job_timings(job)
+
+    resp = send_download(file_path, download_name, media_mimetype(file_path.suffix.lstrip(".")))
+
+    # expose a short id so frontend can build /files/<id> QR link
+    if job.get("download_id"):
+        resp.headers["X-Download-Id"] = job["download_id"]
+
+    return observe_send(resp, "job")
+
+
+@app.route("/api/playlist/download", methods=["POST"])
+def playlist_download():
+    """
+    Register selected playlist entries for a single ZIP download.
+
+    Body: {"entries": [{"url": ..., "title": ...}], "kind", "format_id",
+    "concurrency"}. Returns the zip_url that streams the archive (once).
+    Admission costs one token per entry.
+    """
+    data = request.get_json(force=True) or {}
+    entries = [
+        {"url": str(e.get("url") or "").strip(), "title": e.get("title")}
+        for e in data.get("entries") or []
+        if isinstance(e, dict)
+    ]
+    entries = [e for e in entries if e["url"]]
+    if not entries:
+        return jsonify({"error": "ENTRIES_REQUIRED"}), 400
+    if len(entries) > MAX_BATCH_ENTRIES:
+        return jsonify({"error": "TOO_MANY_ENTRIES", "max": MAX_BATCH_ENTRIES}), 400
+
+    kind = str(data.get("kind") or "mp4").lower()
+    if kind not in DOWNLOAD_KINDS:
+        return jsonify({"error": "INVALID_KIND"}), 400
+    format_id = data.get("format_id") or data.get("resolution") or "best"
+    try:
+        concurrency = int(data.get("concurrency") or PLAYLIST_ZIP_CONCURRENCY)
+    except (TypeError, ValueError):
+        return jsonify({"error": "INVALID_CONCURRENCY"}), 400
+    concurrency = max(1, min(concurrency, MAX_CONCURRENT_DOWNLOADS))
+
+    if refused := admission_refused("download", cost=len(entries)):
+        return refused
+
+    batch = create_batch(entries, kind, format_id, concurrency, request_client())
+    logger.info(
+        "Playlist batch %s: %d entries, kind=%s, concurrency=%d",
+        batch["batch_id"], len(entries), kind, concurrency,
+    )
+
+    return (
+        jsonify(
+            {
+                "success": True,
+                "batch_id": batch["batch_id"],
+                "entries": len(entries),
+                "concurrency": concurrency,
+                "zip_url": url_for("download_batch_zip", batch_id=batch["batch_id"]),
+            }
+        ),
+        201,
+    )
 
-    except Exception as e:  # noqa: BLE001
-        logger.error("DOWNLOAD ERROR: %s", e)
 
-        # If enhanced mode failed once, flip to simple for next calls
-        if not USE_SIMPLE_VERSION:
-            USE_SIMPLE_VERSION = True
-            logger.warning("Switching to SIMPLE yt-dlp mode due to download error.")
+@app.route("/download/batch/<batch_id>.zip")
+def download_batch_zip(batch_id: str):
+    """Stream the ZIP archive of a playlist batch while its downloads run."""
+    batch = STATE_STORE.get("batches", batch_id)
+    if batch is None:
+        return jsonify({"error": "BATCH_NOT_FOUND"}), 404
+    # the slot is held until the response is closed, i.e. for the whole stream
+    slot = ExitStack()
+    try:
+        slot.enter_context(BATCH_ZIP_INFLIGHT.slot())
+    except Overloaded:
+        status, body, headers = rejection("batch", 503, "SERVER_BUSY", SHED_RETRY_AFTER)
+        return jsonify(body), status, headers
+    # single use: a replay would queue the whole playlist again past admission control
+    if not STATE_STORE.add("batch_claims", batch_id, WORKER_ID, ttl=DOWNLOAD_TTL_SECONDS):
+        slot.close()
+        return jsonify({"error": "BATCH_ALREADY_STARTED"}), 410
 
-        return jsonify({"error": "DOWNLOAD_FAILED", "message": str(e)}), 502
+    resp = Response(
+        throttled(stream_batch_zip(batch), EGRESS, "bulk"),
+        mimetype="application/zip",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
+    )
+    resp.call_on_close(slot.close)
+    resp.headers.set(
+        "Content-Disposition", "attachment", **attachment_headers(f"playlist-{batch_id[:8]}.zip")
+    )
+    return observe_send(resp, "batch")
 
 
 @app.route("/files/<download_id>")
@@ -496,29 +5379,112 @@ def serve_file_by_id(download_id: str):
     We DON'T expose the raw filename in the URL, only the random id prefix.
     """
     try:
-        candidates = sorted(DOWNLOAD_DIR.glob(f"{download_id}_*"))
-        if not candidates:
+        entry = DOWNLOAD_MANIFEST.get(download_id)
+        if entry is None:
             return "File expired or not found", 404
 
-        file_path = candidates[0]
-        title_part = file_path.name.split("_", 1)[-1].rsplit(".", 1)[0]
+        file_path = Path(entry["path"])
         ext = file_path.suffix.lstrip(".").lower() or "mp4"
-        download_name = safe_download_name(title_part, ext)
+        title_part = file_path.name.split("_", 1)[-1].rsplit(".", 1)[0]
+        download_name = entry["filename"] or safe_download_name(title_part, ext)
 
         logger.info("QR /files request -> %s as %s", file_path, download_name)
 
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name=download_name,
-            mimetype="audio/mpeg" if ext == "mp3" else "video/mp4",
-            conditional=True,
-        )
+        resp = send_download(file_path, download_name, media_mimetype(ext))
+        return observe_send(resp, "files")
     except Exception as e:  # noqa: BLE001
         logger.error("FILES ROUTE ERROR: %s", e)
         return "Internal error", 500
 
 
+@app.route("/img/thumb/<key>/<int:width>.webp")
+def thumbnail(key: str, width: int):
+    """Resized WebP of a thumbnail listed in a metadata response."""
+    if not THUMBNAIL_KEY_RE.match(key) or width not in THUMBNAIL_WIDTHS:
+        return jsonify({"error": "IMAGE_NOT_FOUND"}), 404
+    try:
+        data = load_thumbnail(key, width)
+    except Exception as e:  # noqa: BLE001
+        logger.warning("Thumbnail %s failed: %s", key, e)
+        ERRORS.labels("THUMBNAIL_FAILED").inc()
+        return jsonify({"error": "THUMBNAIL_FAILED"}), 502
+    if data is None:
+        return jsonify({"error": "IMAGE_NOT_FOUND"}), 404
+    return image_response(data, "image/webp")
+
+
+@app.route("/img/qr/<download_id>.<fmt>")
+def qr_code(download_id: str, fmt: str):
+    """
+    QR code (png or svg) of the /files/<download_id> link, for phones.
+
+    Only ids of finished downloads (or of jobs on this worker) get one. The
+    cache is keyed by the id and PUBLIC_BASE_URL; without PUBLIC_BASE_URL the
+    link depends on the Host header, so the image is drawn but never cached.
+    """
+    if not re.fullmatch(r"[0-9a-f]{32}", download_id) or fmt not in QR_FORMATS:
+        return jsonify({"error": "IMAGE_NOT_FOUND"}), 404
+    if not is_known_download(download_id):
+        return jsonify({"error": "IMAGE_NOT_FOUND"}), 404
+    link = f"{resolve_base_url()}/files/{download_id}"
+    if not PUBLIC_BASE_URL:
+        return image_response(generate_qr_code(link, fmt), QR_FORMATS[fmt])
+    base = hashlib.sha1(PUBLIC_BASE_URL.encode("utf-8")).hexdigest()[:8]
+    name = f"qr_{download_id}_{base}.{fmt}"
+    data = IMAGE_CACHE.get(name)
+    if data is None:
+        data = generate_qr_code(link, fmt)
+        IMAGE_CACHE.put(name, data)
+    return image_response(data, QR_FORMATS[fmt])
+
+
+def admin_only(view):
+    """Admin routes need X-Admin-Token; without ADMIN_TOKEN they do not exist."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({"error": "NOT_FOUND"}), 404
+        if not is_admin(request.headers.get("X-Admin-Token")):
+            return jsonify({"error": "FORBIDDEN"}), 403
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@app.route("/admin/profiling", methods=["GET", "POST"])
+@admin_only
+def admin_profiling():
+    """
+    GET: sample rate and saved profiles. POST {"sample_rate": 0.01}: profile
+    that share of requests in every worker (0 stops sampling).
+    """
+    if request.method == "POST":
+        data = request.get_json(force=True, silent=True) or {}
+        try:
+            rate = float(data.get("sample_rate"))
+        except (TypeError, ValueError):
+            rate = -1.0
+        if not 0 <= rate <= 1:
+            return jsonify({"error": "INVALID_SAMPLE_RATE"}), 400
+        STATE_STORE.set("settings", "profile_sample_rate", rate)
+        _PROFILE_RATE.update(rate=rate, read_at=time.monotonic())
+        logger.info("Profile sample rate set to %s", rate)
+    return jsonify({"sample_rate": profile_sample_rate(), "profiles": list_profiles()})
+
+
+@app.route("/admin/profiles/<name>")
+@admin_only
+def admin_profile(name: str):
+    """A saved profile: the raw cProfile file, or ?format=text for a pstats report."""
+    path = PROFILE_DIR / name
+    if not PROFILE_NAME_RE.match(name) or not path.is_file():
+        return jsonify({"error": "PROFILE_NOT_FOUND"}), 404
+    if request.args.get("format") == "text":
+        return Response(profile_summary(path), mimetype="text/plain")
+    return send_file(path, mimetype="application/octet-stream", as_attachment=True, download_name=name)
+
+
 # ---------------------------------------------------------
 # MAIN (for local testing)
 # ---------------------------------------------------------
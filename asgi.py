@@ -0,0 +1,759 @@
+"""
+Asyncio serving mode (ASGI) for YTDownloadX.
+
+    gunicorn asgi:app -k uvicorn_worker.UvicornWorker --workers 2
+    uvicorn asgi:app --port 5000            # local, single process
+
+The routes that mostly wait - /api/metadata, /api/download, /api/status,
+/api/progress, /download, /files and /api/health - run on the event loop and
+hand their blocking parts (yt-dlp extraction, state store / manifest lookups,
+file reads) to bounded thread pools. An idle connection (an SSE stream, a slow
+download, a client waiting for an extraction) then costs a coroutine instead
+of one of gunicorn's threads, so one worker holds thousands of them.
+
+Every other route is the Flask app from app.py, mounted through a2wsgi, and
+downloads still run on app.DOWNLOAD_EXECUTOR: both serving modes share jobs,
+caches and files.
+"""
+
+import asyncio
+import contextvars
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
+from functools import partial, wraps
+from datetime import datetime, timezone
+from pathlib import Path
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.http import (
+    dump_options_header,
+    http_date,
+    parse_date,
+    parse_etags,
+    parse_if_range_header,
+    quote_etag,
+)
+
+from app import (
+    DOWNLOAD_MANIFEST,
+    EGRESS,
+    ERRORS,
+    JOB_FINAL_STATES,
+    COMPRESS_MIN_BYTES,
+    JOB_LISTENERS,
+    METADATA_CACHE,
+    METADATA_FORMATS_POLL_SECONDS,
+    METADATA_FORMATS_TIMEOUT,
+    METADATA_HTTP_MAX_AGE,
+    METADATA_PHASES,
+    SHED_RETRY_AFTER,
+    Overloaded,
+    PLAYLIST_PAGE_SIZE,
+    RequestTiming,
+    SEND_SECONDS,
+    STATE_SYNC_INTERVAL,
+    STREAM_POLL_SECONDS,
+    admit,
+    app as flask_app,
+    attachment_headers,
+    basic_metadata,
+    canonical_media_key,
+    client_key,
+    compress_body,
+    content_etag,
+    encoded_etag,
+    enqueue_download,
+    fetch_metadata,
+    file_chunks,
+    file_etag,
+    formats_result,
+    get_job,
+    get_local_job,
+    growing_file_chunks,
+    health_payload,
+    is_not_modified,
+    logger,
+    media_mimetype,
+    metadata_json,
+    metadata_page,
+    metadata_view_options,
+    negotiate_encoding,
+    parse_clip,
+    note_job_timings,
+    proxy_delivery_headers,
+    public_job,
+    rejection,
+    ranged_body,
+    render_metadata,
+    requested_ranges,
+    safe_download_name,
+    start_worker,
+    timed,
+)
+
+# ---------------------------------------------------------
+# EXECUTORS
+# ---------------------------------------------------------
+#
+# Extractions hold a thread for seconds, so they get their own pool; short
+# blocking calls (SQLite / Redis, stat) share another. Each pool accepts at
+# most threads + backlog calls; past that requests get 503 + Retry-After
+# instead of queueing without bound. Threads rather than processes: yt-dlp
+# waits on the network, and the pooled yt-dlp contexts, circuit breaker and
+# job table all live in this process.
+
+ASGI_METADATA_THREADS = max(1, int(os.environ.get("ASGI_METADATA_THREADS", "8")))
+ASGI_METADATA_BACKLOG = max(0, int(os.environ.get("ASGI_METADATA_BACKLOG", "64")))
+ASGI_IO_THREADS = max(1, int(os.environ.get("ASGI_IO_THREADS", "16")))
+ASGI_IO_BACKLOG = max(0, int(os.environ.get("ASGI_IO_BACKLOG", "1024")))
+# Threads serving the mounted Flask routes (pages, /metrics, playlist ZIPs)
+ASGI_WSGI_THREADS = max(1, int(os.environ.get("ASGI_WSGI_THREADS", "8")))
+
+BUSY_RETRY_AFTER = 5  # seconds, sent with 503 SERVER_BUSY
+SSE_KEEPALIVE_SECONDS = 15
+
+
+class ServerBusy(Exception):
+    """A bounded executor is full; answered with 503 + Retry-After."""
+
+
+class ClientDisconnected(Exception):
+    """The client went away while its request was waiting."""
+
+
+class BoundedExecutor:
+    """
+    Thread pool for coroutines with a cap on running + queued calls.
+
+    Cancelling the awaiting coroutine (the client disconnected) drops a call
+    that has not started yet; one already running finishes in its thread.
+    """
+
+    def __init__(self, name: str, threads: int, backlog: int):
+        self.name = name
+        self.limit = threads + backlog
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=f"asgi-{name}")
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.rejected = 0
+
+    def _done(self, _future) -> None:
+        with self._lock:
+            self.pending -= 1
+
+    async def run(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.limit:
+                self.rejected += 1
+                raise ServerBusy(self.name)
+            self.pending += 1
+        # the call sees the request's context (request id, phase timings)
+        future = self._pool.submit(contextvars.copy_context().run, fn, *args)
+        future.add_done_callback(self._done)
+        # cancelling the asyncio side cancels the pool future if still queued
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"pending": self.pending, "limit": self.limit, "rejected": self.rejected}
+
+
+METADATA_POOL = BoundedExecutor("metadata", ASGI_METADATA_THREADS, ASGI_METADATA_BACKLOG)
+IO_POOL = BoundedExecutor("io", ASGI_IO_THREADS, ASGI_IO_BACKLOG)
+
+# media key -> [future, waiting requests]; one extraction per key on this loop
+EXTRACTIONS: dict[str, list] = {}
+
+
+async def load_metadata(url: str) -> tuple[dict, bool]:
+    """
+    METADATA_CACHE.get_or_load on METADATA_POOL, shared by every request for
+    the same media. When the last waiting request is cancelled, an extraction
+    that is still queued is dropped.
+    """
+    key = canonical_media_key(url)
+    cached = METADATA_CACHE.peek(key)
+    if cached is not None:
+        return cached, True
+
+    entry = EXTRACTIONS.get(key)
+    leader = entry is None
+    if leader:
+        future = asyncio.ensure_future(
+            METADATA_POOL.run(METADATA_CACHE.get_or_load, key, lambda: fetch_metadata(url))
+        )
+        entry = EXTRACTIONS[key] = [future, 0]
+        future.add_done_callback(
+            lambda _: EXTRACTIONS.pop(key) if EXTRACTIONS.get(key) is entry else None
+        )
+
+    entry[1] += 1
+    try:
+        payload, hit = await asyncio.shield(entry[0])
+    except asyncio.CancelledError:
+        if entry[1] == 1:
+            entry[0].cancel()
+        raise
+    finally:
+        entry[1] -= 1
+    return payload, hit or not leader
+
+
+async def find_job(job_id: str) -> dict | None:
+    """get_job without blocking the loop (only jobs of other workers need I/O)."""
+    return get_local_job(job_id) or await IO_POOL.run(get_job, job_id)
+
+
+async def until_disconnected(request: Request, awaitable):
+    """Await `awaitable`; cancel it and raise ClientDisconnected if the client leaves first."""
+
+    async def disconnected():
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+
+    work = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(disconnected())
+    try:
+        await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        work.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if not work.done():
+        work.cancel()
+        raise ClientDisconnected()
+    return work.result()
+
+
+# ---------------------------------------------------------
+# JOB EVENTS
+# ---------------------------------------------------------
+
+
+class JobEvents:
+    """
+    Wakes SSE streams of this worker's jobs: update_job calls notify() from
+    any thread, which sets the asyncio.Event the streams of that job wait on.
+    Jobs of other workers are polled every STATE_SYNC_INTERVAL instead.
+    """
+
+    def __init__(self):
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._events: dict[str, asyncio.Event] = {}
+
+    def attach(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        JOB_LISTENERS.append(self.notify)
+
+    def detach(self) -> None:
+        with suppress(ValueError):
+            JOB_LISTENERS.remove(self.notify)
+        self.loop = None
+
+    def notify(self, job_id: str) -> None:
+        # runs under JOBS_CONDITION: only schedule the wake-up
+        loop = self.loop
+        if loop is not None and job_id in self._events:
+            with suppress(RuntimeError):  # loop already closed
+                loop.call_soon_threadsafe(self._wake, job_id)
+
+    def _wake(self, job_id: str) -> None:
+        event = self._events.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    async def wait_for_update(self, job_id: str, last_version: int, timeout: float) -> dict | None:
+        """Async counterpart of app.wait_for_job_update."""
+        deadline = time.monotonic() + timeout
+        while True:
+            # register before reading, so an update in between is not missed
+            event = self._events.setdefault(job_id, asyncio.Event())
+            job = get_local_job(job_id)
+            local = job is not None
+            if not local:
+                self._events.pop(job_id, None)
+                job = await IO_POOL.run(get_job, job_id)
+
+            remaining = deadline - time.monotonic()
+            if job is None or job["version"] != last_version or remaining <= 0:
+                return job
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    event.wait(), remaining if local else min(STATE_SYNC_INTERVAL, remaining)
+                )
+
+
+JOB_EVENTS = JobEvents()
+
+
+# ---------------------------------------------------------
+# HELPERS
+# ---------------------------------------------------------
+
+
+def url_builder(request: Request):
+    """url_for equivalent for this request: the Flask app's URL map, without a request context."""
+    adapter = flask_app.url_map.bind("localhost", script_name=request.scope.get("root_path") or "/")
+    return lambda endpoint, **values: adapter.build(endpoint, values)
+
+
+def observe_send(resp: Response, route: str) -> Response:
+    """Record how long the response body takes to reach the client."""
+    started = time.perf_counter()
+
+    async def observe():
+        SEND_SECONDS.labels(route).observe(time.perf_counter() - started)
+
+    resp.background = BackgroundTask(observe)
+    return resp
+
+
+def with_timing(endpoint):
+    """app.RequestTiming for a native route: X-Request-ID, Server-Timing and the request log line."""
+
+    @wraps(endpoint)
+    async def wrapper(request: Request):
+        timing = RequestTiming(request.headers.get("x-request-id"))
+        resp = await endpoint(request)
+        resp.headers.update(timing.headers())
+        previous, sent_at = resp.background, time.perf_counter()
+
+        async def log():
+            if previous is not None:
+                await previous()
+            timing.log(request.method, request.url.path, resp.status_code, sent_at)
+
+        resp.background = BackgroundTask(log)
+        return resp
+
+    return wrapper
+
+
+def request_client(request: Request) -> str:
+    """app.request_client for a Starlette request (uvicorn's --proxy-headers sets the address)."""
+    return client_key(request.headers.get("x-api-key"), request.client.host if request.client else None)
+
+
+async def refused(request: Request, route: str) -> JSONResponse | None:
+    """app.admit for this request: the 429/503 response to send, or None."""
+    with timed("admission"):
+        result = await IO_POOL.run(admit, request_client(request), route)
+    if result is None:
+        return None
+    status, body, headers = result
+    return JSONResponse(body, status_code=status, headers=headers)
+
+
+async def read_json(request: Request) -> dict:
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def paced(chunks, traffic_class: str):
+    """Async counterpart of app.throttled: waits out each chunk's EGRESS delay on the loop."""
+    try:
+        with EGRESS.stream(traffic_class) as stream_id:
+            async for chunk in chunks:
+                delay = EGRESS.reserve(stream_id, len(chunk))
+                if delay:
+                    await asyncio.sleep(delay)
+                yield chunk
+    finally:
+        await chunks.aclose()
+
+
+async def relay_growing_file(job_id: str, path: Path):
+    """Async relay of app.growing_file_chunks (each read runs on IO_POOL)."""
+    chunks = growing_file_chunks(job_id, path)
+    try:
+        while (chunk := await IO_POOL.run(next, chunks, None)) is not None:
+            if chunk:
+                yield chunk
+            else:
+                await asyncio.sleep(STREAM_POLL_SECONDS)
+    finally:
+        # fails while a read is still running in its thread; the file is
+        # then closed when the generator is collected
+        with suppress(ValueError):
+            chunks.close()
+
+
+async def send_download(request: Request, file_path: Path, download_name: str, mimetype: str) -> Response:
+    """
+    Async counterpart of app.send_download: same validators, range handling
+    and FILE_DELIVERY modes. File reads run in Starlette's thread pool, one
+    chunk at a time, and stop when the client disconnects; EGRESS pacing
+    waits on the event loop.
+    """
+    disposition = dump_options_header("attachment", attachment_headers(download_name))
+    proxy_headers = proxy_delivery_headers(file_path)
+    if proxy_headers:
+        return Response(media_type=mimetype, headers={**proxy_headers, "Content-Disposition": disposition})
+
+    stat = await IO_POOL.run(file_path.stat)
+    size = stat.st_size
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+    etag = file_etag(file_path, stat)
+    headers = {
+        "Content-Disposition": disposition,
+        "Last-Modified": http_date(last_modified),
+        "Cache-Control": "no-cache",
+        "ETag": quote_etag(etag),
+        "Accept-Ranges": "bytes",
+    }
+
+    if is_not_modified(
+        parse_etags(request.headers.get("if-none-match")),
+        parse_date(request.headers.get("if-modified-since")),
+        etag,
+        last_modified,
+    ):
+        return Response(status_code=304, headers=headers)
+
+    ranges = requested_ranges(
+        request.headers.get("range", ""),
+        parse_if_range_header(request.headers.get("if-range")),
+        size,
+        etag,
+        last_modified,
+    )
+    head = request.method == "HEAD"
+
+    def read(start: int, length: int):
+        return [] if head else file_chunks(file_path, start, length)
+
+    status, range_headers, body = ranged_body(file_path, ranges, size, mimetype, read)
+    if EGRESS.enabled and not head:
+        body = paced(iterate_in_threadpool(body), "interactive")
+    return StreamingResponse(
+        [] if head else body,
+        status_code=status,
+        headers={**headers, **range_headers},
+        media_type=mimetype,
+    )
+
+
+# ---------------------------------------------------------
+# ROUTES
+# ---------------------------------------------------------
+
+
+async def health(request: Request):
+    payload = await IO_POOL.run(health_payload)
+    payload["asgi"] = {
+        "metadata_pool": METADATA_POOL.stats(),
+        "io_pool": IO_POOL.stats(),
+        "extractions": len(EXTRACTIONS),
+    }
+    return JSONResponse(payload)
+
+
+def encode_metadata(page: dict, view: str, fields, accept_encoding: str) -> tuple[str, str | None, bytes]:
+    """(ETag, content coding, body) of a metadata response, as app.compress_response makes them."""
+    body = metadata_json(render_metadata(page, view, fields))
+    encoding = negotiate_encoding(accept_encoding) if len(body) >= COMPRESS_MIN_BYTES else None
+    return encoded_etag(content_etag(body), encoding), encoding, body
+
+
+async def metadata(request: Request):
+    """
+    Return video or playlist metadata; the extraction is dropped if the client
+    leaves while it is queued. GET is cacheable, as in app.metadata.
+    """
+    if request.method == "GET":
+        data = request.query_params
+    else:
+        data = await read_json(request)
+    url = str(data.get("url") or "").strip()
+    if not url:
+        return JSONResponse({"error": "URL_REQUIRED"}, status_code=400)
+
+    try:
+        offset = int(data.get("offset") or 0)
+        limit = int(data.get("limit") or PLAYLIST_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return JSONResponse({"error": "INVALID_PAGINATION"}, status_code=400)
+    try:
+        view, fields = metadata_view_options(data)
+    except ValueError:
+        return JSONResponse({"error": "INVALID_VIEW"}, status_code=400)
+    phase = data.get("phase") or "full"
+    if phase not in METADATA_PHASES:
+        return JSONResponse({"error": "INVALID_PHASE"}, status_code=400)
+    if resp := await refused(request, "metadata"):
+        return resp
+
+    logger.info("Metadata request for URL: %s", url)
+    try:
+        if phase == "basic":
+            basic = await until_disconnected(
+                request, METADATA_POOL.run(basic_metadata, url, view, fields, url_builder(request))
+            )
+            if basic is not None:
+                return JSONResponse(basic, headers={"Cache-Control": "no-store"})
+        payload, hit = await until_disconnected(request, load_metadata(url))
+        page = metadata_page(payload, hit, offset, limit)
+    except (ServerBusy, ClientDisconnected):
+        raise
+    except Overloaded:
+        status, body, headers = rejection("metadata", 503, "SERVER_BUSY", SHED_RETRY_AFTER)
+        return JSONResponse(body, status_code=status, headers=headers)
+    except Exception as e:  # noqa: BLE001
+        logger.exception("METADATA ERROR: %s", e)
+        ERRORS.labels("METADATA_FAILED").inc()
+        return JSONResponse({"error": "METADATA_FAILED", "message": str(e)}, status_code=500)
+
+    with timed("render"):
+        etag, encoding, body = await IO_POOL.run(
+            encode_metadata, page, view, fields, request.headers.get("accept-encoding", "")
+        )
+    headers = {"ETag": quote_etag(etag), "Vary": "Accept-Encoding", "X-Cache": "HIT" if hit else "MISS"}
+    if request.method == "GET":
+        headers["Cache-Control"] = f"public, max-age={METADATA_HTTP_MAX_AGE}"
+        if parse_etags(request.headers.get("if-none-match")).contains(etag):
+            return Response(status_code=304, headers=headers)
+    if encoding:
+        with timed("compress"):
+            body = await IO_POOL.run(compress_body, body, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
+
+
+async def metadata_events(request: Request):
+    """Formats phase of a phase=basic request as SSE, one coroutine per stream (see app.metadata_events)."""
+    request_id = request.path_params["request_id"]
+    if (await IO_POOL.run(formats_result, request_id))[0] == "unknown":
+        return JSONResponse({"error": "REQUEST_NOT_FOUND"}, status_code=404)
+
+    async def generate():
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + METADATA_FORMATS_TIMEOUT
+        last_sent = loop.time()
+        yield ": waiting for formats\n\n"
+        while loop.time() < deadline:
+            try:
+                state, body = await IO_POOL.run(formats_result, request_id)
+            except ServerBusy:
+                yield f"event: error\ndata: {json.dumps({'error': 'SERVER_BUSY'})}\n\n"
+                return
+            if state == "ready":
+                yield f"event: formats\ndata: {json.dumps(body)}\n\n"
+                return
+            if state != "pending":
+                yield f"event: error\ndata: {json.dumps(body or {'error': 'REQUEST_NOT_FOUND'})}\n\n"
+                return
+            if loop.time() - last_sent >= SSE_KEEPALIVE_SECONDS:
+                last_sent = loop.time()
+                yield ": keep-alive\n\n"
+            await asyncio.sleep(METADATA_FORMATS_POLL_SECONDS)
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def download(request: Request):
+    """Queue a download (see app.download); returns 202 with the job's status URLs."""
+    data = await read_json(request)
+    url = str(data.get("url") or "").strip()
+    format_id = data.get("format_id") or data.get("resolution") or "best"
+    kind = (data.get("kind") or "mp4").lower()
+
+    if not url:
+        return JSONResponse({"error": "URL_REQUIRED"}, status_code=400)
+    try:
+        clip = parse_clip(data)
+    except ValueError as e:
+        return JSONResponse({"error": "INVALID_CLIP", "message": str(e)}, status_code=400)
+
+    if resp := await refused(request, "download"):
+        return resp
+
+    logger.info("Download request: url=%s, kind=%s, format=%s, clip=%s", url, kind, format_id, clip)
+
+    with timed("enqueue"):
+        job = await IO_POOL.run(partial(enqueue_download, clip=clip), url, kind, format_id, request_client(request))
+
+    build_url = url_builder(request)
+    return JSONResponse(
+        {
+            "success": True,
+            "job_id": job["job_id"],
+            "status": job["status"],
+            "status_url": build_url("job_status", job_id=job["job_id"]),
+            "progress_url": build_url("job_progress", job_id=job["job_id"]),
+        },
+        status_code=202,
+    )
+
+
+async def job_status(request: Request):
+    job = await find_job(request.path_params["job_id"])
+    if job is None:
+        return JSONResponse({"error": "JOB_NOT_FOUND"}, status_code=404)
+    return JSONResponse(public_job(job, url_builder(request)))
+
+
+async def job_progress(request: Request):
+    """Server-Sent Events for a job, one coroutine per stream (see app.job_progress)."""
+    job_id = request.path_params["job_id"]
+    if await find_job(job_id) is None:
+        return JSONResponse({"error": "JOB_NOT_FOUND"}, status_code=404)
+
+    build_url = url_builder(request)
+
+    async def generate():
+        last_version = -1
+        while True:
+            try:
+                job = await JOB_EVENTS.wait_for_update(job_id, last_version, SSE_KEEPALIVE_SECONDS)
+            except ServerBusy:
+                # EventSource reconnects on its own
+                yield f"event: error\ndata: {json.dumps({'error': 'SERVER_BUSY'})}\n\n"
+                return
+
+            if job is None:
+                yield f"event: error\ndata: {json.dumps({'error': 'JOB_NOT_FOUND'})}\n\n"
+                return
+
+            if job["version"] == last_version:
+                yield ": keep-alive\n\n"
+                continue
+
+            last_version = job["version"]
+            yield f"data: {json.dumps(public_job(job, build_url))}\n\n"
+
+            if job["status"] in JOB_FINAL_STATES:
+                return
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def download_job_file(request: Request):
+    """Send the finished file of a job, or relay it while it is still downloading."""
+    job_id = request.path_params["job_id"]
+    job = await find_job(job_id)
+    if job is None:
+        return JSONResponse({"error": "JOB_NOT_FOUND"}, status_code=404)
+
+    if job["status"] != "completed" and job.get("streamable") and job["status"] != "error":
+        download_name = job["filename"]
+        logger.info("Streaming in-progress job %s as %s", job_id, download_name)
+        headers = {
+            "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no",
+            "Content-Disposition": dump_options_header("attachment", attachment_headers(download_name)),
+        }
+        if job.get("download_id"):
+            headers["X-Download-Id"] = job["download_id"]
+        body = relay_growing_file(job_id, Path(job["stream_path"]))
+        resp = StreamingResponse(
+            paced(body, "interactive") if EGRESS.enabled else body,
+            media_type=media_mimetype(Path(download_name).suffix.lstrip(".")),
+            headers=headers,
+        )
+        return observe_send(resp, "stream")
+
+    if job["status"] != "completed":
+        return JSONResponse({"error": "JOB_NOT_READY", "status": job["status"]}, status_code=409)
+
+    file_path = Path(job["file_path"])
+    if not await IO_POOL.run(file_path.exists):
+        ERRORS.labels("FILE_NOT_FOUND").inc()
+        return JSONResponse({"error": "FILE_NOT_FOUND"}, status_code=404)
+    if job.get("download_id"):
+        await IO_POOL.run(DOWNLOAD_MANIFEST.get, job["download_id"])  # count as an access
+
+    download_name = job["filename"]
+    logger.info("Sending file %s as %s", file_path, download_name)
+    note_job_timings(job)
+
+    resp = await send_download(request, file_path, download_name, media_mimetype(file_path.suffix.lstrip(".")))
+    if job.get("download_id"):
+        resp.headers["X-Download-Id"] = job["download_id"]
+    return observe_send(resp, "job")
+
+
+async def serve_file_by_id(request: Request):
+    """QR-code download by short id (see app.serve_file_by_id)."""
+    download_id = request.path_params["download_id"]
+    try:
+        entry = await IO_POOL.run(DOWNLOAD_MANIFEST.get, download_id)
+        if entry is None:
+            return Response("File expired or not found", status_code=404, media_type="text/html")
+
+        file_path = Path(entry["path"])
+        ext = file_path.suffix.lstrip(".").lower() or "mp4"
+        title_part = file_path.name.split("_", 1)[-1].rsplit(".", 1)[0]
+        download_name = entry["filename"] or safe_download_name(title_part, ext)
+
+        logger.info("QR /files request -> %s as %s", file_path, download_name)
+
+        resp = await send_download(request, file_path, download_name, media_mimetype(ext))
+        return observe_send(resp, "files")
+    except ServerBusy:
+        raise
+    except Exception as e:  # noqa: BLE001
+        logger.error("FILES ROUTE ERROR: %s", e)
+        return Response("Internal error", status_code=500, media_type="text/html")
+
+
+async def server_busy(request: Request, exc: ServerBusy):
+    ERRORS.labels("SERVER_BUSY").inc()
+    return JSONResponse(
+        {"error": "SERVER_BUSY"}, status_code=503, headers={"Retry-After": str(BUSY_RETRY_AFTER)}
+    )
+
+
+async def client_disconnected(request: Request, exc: ClientDisconnected):
+    logger.info("Client left before %s %s finished", request.method, request.url.path)
+    # nobody reads this; nginx's code for "client closed request"
+    return Response(status_code=499)
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    # no-op when gunicorn's post_fork hook already ran it
+    start_worker()
+    JOB_EVENTS.attach(asyncio.get_running_loop())
+    try:
+        yield
+    finally:
+        JOB_EVENTS.detach()
+
+
+app = Starlette(
+    routes=[
+        Route("/api/health", with_timing(health)),
+        Route("/api/metadata", with_timing(metadata), methods=["GET", "POST"]),
+        Route("/api/metadata/events/{request_id}", with_timing(metadata_events)),
+        Route("/api/download", with_timing(download), methods=["POST"]),
+        Route("/api/status/{job_id}", with_timing(job_status)),
+        Route("/api/progress/{job_id}", with_timing(job_progress)),
+        Route("/download/{job_id}/{filename:path}", with_timing(download_job_file)),
+        Route("/files/{download_id}", with_timing(serve_file_by_id)),
+        Mount("/", app=WSGIMiddleware(flask_app, workers=ASGI_WSGI_THREADS)),
+    ],
+    exception_handlers={ServerBusy: server_busy, ClientDisconnected: client_disconnected},
+    lifespan=lifespan,
+)
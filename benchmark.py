@@ -0,0 +1,513 @@
+"""
+Offline benchmark for YTDownloadX.
+
+Serves synthetic media (progressive MP4 / M4A, HLS and DASH manifests) from a
+local HTTP origin, starts the app against it and drives /api/metadata and
+/api/download through yt-dlp's generic extractor -- no network needed.
+
+For every scenario and concurrency level it reports throughput, p50/p95/p99
+latency and the peak RSS of the app processes, and writes a JSON file that
+later runs can be compared against:
+
+    python benchmark.py --levels 1,4,8 --requests 24 --save benchmarks/baseline.json
+    python benchmark.py --compare benchmarks/baseline.json
+
+Requires ffmpeg on PATH (to make the media and for HLS/DASH downloads).
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+
+SCENARIOS = {
+    # name: (endpoint, media path, download kind)
+    "metadata_mp4": ("metadata", "prog.mp4", None),
+    "metadata_hls": ("metadata", "hls/index.m3u8", None),
+    "download_mp4": ("download", "prog.mp4", "mp4"),
+    "download_m4a": ("download", "audio.m4a", "m4a"),
+    "download_mp3": ("download", "audio.m4a", "mp3"),
+    "download_hls": ("download", "hls/index.m3u8", "mp4"),
+    "download_dash": ("download", "dash/manifest.mpd", "mp4"),
+}
+
+# ---------------------------------------------------------
+# SYNTHETIC MEDIA
+# ---------------------------------------------------------
+
+
+def ffmpeg(*args: str) -> None:
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *args], check=True)
+
+
+def make_media(media_dir: Path, seconds: int) -> None:
+    """Generate the files the origin serves (skipped when already there)."""
+    media_dir.mkdir(parents=True, exist_ok=True)
+    prog = media_dir / "prog.mp4"
+    if not prog.exists():
+        ffmpeg(
+            "-f", "lavfi", "-i", f"testsrc=size=1280x720:rate=30:duration={seconds}",
+            "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+            "-c:v", "libx264", "-preset", "ultrafast", "-g", "60",
+            "-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart", "-shortest",
+            str(prog),
+        )
+    audio = media_dir / "audio.m4a"
+    if not audio.exists():
+        ffmpeg("-i", str(prog), "-vn", "-c:a", "copy", str(audio))
+
+    hls = media_dir / "hls" / "index.m3u8"
+    if not hls.exists():
+        hls.parent.mkdir(exist_ok=True)
+        ffmpeg(
+            "-i", str(prog), "-c", "copy", "-f", "hls", "-hls_time", "2",
+            "-hls_playlist_type", "vod", str(hls),
+        )
+
+    dash = media_dir / "dash" / "manifest.mpd"
+    if not dash.exists():
+        dash.parent.mkdir(exist_ok=True)
+        ffmpeg(
+            "-i", str(prog), "-map", "0:v", "-map", "0:a", "-c", "copy", "-f", "dash",
+            "-seg_duration", "2", "-adaptation_sets", "id=0,streams=v id=1,streams=a",
+            str(dash),
+        )
+
+
+# ---------------------------------------------------------
+# FAKE ORIGIN
+# ---------------------------------------------------------
+
+
+class OriginHandler(SimpleHTTPRequestHandler):
+    """
+    Serves the media directory under /u/<token>/<path>, so every request can
+    use a unique URL (no metadata / download cache hits). Optionally throttled
+    per connection to simulate a remote CDN.
+    """
+
+    extensions_map = {
+        **SimpleHTTPRequestHandler.extensions_map,
+        ".mp4": "video/mp4",
+        ".m4a": "audio/mp4",
+        ".m4s": "video/iso.segment",
+        ".m3u8": "application/vnd.apple.mpegurl",
+        ".mpd": "application/dash+xml",
+        ".ts": "video/mp2t",
+    }
+    rate: float = 0  # bytes per second, 0 = unlimited
+
+    def translate_path(self, path: str) -> str:
+        parts = path.split("?", 1)[0].lstrip("/").split("/")
+        if len(parts) > 2 and parts[0] == "u":
+            path = "/" + "/".join(parts[2:])
+        return super().translate_path(path)
+
+    def copyfile(self, source, outputfile) -> None:
+        if not self.rate:
+            return super().copyfile(source, outputfile)
+        chunk = 64 * 1024
+        while data := source.read(chunk):
+            outputfile.write(data)
+            time.sleep(len(data) / self.rate)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class OriginServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address) -> None:
+        # yt-dlp / ffmpeg routinely hang up mid-response (probing, ranges)
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_origin(media_dir: Path, rate: float) -> tuple[ThreadingHTTPServer, str]:
+    handler = type("Handler", (OriginHandler,), {"rate": rate})
+    server = OriginServer(
+        ("127.0.0.1", 0), lambda *a, **kw: handler(*a, directory=str(media_dir), **kw)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# ---------------------------------------------------------
+# APP UNDER TEST
+# ---------------------------------------------------------
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_app(args, work_dir: Path) -> tuple[subprocess.Popen, str]:
+    """Start the app in its own process group with a fresh downloads/state dir."""
+    port = free_port()
+    for sub in ("downloads", "metrics"):
+        shutil.rmtree(work_dir / sub, ignore_errors=True)
+        (work_dir / sub).mkdir(parents=True)
+    env = {
+        **os.environ,
+        "DOWNLOAD_DIR": str(work_dir / "downloads"),
+        "PROMETHEUS_MULTIPROC_DIR": str(work_dir / "metrics"),
+        "RATE_LIMIT": "0",  # load comes from one address
+    }
+
+    if args.server == "gunicorn":
+        cmd = [
+            sys.executable, "-m", "gunicorn", "app:app",
+            "--bind", f"127.0.0.1:{port}",
+            "--workers", str(args.workers), "--threads", str(args.threads),
+            "--timeout", "300",
+        ]
+    else:
+        env.pop("PROMETHEUS_MULTIPROC_DIR")
+        cmd = [
+            sys.executable, "-c",
+            "import sys, app; from werkzeug.serving import run_simple; "
+            "run_simple('127.0.0.1', int(sys.argv[1]), app.app, threaded=True)",
+            str(port),
+        ]
+
+    log = open(work_dir / "app.log", "ab")
+    proc = subprocess.Popen(
+        cmd, cwd=BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+    )
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"app exited during startup, see {work_dir / 'app.log'}")
+        try:
+            urllib.request.urlopen(f"{base}/api/health", timeout=2).read()
+            return proc, base
+        except OSError:
+            time.sleep(0.2)
+    stop_app(proc)
+    raise RuntimeError("app did not start within 60s")
+
+
+def stop_app(proc: subprocess.Popen) -> None:
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=30)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+
+def tree_rss(pid: int) -> int:
+    """Summed RSS (bytes) of a process and its descendants (Linux /proc)."""
+    children: dict[int, list[int]] = {}
+    rss: dict[int, int] = {}
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+            status = (entry / "status").read_text()
+        except OSError:
+            continue
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+        for line in status.splitlines():
+            if line.startswith("VmRSS:"):
+                rss[int(entry.name)] = int(line.split()[1]) * 1024
+    total, stack = 0, [pid]
+    while stack:
+        current = stack.pop()
+        total += rss.get(current, 0)
+        stack.extend(children.get(current, []))
+    return total
+
+
+class RssSampler(threading.Thread):
+    """Samples the app's process tree RSS every 100ms and keeps the peak."""
+
+    def __init__(self, pid: int):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.peak = 0
+        self._done = threading.Event()
+
+    def run(self) -> None:
+        if not Path("/proc").is_dir():
+            return
+        while not self._done.is_set():
+            self.peak = max(self.peak, tree_rss(self.pid))
+            self._done.wait(0.1)
+
+    def stop(self) -> int:
+        self._done.set()
+        self.join()
+        return self.peak
+
+
+# ---------------------------------------------------------
+# CLIENT
+# ---------------------------------------------------------
+
+
+def post_json(url: str, payload: dict, timeout: float) -> tuple[int, dict]:
+    req = urllib.request.Request(
+        url, data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"}
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return resp.status, json.load(resp)
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b"{}")
+
+
+def get_json(url: str, timeout: float) -> dict:
+    with urllib.request.urlopen(url, timeout=timeout) as resp:
+        return json.load(resp)
+
+
+def run_metadata(base: str, media_url: str, timeout: float) -> int:
+    status, body = post_json(f"{base}/api/metadata", {"url": media_url}, timeout)
+    if status != 200 or not body.get("success"):
+        raise RuntimeError(body.get("error") or f"HTTP {status}")
+    return 0
+
+
+def run_download(base: str, media_url: str, kind: str, timeout: float) -> int:
+    """Queue a download, wait for the job and fetch the file; returns its size."""
+    status, body = post_json(f"{base}/api/download", {"url": media_url, "kind": kind}, timeout)
+    if status != 202:
+        raise RuntimeError(body.get("error") or f"HTTP {status}")
+
+    deadline = time.monotonic() + timeout
+    while True:
+        job = get_json(base + body["status_url"], timeout)
+        if job["status"] == "completed":
+            break
+        if job["status"] == "error":
+            raise RuntimeError(job.get("error") or "DOWNLOAD_FAILED")
+        if time.monotonic() > deadline:
+            raise RuntimeError("TIMEOUT")
+        time.sleep(0.05)
+
+    size = 0
+    with urllib.request.urlopen(base + job["download_url"], timeout=timeout) as resp:
+        while chunk := resp.read(256 * 1024):
+            size += len(chunk)
+    return size
+
+
+# ---------------------------------------------------------
+# STATISTICS
+# ---------------------------------------------------------
+
+
+def percentile(values: list[float], pct: float) -> float | None:
+    """Linear-interpolated percentile (pct in 0..100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(name, concurrency, latencies, errors, elapsed, total_bytes, peak_rss) -> dict:
+    ms = [v * 1000 for v in latencies]
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": len(latencies) + len(errors),
+        "errors": len(errors),
+        "error_codes": sorted(set(errors)),
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 3) if elapsed else None,
+        "mb_per_s": round(total_bytes / elapsed / 1e6, 3) if elapsed and total_bytes else None,
+        "latency_ms": {
+            "p50": round(percentile(ms, 50), 1) if ms else None,
+            "p95": round(percentile(ms, 95), 1) if ms else None,
+            "p99": round(percentile(ms, 99), 1) if ms else None,
+            "mean": round(sum(ms) / len(ms), 1) if ms else None,
+            "max": round(max(ms), 1) if ms else None,
+        },
+        "peak_rss_mb": round(peak_rss / 1e6, 1) if peak_rss else None,
+    }
+
+
+def compare(results: list[dict], baseline: dict, max_regression: float) -> bool:
+    """Print p95 / throughput changes against a baseline; False on a regression."""
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline["results"]}
+    ok = True
+    print(f"\nCompared with {baseline['meta'].get('commit') or 'baseline'}:")
+    for r in results:
+        old = previous.get((r["scenario"], r["concurrency"]))
+        if not old or not old["latency_ms"]["p95"] or not r["latency_ms"]["p95"]:
+            continue
+        p95 = r["latency_ms"]["p95"] / old["latency_ms"]["p95"] - 1
+        rps = (r["throughput_rps"] or 0) / (old["throughput_rps"] or 1) - 1
+        regressed = p95 > max_regression or rps < -max_regression
+        ok = ok and not regressed
+        print(
+            f"  {'✗' if regressed else '✓'} {r['scenario']:<14} c={r['concurrency']:<3} "
+            f"p95 {p95:+.0%}  throughput {rps:+.0%}"
+        )
+    return ok
+
+
+# ---------------------------------------------------------
+# MAIN
+# ---------------------------------------------------------
+
+
+def run_level(args, work_dir: Path, origin: str, name: str, concurrency: int) -> dict:
+    endpoint, media_path, kind = SCENARIOS[name]
+    proc, base = start_app(args, work_dir)
+    sampler = RssSampler(proc.pid)
+    sampler.start()
+    latencies: list[float] = []
+    errors: list[str] = []
+    total_bytes = 0
+    lock = threading.Lock()
+
+    def one(n: int) -> None:
+        nonlocal total_bytes
+        media_url = f"{origin}/u/{name}-{concurrency}-{n}/{media_path}"
+        started = time.perf_counter()
+        try:
+            if endpoint == "metadata":
+                size = run_metadata(base, media_url, args.timeout)
+            else:
+                size = run_download(base, media_url, kind, args.timeout)
+        except Exception as e:  # noqa: BLE001
+            with lock:
+                errors.append(str(e)[:80])
+            return
+        with lock:
+            latencies.append(time.perf_counter() - started)
+            total_bytes += size
+
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(one, range(args.requests)))
+        elapsed = time.perf_counter() - started
+    finally:
+        peak = sampler.stop()
+        stop_app(proc)
+
+    return summarize(name, concurrency, latencies, errors, elapsed, total_bytes, peak)
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+            text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--levels", default="1,4,8", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=16, help="requests per level")
+    parser.add_argument("--server", choices=("gunicorn", "werkzeug"), default="gunicorn")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--media-seconds", type=int, default=20, help="length of the test video")
+    parser.add_argument("--origin-rate", type=float, default=0, help="origin bytes/s per connection")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--work-dir", type=Path, default=Path(tempfile.gettempdir()) / "ytdownloadx-bench")
+    parser.add_argument("--save", type=Path, help="write results as JSON")
+    parser.add_argument("--compare", type=Path, help="baseline JSON to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if not shutil.which("ffmpeg"):
+        print("✗ ffmpeg not found on PATH")
+        return 2
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        print(f"✗ Unknown scenarios: {', '.join(unknown)}")
+        return 2
+    levels = [int(level) for level in args.levels.split(",")]
+
+    media_dir = args.work_dir / f"media-{args.media_seconds}s"
+    print(f"Preparing synthetic media in {media_dir} ...")
+    make_media(media_dir, args.media_seconds)
+    origin_server, origin = start_origin(media_dir, args.origin_rate)
+
+    print("=" * 78)
+    print(f"{'scenario':<15}{'conc':>5}{'ok/err':>9}{'req/s':>8}{'MB/s':>8}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'RSS MB':>8}")
+    print("-" * 78)
+    results = []
+    try:
+        for name in scenarios:
+            for concurrency in levels:
+                r = run_level(args, args.work_dir, origin, name, concurrency)
+                results.append(r)
+                lat = r["latency_ms"]
+                print(
+                    f"{name:<15}{concurrency:>5}{r['requests'] - r['errors']:>5}/{r['errors']:<3}"
+                    f"{r['throughput_rps'] or 0:>8.2f}{r['mb_per_s'] or 0:>8.1f}"
+                    f"{lat['p50'] or 0:>9.0f}{lat['p95'] or 0:>9.0f}{lat['p99'] or 0:>9.0f}"
+                    f"{r['peak_rss_mb'] or 0:>8.0f}"
+                )
+                if r["errors"]:
+                    print(f"    errors: {', '.join(r['error_codes'])}")
+    finally:
+        origin_server.shutdown()
+    print("=" * 78)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "server": args.server,
+            "workers": args.workers,
+            "threads": args.threads,
+            "requests_per_level": args.requests,
+            "media_seconds": args.media_seconds,
+            "origin_rate": args.origin_rate,
+        },
+        "results": results,
+    }
+    if args.save:
+        args.save.parent.mkdir(parents=True, exist_ok=True)
+        args.save.write_text(json.dumps(report, indent=2))
+        print(f"Saved results to {args.save}")
+
+    if args.compare:
+        if not compare(results, json.loads(args.compare.read_text()), args.max_regression):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
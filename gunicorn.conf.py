@@ -0,0 +1,40 @@
+"""
+gunicorn settings picked up automatically from the working directory
+(Dockerfile, Procfile and render.yaml pass workers/threads on the command line).
+"""
+
+import os
+import shutil
+import tempfile
+
+# Each worker writes its Prometheus samples here; /metrics sums them up
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "ytdownloadx-metrics")
+)
+
+# Samples of a previous run must not be added to this one. Done here rather
+# than in on_starting because preload_app imports the app (which records
+# metrics) before that hook runs; the marker keeps a config reload (HUP) from
+# wiping the running workers' samples.
+if not os.environ.get("YTDOWNLOADX_METRICS_RESET"):
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.environ["YTDOWNLOADX_METRICS_RESET"] = "1"
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+# Import the app once in the master: yt-dlp imports, the extractor regexes and
+# the pre-built yt-dlp contexts (app.warm_up) are shared with every forked
+# worker, so booting or recycling a worker costs milliseconds instead of seconds.
+preload_app = True
+
+
+def post_fork(server, worker):
+    # threads started in the master would not survive the fork
+    from app import start_worker
+
+    start_worker()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
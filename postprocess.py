@@ -0,0 +1,69 @@
+"""
+ffmpeg steps of a download, run by the postprocess worker processes
+(see POSTPROCESS STAGE in app.py).
+
+The workers are spawned, so this module is all they import: it must not
+import app.py, whose import warms up yt-dlp, reconciles the download manifest
+and starts background threads. Each function takes and returns plain data.
+"""
+
+import logging
+import time
+from pathlib import Path
+
+import yt_dlp
+from yt_dlp.postprocessor import FFmpegExtractAudioPP, FFmpegVideoConvertorPP, FFmpegVideoRemuxerPP
+
+logger = logging.getLogger("ytdownloadx.postprocess")
+
+_YDL: yt_dlp.YoutubeDL | None = None
+
+
+def _ydl(pp_args: dict) -> yt_dlp.YoutubeDL:
+    """The YoutubeDL hosting this process's postprocessors (no extraction happens here)."""
+    global _YDL
+    if _YDL is None:
+        _YDL = yt_dlp.YoutubeDL({"quiet": True, "no_warnings": True, "noprogress": True})
+    _YDL.params["postprocessor_args"] = pp_args
+    return _YDL
+
+
+def extract_audio(path: str, codec: str, quality: str, pp_args: dict) -> dict:
+    """Convert a downloaded audio stream (FFmpegExtractAudio); the source file is removed."""
+    ydl = _ydl(pp_args)
+    started = time.perf_counter()
+    info = {"filepath": path, "ext": Path(path).suffix.lstrip(".")}
+    info = ydl.run_pp(FFmpegExtractAudioPP(ydl, preferredcodec=codec, preferredquality=quality), info)
+    return {
+        "path": info["filepath"],
+        "pipeline": "audio",
+        "timings": {"ExtractAudio": round(time.perf_counter() - started, 3)},
+    }
+
+
+def to_mp4(path: str, steps: list[str], pp_args: dict) -> dict:
+    """
+    Bring a video into mp4 with the first of `steps` ("remux", "transcode")
+    that produces one. pipeline is "failed" (and path the input) otherwise.
+    """
+    ydl = _ydl(pp_args)
+    file_path = Path(path)
+    timings: dict = {}
+
+    for step in steps:
+        pp_class = FFmpegVideoRemuxerPP if step == "remux" else FFmpegVideoConvertorPP
+        info = {"filepath": str(file_path), "ext": file_path.suffix.lstrip(".")}
+
+        started = time.perf_counter()
+        try:
+            info = ydl.run_pp(pp_class(ydl, preferedformat="mp4"), info)
+        except (yt_dlp.utils.PostProcessingError, yt_dlp.utils.DownloadError) as e:
+            logger.warning("ffmpeg %s error: %s", step, e)
+        timings[step] = round(time.perf_counter() - started, 3)
+
+        result = Path(info.get("filepath") or file_path)
+        if result.suffix.lower() == ".mp4" and result.exists():
+            return {"path": str(result), "pipeline": step, "timings": timings}
+        logger.warning("%s to mp4 failed for %s", step, file_path)
+
+    return {"path": str(file_path), "pipeline": "failed", "timings": timings}
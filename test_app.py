@@ -88,18 +88,1710 @@ def test_format_selector():
             print("✗ MP3 format selector incorrect")
             return False
         
-        # Test MP4 format (should be 360p)
-        mp4_format = app.get_format_selector('mp4')
-        if '360' not in mp4_format:
-            print("✗ MP4 format selector not set to 360p")
-            return False
+        # Test MP4 format: best video + audio, merged into mp4
+        expected = {
+            ('mp4', None, False): 'bestvideo*+bestaudio/best',
+            ('mp4', 'best', False): 'bestvideo*+bestaudio/best',
+            ('mp4', '137', False): '137+bestaudio[ext=m4a]/137+bestaudio/best',
+            # simple mode never merges
+            ('mp4', None, True): 'best[height<=1080][ext=mp4]/best[height<=1080]/best',
+            ('mp4', '137', True): '137',
+            ('m4a', None, False): 'bestaudio[ext=m4a]/bestaudio/best',
+        }
+        for (kind, format_id, simple), selector in expected.items():
+            got = app.get_format_selector(kind, format_id, simple=simple)
+            if got != selector:
+                print(f"✗ {kind} selector (format_id={format_id}, simple={simple}) is {got!r}")
+                return False
         
-        print("✓ Format selectors are correct (360p for video, best audio for MP3)")
+        print("✓ Format selectors are correct (best video + audio for MP4, best audio for MP3)")
         return True
     except Exception as e:
         print(f"✗ Format selector test failed: {e}")
         return False
 
+def test_job_progress():
+    """Test that progress_hook updates a job and /api/status reports it"""
+    try:
+        import app
+
+        job = app.create_job('https://example.com/watch?v=test', 'mp4', 'best')
+        job_id = job['job_id']
+        app.progress_hook(job_id, {
+            'status': 'downloading',
+            'downloaded_bytes': 50,
+            'total_bytes': 100,
+        })
+
+        client = app.app.test_client()
+        resp = client.get(f'/api/status/{job_id}')
+        data = resp.get_json()
+        if resp.status_code != 200 or data['status'] != 'downloading' or data['progress'] != 50.0:
+            print(f"✗ Unexpected job status: {data}")
+            return False
+
+        if client.get('/api/status/does-not-exist').status_code != 404:
+            print("✗ Unknown job should return 404")
+            return False
+
+        print("✓ Job progress is tracked and exposed via /api/status")
+        return True
+    except Exception as e:
+        print(f"✗ Job progress test failed: {e}")
+        return False
+
+def test_metadata_cache():
+    """Test TTL/LRU metadata cache with single-flight loading"""
+    try:
+        import threading
+        import time
+        import app
+
+        if app.canonical_media_key('https://youtu.be/dQw4w9WgXcQ?si=x') != \
+                app.canonical_media_key('https://www.youtube.com/watch?v=dQw4w9WgXcQ'):
+            print("✗ Equivalent URLs should share a cache key")
+            return False
+
+        cache = app.MetadataCache(ttl=60, max_entries=2)
+        calls = []
+
+        def slow_loader():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'title': 'x'}
+
+        threads = [
+            threading.Thread(target=cache.get_or_load, args=('k', slow_loader))
+            for _ in range(5)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if len(calls) != 1:
+            print(f"✗ Concurrent loads were not coalesced ({len(calls)} extractions)")
+            return False
+
+        cache.get_or_load('a', lambda: {})
+        cache.get_or_load('b', lambda: {})
+        if cache.stats()['entries'] != 2:
+            print("✗ LRU size bound not enforced")
+            return False
+
+        print("✓ Metadata cache coalesces concurrent loads and stays bounded")
+        return True
+    except Exception as e:
+        print(f"✗ Metadata cache test failed: {e}")
+        return False
+
+def test_playlist_pagination():
+    """Test that flat playlist metadata is paginated"""
+    try:
+        import app
+
+        info = {
+            '_type': 'playlist',
+            'id': 'PLtest',
+            'title': 'Test playlist',
+            'entries': [
+                {'id': f'vid{i}', 'title': f'Video {i}', 'url': f'https://youtu.be/vid{i}'}
+                for i in range(120)
+            ],
+        }
+        payload = app.build_metadata_response(info)
+        if payload['formats_url'] != 'https://youtu.be/vid0':
+            print("✗ Playlist should point at its first video for formats")
+            return False
+
+        page = app.paginate_playlist(payload, offset=100, limit=50)['playlist']
+        if len(page['videos']) != 20 or page['next_offset'] is not None or page['video_count'] != 120:
+            print(f"✗ Unexpected last page: {len(page['videos'])} videos, next={page['next_offset']}")
+            return False
+
+        first = app.paginate_playlist(payload, offset=0, limit=50)['playlist']
+        if first['next_offset'] != 50 or first['videos'][0]['id'] != 'vid0':
+            print("✗ Unexpected first page")
+            return False
+
+        print("✓ Playlist metadata is paginated")
+        return True
+    except Exception as e:
+        print(f"✗ Playlist pagination test failed: {e}")
+        return False
+
+def test_metadata_views():
+    """Test compact metadata, field projection, ETags and compression"""
+    try:
+        import gzip
+        import app
+
+        formats = [
+            {'format_id': str(100 + i), 'ext': 'mp4', 'vcodec': 'avc1.64001F', 'acodec': 'none',
+             'height': 720, 'fps': 30, 'tbr': 1000 + i}
+            for i in range(20)
+        ] + [{'format_id': '140', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a.40.2', 'tbr': 128}]
+        info = {'id': 'viewTest01', 'title': 'View test', 'duration': 100, 'formats': formats}
+        url = 'https://www.youtube.com/watch?v=viewTest01'
+
+        fetch = app.fetch_metadata
+        app.fetch_metadata = lambda u: app.build_metadata_response(info)
+        try:
+            client = app.app.test_client()
+            full = client.get('/api/metadata', query_string={'url': url})
+            compact = client.get('/api/metadata', query_string={'url': url, 'view': 'compact'})
+            video = compact.get_json()['video']
+            if 'formats' in video or [r['format_id'] for r in video['ladder']['video']] != ['119']:
+                print(f"✗ Expected one deduplicated 720p rung, got {video.get('ladder')}")
+                return False
+            if len(compact.data) * 4 > len(full.data):
+                print(f"✗ Compact response is not much smaller ({len(compact.data)} vs {len(full.data)} bytes)")
+                return False
+
+            etag = compact.headers['ETag']
+            cached = client.get('/api/metadata', query_string={'url': url, 'view': 'compact'},
+                                headers={'If-None-Match': etag})
+            if cached.status_code != 304 or 'public' not in compact.headers['Cache-Control']:
+                print(f"✗ Expected a cacheable response and 304, got {cached.status_code}")
+                return False
+
+            zipped = client.get('/api/metadata', query_string={'url': url},
+                                headers={'Accept-Encoding': 'gzip'})
+            if (zipped.headers.get('Content-Encoding') != 'gzip'
+                    or gzip.decompress(zipped.data) != full.data
+                    or zipped.headers['ETag'] == full.headers['ETag']):
+                print("✗ Expected a gzip response with its own ETag")
+                return False
+
+            projected = client.post('/api/metadata', json={'url': url, 'fields': ['title']})
+            if projected.get_json()['video'] != {'title': 'View test'}:
+                print(f"✗ Unexpected projection: {projected.get_json()['video']}")
+                return False
+            if client.get('/api/metadata', query_string={'url': url, 'view': 'tiny'}).status_code != 400:
+                print("✗ Unknown views should be rejected")
+                return False
+        finally:
+            app.fetch_metadata = fetch
+
+        print("✓ Metadata has a compact view, projection, ETags and compression")
+        return True
+    except Exception as e:
+        print(f"✗ Metadata views test failed: {e}")
+        return False
+
+def test_metadata_batch():
+    """Test batch metadata: concurrent, deduplicated, streamed NDJSON with per-item errors"""
+    try:
+        import json
+        import threading
+        import time
+        import uuid
+        import app
+
+        ids = [uuid.uuid4().hex[:11] for _ in range(3)]  # fresh ids, so nothing is cached
+        slow, fast, bad = [f'https://www.youtube.com/watch?v={i}' for i in ids]
+        calls = []
+        lock = threading.Lock()
+
+        def fake_fetch(url):
+            with lock:
+                calls.append(url)
+            if url == bad:
+                raise RuntimeError('Video unavailable')
+            time.sleep(0.6 if url == slow else 0.05)
+            return app.build_metadata_response({'id': url[-11:], 'title': url[-11:], 'formats': []})
+
+        fetch = app.fetch_metadata
+        app.fetch_metadata = fake_fetch
+        try:
+            client = app.app.test_client()
+            env = {'REMOTE_ADDR': '203.0.113.22'}
+            urls = [slow, fast, bad, f'https://youtu.be/{ids[1]}']  # the last one repeats `fast`
+            started = time.time()
+            resp = client.post('/api/metadata/batch', json={'urls': urls, 'fields': ['title']}, environ_base=env)
+            lines = [json.loads(line) for line in resp.data.decode().splitlines()]
+            elapsed = time.time() - started
+        finally:
+            app.fetch_metadata = fetch
+
+        if resp.mimetype != 'application/x-ndjson' or sorted(item['index'] for item in lines) != [0, 1, 2, 3]:
+            print(f"✗ Expected one NDJSON line per URL, got {lines}")
+            return False
+        if len(calls) != 3 or elapsed > 1.0:
+            print(f"✗ Expected 3 concurrent extractions, got {len(calls)} in {elapsed:.2f}s")
+            return False
+        if lines[-1]['index'] != 0:
+            print("✗ Results should stream in completion order")
+            return False
+        by_index = {item['index']: item for item in lines}
+        if by_index[2].get('error') != 'METADATA_FAILED' or by_index[3]['video'] != {'title': ids[1]}:
+            print(f"✗ Unexpected items: {by_index}")
+            return False
+
+        too_many = client.post('/api/metadata/batch', json={'urls': ['x'] * (app.METADATA_BATCH_MAX + 1)},
+                               environ_base=env)
+        if too_many.status_code != 400 or client.post('/api/metadata/batch', json={},
+                                                      environ_base=env).status_code != 400:
+            print("✗ Oversized or empty batches should be rejected")
+            return False
+
+        print("✓ Batch metadata resolves URLs concurrently and streams NDJSON")
+        return True
+    except Exception as e:
+        print(f"✗ Metadata batch test failed: {e}")
+        return False
+
+def test_two_phase_metadata():
+    """Test that phase=basic answers from a light extraction and delivers formats later"""
+    try:
+        import time
+        import uuid
+        import app
+
+        ids = [uuid.uuid4().hex[:11] for _ in range(2)]
+        good, bad = [f'https://www.youtube.com/watch?v={i}' for i in ids]
+        formats = [{'format_id': '18', 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'mp4a', 'height': 360, 'tbr': 500}]
+
+        def fake_basic(url):
+            return {'id': url[-11:], 'title': 'Quick', 'thumbnail': None, 'duration': 60, 'uploader': 'Someone'}
+
+        def fake_fetch(url):
+            time.sleep(0.5)
+            if url == bad:
+                raise RuntimeError('Sign in to confirm your age')
+            return app.build_metadata_response({'id': url[-11:], 'title': 'Quick', 'duration': 60, 'formats': formats})
+
+        basic, fetch = app.fetch_basic_metadata, app.fetch_metadata
+        app.fetch_basic_metadata, app.fetch_metadata = fake_basic, fake_fetch
+        try:
+            client = app.app.test_client()
+            env = {'REMOTE_ADDR': '203.0.113.24'}
+            started = time.time()
+            resp = client.get('/api/metadata', query_string={'url': good, 'phase': 'basic', 'view': 'compact'},
+                              environ_base=env)
+            body = resp.get_json()
+            if time.time() - started > 0.3 or not body.get('formats_pending') or body['video']['title'] != 'Quick':
+                print(f"✗ Expected an immediate basic response, got {body}")
+                return False
+            if resp.headers.get('Cache-Control') != 'no-store':
+                print("✗ A basic response must not be cached")
+                return False
+            if client.get(body['formats_url']).status_code != 202:
+                print("✗ Formats should be pending right after the basic response")
+                return False
+
+            events = client.get(body['events_url']).data.decode()
+            if 'event: formats' not in events or '"ladder"' not in events:
+                print(f"✗ Expected a formats event with the full response, got {events!r}")
+                return False
+            full = client.get(body['formats_url'])
+            if full.status_code != 200 or full.get_json()['video']['ladder']['video'][0]['format_id'] != '18':
+                print(f"✗ Polling should return the full response once ready, got {full.status_code}")
+                return False
+            again = client.get('/api/metadata', query_string={'url': good, 'phase': 'basic'}, environ_base=env)
+            if 'phase' in again.get_json() or again.headers.get('X-Cache') != 'HIT':
+                print("✗ Cached metadata should be answered in full at once")
+                return False
+
+            failed = client.get('/api/metadata', query_string={'url': bad, 'phase': 'basic'}, environ_base=env).get_json()
+            events = client.get(failed['events_url']).data.decode()
+            if 'event: error' not in events or 'confirm your age' not in events:
+                print(f"✗ Expected an error event for a failed formats phase, got {events!r}")
+                return False
+        finally:
+            app.fetch_basic_metadata, app.fetch_metadata = basic, fetch
+
+        if client.get('/api/metadata', query_string={'url': good, 'phase': 'soon'}, environ_base=env).status_code != 400:
+            print("✗ Unknown phases should be rejected")
+            return False
+        if client.get('/api/metadata/formats/unknown-request').status_code != 404:
+            print("✗ Unknown request ids should give 404")
+            return False
+
+        print("✓ Basic metadata comes first; formats follow over SSE or polling")
+        return True
+    except Exception as e:
+        print(f"✗ Two-phase metadata test failed: {e}")
+        return False
+
+def test_image_service():
+    """Test local thumbnails (resized WebP) and QR codes from the image cache"""
+    try:
+        import io
+        import tempfile
+        import threading
+        import time
+        import app
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from pathlib import Path
+        from PIL import Image
+
+        source = io.BytesIO()
+        Image.new('RGB', (1280, 720), (200, 30, 30)).save(source, 'JPEG')
+        fetched = []
+
+        class Origin(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fetched.append(self.path)
+                if self.path.startswith('/broken/'):
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                time.sleep(0.2)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.end_headers()
+                self.wfile.write(source.getvalue())
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Origin)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        saved = app.IMAGE_CACHE
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                app.IMAGE_CACHE = app.ImageCache(Path(tmp), 10 * 1024 * 1024)
+                client = app.app.test_client()
+
+                src = f'http://127.0.0.1:{server.server_port}/vi/abc/maxresdefault.jpg'
+                url = app.build_metadata_response({'id': 'abc', 'thumbnail': src, 'formats': []})['video']['thumbnail']
+                if not url.startswith('/img/thumb/') or not url.endswith('/640.webp'):
+                    print(f"✗ Metadata thumbnail not rewritten: {url}")
+                    return False
+                small = client.get(url.replace('/640.webp', '/160.webp'))
+                large = client.get(url)
+                if small.status_code != 200 or small.mimetype != 'image/webp' or len(fetched) != 1:
+                    print(f"✗ Thumbnail not served from one fetch: {small.status_code}, {fetched}")
+                    return False
+                if Image.open(io.BytesIO(small.data)).size != (160, 90) or len(large.data) <= len(small.data):
+                    print("✗ Thumbnail widths are wrong")
+                    return False
+                if 'immutable' not in small.headers['Cache-Control']:
+                    print("✗ Thumbnails should be cacheable for good")
+                    return False
+                if client.get('/img/thumb/0123456789abcdef0123/320.webp').status_code != 404 \
+                        or client.get(url.replace('/640.webp', '/333.webp')).status_code != 404:
+                    print("✗ Unknown thumbnails / widths should be 404")
+                    return False
+
+                # concurrent requests for a new source share one fetch
+                base = f'http://127.0.0.1:{server.server_port}'
+                url = app.build_metadata_response({'id': 'def', 'thumbnail': base + '/vi/def/0.jpg',
+                                                   'formats': []})['video']['thumbnail']
+                fetched.clear()
+                codes = []
+                def fetch_thumbnail(width):
+                    with app.app.test_client() as c:
+                        codes.append(c.get(url.replace('/640.webp', f'/{width}.webp')).status_code)
+                workers = [threading.Thread(target=fetch_thumbnail, args=(w,)) for w in (160, 320, 640, 640) * 2]
+                for t in workers:
+                    t.start()
+                for t in workers:
+                    t.join()
+                if codes != [200] * 8 or len(fetched) != 1 or app._THUMBNAIL_LOCKS:
+                    print(f"✗ Concurrent thumbnails should share one fetch: {codes}, {fetched}")
+                    return False
+
+                # a failed source is remembered for a while instead of refetched
+                url = app.build_metadata_response({'id': 'bad', 'thumbnail': base + '/broken/bad.jpg',
+                                                   'formats': []})['video']['thumbnail']
+                fetched.clear()
+                if client.get(url).status_code != 502 or client.get(url).status_code != 502 or len(fetched) != 1:
+                    print(f"✗ Failed thumbnail fetches should be cached briefly: {fetched}")
+                    return False
+
+                png = app.generate_qr_code('https://example.com/files/x')
+                svg = app.generate_qr_code('https://example.com/files/x', 'svg')
+                if not png.startswith(b'\x89PNG') or b'<svg' not in svg:
+                    print("✗ generate_qr_code should return PNG / SVG bytes")
+                    return False
+                if client.get('/img/qr/' + 'b' * 32 + '.png').status_code != 404:
+                    print("✗ QR codes of unknown downloads should be 404")
+                    return False
+                media = Path(tmp) / ('a' * 32 + '_clip.mp4')
+                media.write_bytes(b'x')
+                app.DOWNLOAD_MANIFEST.add('a' * 32, media, title='clip', filename='clip.mp4')
+                saved_base = app.PUBLIC_BASE_URL
+                try:
+                    app.PUBLIC_BASE_URL = 'https://dl.example.com'
+                    qr = client.get('/img/qr/' + 'a' * 32 + '.png', base_url='https://evil.example')
+                    again = client.get('/img/qr/' + 'a' * 32 + '.png',
+                                       headers={'If-None-Match': qr.headers['ETag']})
+                finally:
+                    app.PUBLIC_BASE_URL = saved_base
+                    app.DOWNLOAD_MANIFEST.remove('a' * 32)
+                if qr.status_code != 200 or qr.mimetype != 'image/png' or again.status_code != 304:
+                    print(f"✗ QR route: {qr.status_code}, revalidation {again.status_code}")
+                    return False
+                if qr.data != app.generate_qr_code('https://dl.example.com/files/' + 'a' * 32):
+                    print("✗ QR code should link to PUBLIC_BASE_URL, not the request host")
+                    return False
+
+                # least recently used images go first
+                cache = app.ImageCache(Path(tmp) / 'bounded', 2500)
+                for name in ('a', 'b', 'c'):
+                    cache.put(name, b'x' * 1000)
+                    time.sleep(0.01)
+                if cache.get('a') is not None or cache.get('c') is None:
+                    print("✗ Image cache not bounded to its size")
+                    return False
+        finally:
+            app.IMAGE_CACHE = saved
+            server.shutdown()
+
+        print("✓ Thumbnails and QR codes are made locally and cached on disk")
+        return True
+    except Exception as e:
+        print(f"✗ Image service test failed: {e}")
+        return False
+
+def test_download_cache():
+    """Test that repeated downloads are served from the download cache"""
+    try:
+        import app
+
+        url = 'https://www.youtube.com/watch?v=cacheTest01'
+        selector = app.get_format_selector('mp4', 'best')
+        key = app.download_cache_key(url, 'mp4', selector)
+        if key != app.download_cache_key('https://youtu.be/cacheTest01', 'mp4', selector):
+            print("✗ Same video should map to the same cache key")
+            return False
+
+        cached_file = app.DOWNLOAD_DIR / 'cachetest_Cached video.mp4'
+        cached_file.write_bytes(b'data')
+        try:
+            app.DOWNLOAD_MANIFEST.add(
+                'cachetest', cached_file, cache_key=key,
+                title='Cached video', filename='Cached video.mp4',
+            )
+            job = app.enqueue_download(url, 'mp4', 'best')
+            if job['status'] != 'completed' or not job['cached']:
+                print(f"✗ Cache hit did not complete the job: {job['status']}")
+                return False
+
+            # a request for a download that is already running joins it
+            app.DOWNLOAD_MANIFEST.remove('cachetest')
+            app.DOWNLOAD_INFLIGHT[key] = ['leader-job']
+            follower = app.enqueue_download(url, 'mp4', 'best')
+            if app.DOWNLOAD_INFLIGHT.pop(key) != ['leader-job', follower['job_id']]:
+                print("✗ Concurrent identical download was not coalesced")
+                return False
+        finally:
+            app.DOWNLOAD_MANIFEST.remove('cachetest')
+            cached_file.unlink(missing_ok=True)
+
+        print("✓ Download cache serves hits and coalesces running downloads")
+        return True
+    except Exception as e:
+        print(f"✗ Download cache test failed: {e}")
+        return False
+
+def test_clip_downloads():
+    """Test that clip requests are validated, cached separately and fetch only the clip"""
+    try:
+        import re
+        import shutil
+        import subprocess
+        import tempfile
+        import threading
+        import time
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from pathlib import Path
+        import app
+
+        if app.parse_clip({'start': '1:00', 'end': 75}) != {'start': 60.0, 'end': 75.0}:
+            print("✗ start/end should accept seconds and [HH:]MM:SS")
+            return False
+        if app.parse_clip({}) is not None or app.parse_clip({'chapter': ' Intro '}) != {'chapter': 'Intro'}:
+            print("✗ Unexpected clip for a full or chapter download")
+            return False
+        for bad in ({'start': 10, 'end': 5}, {'start': -1}, {'start': 'soon'}, {'chapter': 'x', 'end': 5}):
+            try:
+                app.parse_clip(bad)
+                print(f"✗ Invalid clip accepted: {bad}")
+                return False
+            except ValueError:
+                pass
+
+        url = 'https://www.youtube.com/watch?v=clipTest001'
+        selector = app.get_format_selector('mp4', 'best')
+        full = app.download_cache_key(url, 'mp4', selector)
+        clip = app.download_cache_key(url, 'mp4', selector, {'start': 60.0, 'end': 75.0})
+        if clip == full or clip != app.download_cache_key(url, 'mp4', selector, app.parse_clip({'start': '1:00', 'end': '1:15'})):
+            print("✗ A clip needs its own cache key, shared by equivalent requests")
+            return False
+
+        client = app.app.test_client()
+        resp = client.post('/api/download', json={'url': url, 'start': 30, 'end': 10},
+                           environ_base={'REMOTE_ADDR': '203.0.113.23'})
+        if resp.status_code != 400 or resp.get_json()['error'] != 'INVALID_CLIP':
+            print(f"✗ Expected 400 INVALID_CLIP, got {resp.status_code}")
+            return False
+
+        if shutil.which('ffmpeg'):
+            media = Path(tempfile.mkdtemp()) / 'long.mp4'
+            subprocess.run(
+                ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc=size=320x180:rate=25:duration=60',
+                 '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '25', '-movflags', '+faststart', str(media)],
+                check=True,
+            )
+            data = media.read_bytes()
+            offsets = []
+
+            class Origin(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    match = re.match(r'bytes=(\d+)-', self.headers.get('Range') or '')
+                    start = int(match.group(1)) if match else 0
+                    offsets.append(start)
+                    self.send_response(206 if match else 200)
+                    if match:
+                        self.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+                    self.send_header('Accept-Ranges', 'bytes')
+                    self.send_header('Content-Type', 'video/mp4')
+                    self.send_header('Content-Length', str(len(data) - start))
+                    self.end_headers()
+                    try:
+                        self.wfile.write(data[start:])
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+
+                def log_message(self, *args):
+                    pass
+
+            server = ThreadingHTTPServer(('127.0.0.1', 0), Origin)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                source = f'http://127.0.0.1:{server.server_port}/long.mp4?run={time.time()}'
+                job = app.enqueue_download(source, 'mp4', 'best', clip={'start': 40.0, 'end': 42.0})
+                deadline = time.time() + 120
+                while job['status'] not in app.JOB_FINAL_STATES and time.time() < deadline:
+                    time.sleep(0.2)
+                    job = app.get_job(job['job_id'])
+            finally:
+                server.shutdown()
+
+            if job['status'] != 'completed':
+                print(f"✗ Clip download did not complete: {job.get('message')}")
+                return False
+            probe = subprocess.run(['ffmpeg', '-i', job['file_path']], capture_output=True, text=True).stderr
+            hours, minutes, seconds = re.search(r'Duration: (\d+):(\d+):([\d.]+)', probe).groups()
+            if not 1.5 <= float(seconds) + 60 * int(minutes) <= 3 or '0m40s-0m42s' not in job['filename']:
+                print(f"✗ Expected a ~2 s clip, got {seconds}s ({job['filename']})")
+                return False
+            if max(offsets) < len(data) // 2:
+                print(f"✗ ffmpeg should seek into the source, requested offsets {offsets}")
+                return False
+
+        print("✓ Clip downloads fetch only the requested range under their own cache key")
+        return True
+    except Exception as e:
+        print(f"✗ Clip download test failed: {e}")
+        return False
+
+def test_mp4_pipeline():
+    """Test that video post-processing prefers remuxing over transcoding"""
+    try:
+        from pathlib import Path
+        import app
+
+        merged = {'requested_formats': [
+            {'vcodec': 'vp09.00.40.08', 'acodec': 'none'},
+            {'vcodec': 'none', 'acodec': 'opus'},
+        ]}
+        checks = [
+            (app.plan_mp4_pipeline({'vcodec': 'avc1.64001F', 'acodec': 'mp4a.40.2'}, Path('a.mp4')), 'none'),
+            (app.plan_mp4_pipeline(merged, Path('a.mkv')), 'remux'),
+            (app.plan_mp4_pipeline({'vcodec': 'flv1', 'acodec': 'mp3'}, Path('a.flv')), 'transcode'),
+        ]
+        for got, expected in checks:
+            if got != expected:
+                print(f"✗ Expected {expected} pipeline, got {got}")
+                return False
+
+        opts, _ = app.get_ydl_opts_enhanced(download=True, format_id='137')
+        if 'postprocessors' in opts or opts.get('merge_output_format') != 'mp4/mkv':
+            print("✗ Video downloads should merge to mp4 without a convertor postprocessor")
+            return False
+
+        print("✓ MP4 pipeline remuxes when possible and transcodes as a last resort")
+        return True
+    except Exception as e:
+        print(f"✗ MP4 pipeline test failed: {e}")
+        return False
+
+def test_streamable_formats():
+    """Test which downloads can be streamed while still in progress"""
+    try:
+        import app
+
+        progressive = {'ext': 'mp4', 'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2'}
+        merged = {'ext': 'mp4', 'requested_formats': [{}, {}]}
+        webm = {'ext': 'webm', 'vcodec': 'vp9', 'acodec': 'opus'}
+
+        checks = [
+            (app.is_streamable(progressive, 'mp4'), True),
+            (app.is_streamable(merged, 'mp4'), False),
+            (app.is_streamable(webm, 'mp4'), False),
+            (app.is_streamable({'ext': 'm4a', 'vcodec': 'none'}, 'm4a'), True),
+            (app.is_streamable({'ext': 'm4a', 'vcodec': 'none'}, 'mp3'), False),
+            (app.is_streamable({'_type': 'playlist'}, 'm4a'), False),
+        ]
+        if any(got != expected for got, expected in checks):
+            print(f"✗ Unexpected streamable decisions: {[got for got, _ in checks]}")
+            return False
+
+        print("✓ Only single-stream downloads without ffmpeg are streamed")
+        return True
+    except Exception as e:
+        print(f"✗ Streamable format test failed: {e}")
+        return False
+
+def test_playlist_zip():
+    """Test that a playlist batch is streamed as a stored ZIP with a manifest"""
+    try:
+        import io
+        import json
+        import zipfile
+        import app
+
+        url = 'https://www.youtube.com/watch?v=zipTest0001'
+        key = app.download_cache_key(url, 'mp4', app.get_format_selector('mp4', 'best'))
+        cached_file = app.DOWNLOAD_DIR / 'ziptest_Zip video.mp4'
+        cached_file.write_bytes(b'0123456789' * 1000)
+        app.DOWNLOAD_MANIFEST.add(
+            'ziptest', cached_file, cache_key=key,
+            title='Zip video', filename='Zip video.mp4',
+        )
+        try:
+            client = app.app.test_client()
+            resp = client.post('/api/playlist/download', json={'entries': [{'url': url}]})
+            if resp.status_code != 201:
+                print(f"✗ Batch was not created: {resp.status_code}")
+                return False
+
+            zip_url = resp.get_json()['zip_url']
+            # past BATCH_ZIP_LIMIT streams a worker answers 503 without using up the batch
+            saved_limit = app.BATCH_ZIP_INFLIGHT.limit
+            app.BATCH_ZIP_INFLIGHT.limit = 0
+            try:
+                busy = client.get(zip_url)
+            finally:
+                app.BATCH_ZIP_INFLIGHT.limit = saved_limit
+            if busy.status_code != 503 or 'Retry-After' not in busy.headers:
+                print(f"✗ Batch ZIPs past the limit should be 503: {busy.status_code}")
+                return False
+            zipped = client.get(zip_url)
+            archive = zipfile.ZipFile(io.BytesIO(zipped.data))
+            zipped.close()
+            if app.BATCH_ZIP_INFLIGHT.current != 0:
+                print("✗ A finished batch ZIP should give its slot back")
+                return False
+            names = archive.namelist()
+            manifest = json.loads(archive.read('manifest.json'))
+            if names != ['001 - Zip video.mp4', 'manifest.json'] or manifest['completed'] != 1:
+                print(f"✗ Unexpected archive contents: {names}")
+                return False
+            if archive.getinfo(names[0]).compress_type != zipfile.ZIP_STORED:
+                print("✗ Media files should be stored, not deflated")
+                return False
+            if client.get(zip_url).status_code != 410:
+                print("✗ A batch ZIP should only be streamed once")
+                return False
+            bad = client.post('/api/playlist/download', json={'entries': [{'url': url}], 'kind': 'exe'})
+            if bad.status_code != 400 or bad.get_json()['error'] != 'INVALID_KIND':
+                print(f"✗ Unknown kinds should be refused: {bad.status_code}")
+                return False
+
+            # every entry costs a rate limit token
+            saved = app.RATE_LIMITER
+            app.RATE_LIMITER = app.TokenBucket(app.STATE_STORE, 1, 3)
+            env = {'REMOTE_ADDR': '203.0.113.25'}
+            app.STATE_STORE.delete('ratelimit', 'ip:203.0.113.25')
+            try:
+                two = {'entries': [{'url': url}, {'url': url + 'x'}]}
+                first = client.post('/api/playlist/download', json=two, environ_base=env)
+                second = client.post('/api/playlist/download', json=two, environ_base=env)
+            finally:
+                app.RATE_LIMITER = saved
+            if first.status_code != 201 or second.status_code != 429:
+                print(f"✗ Batches should be charged per entry: {first.status_code}, {second.status_code}")
+                return False
+        finally:
+            app.DOWNLOAD_MANIFEST.remove('ziptest')
+            cached_file.unlink(missing_ok=True)
+
+        print("✓ Playlist batches stream as a stored ZIP with a manifest")
+        return True
+    except Exception as e:
+        print(f"✗ Playlist ZIP test failed: {e}")
+        return False
+
+def test_download_manifest():
+    """Test that the download manifest expires and evicts least recently used files"""
+    try:
+        import tempfile
+        import time
+        import app
+        from pathlib import Path
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            manifest = app.DownloadManifest(tmp / 'manifest.sqlite3', quota_bytes=250)
+            files = {}
+            for name in ('a', 'b', 'c'):
+                files[name] = tmp / f'{name}_video.mp4'
+                files[name].write_bytes(b'x' * 100)
+            manifest.add('a', files['a'])
+            time.sleep(0.01)
+            manifest.add('b', files['b'])
+            time.sleep(0.01)
+            manifest.get('a')  # a is now more recently used than b
+            manifest.add('c', files['c'])
+
+            if files['b'].exists() or manifest.get('b') is not None:
+                print("✗ Quota should evict the least recently used file")
+                return False
+            if not files['a'].exists() or manifest.stats()['bytes'] != 200:
+                print(f"✗ Unexpected manifest state: {manifest.stats()}")
+                return False
+
+            manifest.expire(0)
+            if manifest.stats()['files'] != 0 or files['a'].exists():
+                print("✗ Expired files should be deleted")
+                return False
+
+            # leased files, running jobs and the new entry are never evicted
+            for name in ('a', 'b', 'c'):
+                files[name].write_bytes(b'x' * 100)
+            manifest.add('a', files['a'])
+            manifest.add('b', files['b'])
+            with manifest.held(files['a']):
+                manifest.add('c', files['c'], busy=lambda: {'b'})
+            if not all(files[name].exists() for name in ('a', 'b', 'c')):
+                print("✗ Files in use should survive the quota")
+                return False
+            manifest.enforce_quota()
+            if files['a'].exists() or not files['c'].exists():
+                print("✗ Released files should be evicted again")
+                return False
+
+            # one file over the whole quota is refused instead of evicting itself
+            big = tmp / 'd_video.mp4'
+            big.write_bytes(b'x' * 300)
+            try:
+                manifest.add('d', big)
+                print("✗ A file larger than the quota should be refused")
+                return False
+            except app.QuotaExceeded:
+                pass
+            if manifest.get('d') is not None or not files['c'].exists():
+                print("✗ A refused file should not touch the manifest")
+                return False
+
+        # ... and its job fails with a clear error rather than a missing file
+        job = app.create_job('https://example.com/watch?v=quotaTest01', 'mp4', 'best')
+        app.update_job(job['job_id'], download_id='quotatest')
+        big = app.DOWNLOAD_DIR / 'quotatest_Big video.mp4'
+        big.write_bytes(b'x' * 300)
+        saved = app.DOWNLOAD_MANIFEST.quota_bytes
+        app.DOWNLOAD_MANIFEST.quota_bytes = 250
+        try:
+            app.complete_download(job['job_id'], 'Big video', big, 'direct', 'enhanced', {}, time.perf_counter())
+        finally:
+            app.DOWNLOAD_MANIFEST.quota_bytes = saved
+            big.unlink(missing_ok=True)
+        job = app.get_job(job['job_id'])
+        if job['status'] != 'error' or job['error'] != 'FILE_TOO_LARGE':
+            print(f"✗ Over-quota download should fail its job: {job['status']} {job.get('error')}")
+            return False
+
+        print("✓ Download manifest expires and enforces the disk quota")
+        return True
+    except Exception as e:
+        print(f"✗ Download manifest test failed: {e}")
+        return False
+
+def test_file_delivery():
+    """Test range requests and proxy offload on /files/<id>"""
+    try:
+        import app
+
+        data = bytes(range(256)) * 40
+        path = app.DOWNLOAD_DIR / 'rangetest_clip.mp4'
+        path.write_bytes(data)
+        app.DOWNLOAD_MANIFEST.add('rangetest', path, title='clip', filename='clip.mp4')
+        client = app.app.test_client()
+        try:
+            resp = client.get('/files/rangetest', headers={'Range': 'bytes=10-19'})
+            if resp.status_code != 206 or resp.data != data[10:20]:
+                print(f"✗ Single range returned {resp.status_code}")
+                return False
+            if resp.headers['Content-Range'] != f'bytes 10-19/{len(data)}':
+                print(f"✗ Wrong Content-Range: {resp.headers['Content-Range']}")
+                return False
+            if 'filename=clip.mp4' not in resp.headers['Content-Disposition']:
+                print("✗ Download name missing from Content-Disposition")
+                return False
+
+            resp = client.get('/files/rangetest', headers={'Range': 'bytes=0-4,-5'})
+            boundary = resp.headers['Content-Type'].partition('boundary=')[2]
+            if resp.status_code != 206 or not boundary or resp.data.count(boundary.encode()) != 3:
+                print("✗ Multiple ranges should return multipart/byteranges")
+                return False
+            if data[:5] not in resp.data or data[-5:] not in resp.data:
+                print("✗ Multipart body is missing a range")
+                return False
+
+            resp = client.get('/files/rangetest', headers={'Range': f'bytes={len(data)}-'})
+            if resp.status_code != 416:
+                print(f"✗ Unsatisfiable range returned {resp.status_code}")
+                return False
+
+            etag = client.get('/files/rangetest').headers['ETag']
+            if client.get('/files/rangetest', headers={'If-None-Match': etag}).status_code != 304:
+                print("✗ Matching If-None-Match should return 304")
+                return False
+
+            app.FILE_DELIVERY = 'x-accel-redirect'
+            resp = client.get('/files/rangetest')
+            if resp.headers.get('X-Accel-Redirect') != '/internal-downloads/rangetest_clip.mp4' or resp.data:
+                print(f"✗ Unexpected X-Accel-Redirect: {resp.headers.get('X-Accel-Redirect')}")
+                return False
+        finally:
+            app.FILE_DELIVERY = 'sendfile'
+            app.DOWNLOAD_MANIFEST.remove('rangetest')
+            path.unlink(missing_ok=True)
+
+        print("✓ Files support single/multi ranges, 304/416 and proxy offload")
+        return True
+    except Exception as e:
+        print(f"✗ File delivery test failed: {e}")
+        return False
+
+def test_state_store():
+    """Test the shared state store backends and cross-worker job lookups"""
+    try:
+        import tempfile
+        import time
+        import app
+        from pathlib import Path
+
+        class LocalRedis:
+            """Stand-in for redis.Redis (get / set with nx and ex / delete)"""
+            def __init__(self):
+                self.data = {}
+            def get(self, key):
+                value, expires = self.data.get(key, (None, None))
+                return None if expires and expires < time.time() else value
+            def set(self, key, value, nx=False, ex=None):
+                if nx and self.get(key) is not None:
+                    return None
+                self.data[key] = (value, time.time() + ex if ex else None)
+                return True
+            def delete(self, key):
+                self.data.pop(key, None)
+            def scan_iter(self, match):
+                return [key for key in list(self.data) if key.startswith(match.rstrip('*'))]
+            def multi(self):
+                pass
+            def transaction(self, func, *watches, value_from_callable=False):
+                return func(self)
+
+        class PartialStore(app.StateStore):
+            def get(self, namespace, key):
+                return None
+        try:
+            PartialStore()
+            print("✗ A backend missing StateStore methods should not instantiate")
+            return False
+        except TypeError:
+            pass
+
+        with tempfile.TemporaryDirectory() as tmp:
+            stores = [
+                app.SQLiteStateStore(Path(tmp) / 'state.sqlite3'),
+                app.RedisStateStore(LocalRedis()),
+            ]
+            for store in stores:
+                name = type(store).__name__
+                store.set('jobs', 'a', {'status': 'queued'})
+                if store.get('jobs', 'a') != {'status': 'queued'} or store.get('jobs', 'b') is not None:
+                    print(f"✗ {name}: get/set mismatch")
+                    return False
+                if not store.add('inflight', 'k', 'job-1') or store.add('inflight', 'k', 'job-2'):
+                    print(f"✗ {name}: add should only succeed once")
+                    return False
+                if store.items('inflight') != [('k', 'job-1')]:
+                    print(f"✗ {name}: items() should list the namespace")
+                    return False
+                store.delete('inflight', 'k')
+                store.update('counters', 'n', lambda v: (v or 0) + 1)
+                if store.update('counters', 'n', lambda v: (v or 0) + 1) != 2:
+                    print(f"✗ {name}: update() should read-modify-write")
+                    return False
+                store.set('flags', 'short', True, ttl=0.01)
+                time.sleep(1.1 if name == 'RedisStateStore' else 0.05)
+                if store.get('inflight', 'k') is not None or store.get('flags', 'short') is not None:
+                    print(f"✗ {name}: deleted/expired keys still visible")
+                    return False
+
+        # a job started by another worker is served from the shared store
+        job = {'job_id': 'otherworker01', 'status': 'downloading', 'progress': 42.0, 'version': 3}
+        app.STATE_STORE.set('jobs', job['job_id'], job, ttl=60)
+        try:
+            resp = app.app.test_client().get('/api/status/otherworker01')
+            if resp.status_code != 200 or resp.get_json()['progress'] != 42.0:
+                print(f"✗ Job of another worker not visible: {resp.status_code}")
+                return False
+            # snapshots are written outside the job lock: a late older one must not win
+            app.share_job({**job, 'progress': 10.0, 'version': 2})
+            if app.STATE_STORE.get('jobs', job['job_id'])['progress'] != 42.0:
+                print("✗ An older job snapshot overwrote a newer one")
+                return False
+        finally:
+            app.STATE_STORE.delete('jobs', job['job_id'])
+
+        # workers finding the same dead claim: exactly one takes it over
+        import threading
+        app.STATE_STORE.set('inflight', 'claimtest', 'deadjob00001', ttl=60)
+        racing = [f'claimjob{n:04d}' for n in range(8)]
+        for job_id in racing:
+            app.STATE_STORE.set('jobs', job_id, {'job_id': job_id, 'status': 'queued', 'version': 1}, ttl=60)
+        won = []
+        def claim(job_id):
+            if app.claim_download('claimtest', job_id) is None:
+                won.append(job_id)
+        # every racer has read the dead owner before any of them acts on it
+        barrier = threading.Barrier(len(racing), timeout=5)
+        get_job = app.get_job
+        def racing_get_job(job_id):
+            if job_id == 'deadjob00001':
+                try:
+                    barrier.wait()
+                except threading.BrokenBarrierError:
+                    pass
+            return get_job(job_id)
+        app.get_job = racing_get_job
+        try:
+            racers = [threading.Thread(target=claim, args=(job_id,)) for job_id in racing]
+            for t in racers:
+                t.start()
+            for t in racers:
+                t.join()
+            owner = app.STATE_STORE.get('inflight', 'claimtest')
+        finally:
+            app.get_job = get_job
+            app.STATE_STORE.delete('inflight', 'claimtest')
+            for job_id in racing:
+                app.STATE_STORE.delete('jobs', job_id)
+        if len(won) != 1 or owner != won[0]:
+            print(f"✗ A stale claim should be taken over once: {won}, owner {owner}")
+            return False
+
+        print("✓ State store is shared across workers (SQLite and Redis backends)")
+        return True
+    except Exception as e:
+        print(f"✗ State store test failed: {e}")
+        return False
+
+def test_resumable_jobs():
+    """Test that interrupted jobs are resumed and orphaned partial files collected"""
+    try:
+        import tempfile
+        import time
+        import app
+        from pathlib import Path
+
+        job = {'job_id': 'resumetest01', 'url': 'https://youtu.be/resumeTest1', 'kind': 'mp4',
+               'format_id': 'best', 'status': 'downloading', 'cache_key': None, 'resumes': 0,
+               'version': 7, 'updated_at': time.time()}
+        submitted = []
+        worker = app.download_worker
+        app.download_worker = lambda *args: submitted.append(args) or app.QUEUE_DEPTH.labels('fetch').dec()
+        try:
+            app.STATE_STORE.set('jobs', job['job_id'], job, ttl=60)
+            app.save_resume_record(job['job_id'], download_id='a' * 32)
+            # the worker that ran it is gone: nobody renews the lease
+            app.STATE_STORE.delete('leases', job['job_id'])
+            first, second = app.recover_jobs(), app.recover_jobs()
+            time.sleep(0.2)
+            resumed = app.get_job(job['job_id'])
+        finally:
+            app.download_worker = worker
+            app.drop_resume_record(job['job_id'])
+            app.forget_job(job['job_id'])
+
+        if (first, second) != (1, 0) or submitted[0][-1] != 'a' * 32:
+            print(f"✗ Expected one resume with the old download id, got {first}, {second}, {submitted}")
+            return False
+        if resumed['resumes'] != 1 or resumed['status'] != 'queued' or resumed['version'] <= 7:
+            print(f"✗ Resumed job not updated in place: {resumed}")
+            return False
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # only files listed in the partial index are candidates, never the whole directory
+            jobs = {'live': 'resumetest02', 'orphan': 'resumetest03', 'fresh': 'resumetest04'}
+            files = {name: Path(tmp) / f'{name}_video.mp4' for name in (*jobs, 'untracked')}
+            for path in files.values():
+                Path(f'{path}.part').write_bytes(b'partial')
+            app.save_resume_record(jobs['live'], download_id='b' * 32)
+            try:
+                for name, job_id in jobs.items():
+                    app.track_partial_files(job_id, name[0] * 32, [str(files[name])])
+                old = time.time() - 3600
+                for name in ('live', 'orphan'):
+                    entry = app.STATE_STORE.get('partials', jobs[name])
+                    app.STATE_STORE.set('partials', jobs[name], {**entry, 'updated_at': old})
+                removed = app.collect_partial_files()
+            finally:
+                app.drop_resume_record(jobs['live'])
+                for job_id in jobs.values():
+                    app.STATE_STORE.delete('partials', job_id)
+            left = {name for name, path in files.items() if Path(f'{path}.part').exists()}
+            if removed != 1 or left != {'live', 'fresh', 'untracked'}:
+                print(f"✗ Only old partials of ended jobs should be collected, left {left}")
+                return False
+
+        print("✓ Interrupted jobs resume under their id; orphaned partials are collected")
+        return True
+    except Exception as e:
+        print(f"✗ Resumable jobs test failed: {e}")
+        return False
+
+def test_admission_control():
+    """Test rate limiting, fair download queueing and load shedding"""
+    try:
+        import tempfile
+        import threading
+        import app
+        from pathlib import Path
+
+        with tempfile.TemporaryDirectory() as tmp:
+            bucket = app.TokenBucket(app.SQLiteStateStore(Path(tmp) / 'state.sqlite3'), 60, 2)
+            if bucket.take('ip:a') or bucket.take('ip:a'):
+                print("✗ A full bucket should grant its burst")
+                return False
+            wait = bucket.take('ip:a')
+            if not 0.5 < wait <= 1.0 or bucket.take('ip:b'):
+                print(f"✗ Empty bucket should ask to wait ~1s, per client (got {wait})")
+                return False
+
+        # round-robin across clients: B's job does not wait behind all of A's
+        scheduler = app.FairScheduler(1, 'test-fair')
+        started, gate, done = threading.Event(), threading.Event(), threading.Event()
+        order = []
+        scheduler.submit('A', lambda: started.set() or gate.wait())
+        started.wait(5)
+        for name in ('A1', 'A2', 'A3', 'B1'):
+            scheduler.submit(name[0], order.append, name)
+        scheduler.submit('C', done.set)
+        if scheduler.pending('A') != 3 or scheduler.stats()['clients'] != 3:
+            print(f"✗ Unexpected queue state: {scheduler.stats()}")
+            return False
+        gate.set()
+        done.wait(5)
+        if order != ['A1', 'B1', 'A2', 'A3']:
+            print(f"✗ Jobs not served round-robin: {order}")
+            return False
+
+        client = app.app.test_client()
+        saved = app.RATE_LIMITER, app.DOWNLOAD_QUEUE_LIMIT, app.CLIENT_QUEUE_LIMIT
+        try:
+            app.RATE_LIMITER = app.TokenBucket(app.STATE_STORE, 1, 1)
+            for addr in ('203.0.113.19', '203.0.113.20'):
+                app.STATE_STORE.delete('ratelimit', f'ip:{addr}')  # left over from an earlier run
+            env = {'REMOTE_ADDR': '203.0.113.19'}
+            # invalid requests are answered before admission and cost nothing
+            invalid = client.post('/api/metadata', json={}, environ_base=env)
+            first = client.post('/api/download', json={'url': 'https://example.com/ratelimit'}, environ_base=env)
+            second = client.post('/api/metadata', json={'url': 'https://example.com/ratelimit'}, environ_base=env)
+            if (invalid.status_code, first.status_code, second.status_code) != (400, 202, 429):
+                print(f"✗ Expected 400, 202, 429, got {invalid.status_code}, {first.status_code}, {second.status_code}")
+                return False
+            if second.get_json()['error'] != 'RATE_LIMITED' or int(second.headers['Retry-After']) < 30:
+                print("✗ 429 should carry RATE_LIMITED and Retry-After")
+                return False
+            other = client.post(
+                '/api/download', json={'url': 'https://example.com/ratelimit'}, environ_base={'REMOTE_ADDR': '203.0.113.20'}
+            )
+            if other.status_code != 202:
+                print("✗ Another client should have its own bucket")
+                return False
+
+            app.RATE_LIMITER = None
+            app.DOWNLOAD_QUEUE_LIMIT = 0
+            resp = client.post('/api/download', json={'url': 'https://example.com/v'})
+            if resp.status_code != 503 or resp.get_json()['error'] != 'SERVER_BUSY' or 'Retry-After' not in resp.headers:
+                print(f"✗ Full download queue should answer 503: {resp.status_code}")
+                return False
+            app.DOWNLOAD_QUEUE_LIMIT, app.CLIENT_QUEUE_LIMIT = 100, 0
+            resp = client.post('/api/download', json={'url': 'https://example.com/v'})
+            if resp.status_code != 429 or resp.get_json()['error'] != 'TOO_MANY_JOBS':
+                print(f"✗ Client over its queue limit should get 429: {resp.status_code}")
+                return False
+        finally:
+            app.RATE_LIMITER, app.DOWNLOAD_QUEUE_LIMIT, app.CLIENT_QUEUE_LIMIT = saved
+
+        print("✓ Clients are rate limited, queued fairly and shed with Retry-After")
+        return True
+    except Exception as e:
+        print(f"✗ Admission control test failed: {e}")
+        return False
+
+def test_bandwidth_governor():
+    """Test bandwidth allocation by traffic class, idle-share reuse and paced delivery"""
+    try:
+        import socket
+        import time
+        import uuid
+        import app
+
+        inf = float('inf')
+        if app.weighted_shares(100, [(4, inf), (1, inf)]) != [80, 20]:
+            print("✗ Shares should follow the class weights")
+            return False
+        if [round(s) for s in app.weighted_shares(100, [(4, 10), (1, inf)])] != [10, 90]:
+            print("✗ What a small demand leaves over should go to the others")
+            return False
+
+        gov = app.BandwidthGovernor('test-bw', 1_000_000)
+        with gov.stream('interactive', 'a'), gov.stream('bulk', 'b'):
+            rates = {s['id']: s['allocated'] for s in gov.stats()['streams']}
+            if rates != {'a': 800_000, 'b': 200_000}:
+                print(f"✗ Unexpected allocations: {rates}")
+                return False
+            # a moves far less than it gets (slow origin), b all it can
+            time.sleep(0.6)
+            gov.reserve('a', 10_000)
+            gov.reserve('b', 600_000)
+            gov.rebalance()
+            rates = {s['id']: s['allocated'] for s in gov.stats()['streams']}
+            if not (rates['a'] < 50_000 and rates['b'] > 900_000):
+                print(f"✗ Unused bandwidth was not handed to the busy stream: {rates}")
+                return False
+        if gov.stats()['streams']:
+            print("✗ Finished streams should be unregistered")
+            return False
+
+        # another worker on this host with one interactive transfer: half the limit each
+        name = f'test-bw-{uuid.uuid4().hex[:8]}'
+        other = f'{name}:{socket.gethostname()}:0'
+        shared = app.BandwidthGovernor(name, 1_000_000, store=app.STATE_STORE)
+        app.STATE_STORE.set('bandwidth', other, 4.0, ttl=5)
+        try:
+            with shared.stream('interactive'):
+                shared.rebalance()
+                if shared.stats()['process_share'] != 500_000:
+                    print(f"✗ Workers should split the limit by weight: {shared.stats()}")
+                    return False
+        finally:
+            app.STATE_STORE.delete('bandwidth', other)
+
+        capped = app.BandwidthGovernor('test-bw-job', 0, stream_max=100_000)
+        with capped.stream('interactive', 'a'), capped.stream('interactive', 'b'):
+            if [s['allocated'] for s in capped.stats()['streams']] != [100_000, 100_000]:
+                print("✗ Per-stream cap should apply without an aggregate limit")
+                return False
+
+        off = app.BandwidthGovernor('test-bw-off', 0)
+        chunks = iter([b'x'])
+        if off.enabled or app.throttled(chunks, off, 'bulk') is not chunks:
+            print("✗ A governor without limits should not touch the body")
+            return False
+
+        # progress hook: the first report (maybe a resumed file) is free, then 300 KB at 200 KB/s
+        saved = app.INGRESS
+        app.INGRESS = app.BandwidthGovernor('test-bw-in', 200_000)
+        try:
+            seen = {}
+            with app.INGRESS.stream('interactive', 'job'):
+                started = time.perf_counter()
+                app.ingress_hook('job', seen, {'status': 'downloading', 'tmpfilename': 'f', 'downloaded_bytes': 10**6})
+                if time.perf_counter() - started > 0.2:
+                    print("✗ Bytes of an earlier run should not be paced")
+                    return False
+                app.ingress_hook('job', seen, {'status': 'downloading', 'tmpfilename': 'f', 'downloaded_bytes': 1_300_000})
+                waited = time.perf_counter() - started
+            if not 0.8 < waited < 1.4:
+                print(f"✗ Download should be held back ~1s, was {waited:.2f}s")
+                return False
+        finally:
+            app.INGRESS = saved
+
+        data = b'b' * 600_000
+        path = app.DOWNLOAD_DIR / 'bwtest_file.bin'
+        path.write_bytes(data)
+        saved = app.EGRESS
+        app.EGRESS = app.BandwidthGovernor('test-bw-out', 400_000)
+        try:
+            with app.app.test_request_context('/files/bwtest'):
+                resp = app.send_download(path, 'file.bin', 'application/octet-stream')
+                started = time.perf_counter()
+                body = b''.join(resp.response)
+                elapsed = time.perf_counter() - started
+                resp.close()
+            # 600 KB at 400 KB/s, less the 0.5s burst
+            if body != data or not 0.7 < elapsed < 1.6:
+                print(f"✗ Paced response took {elapsed:.2f}s")
+                return False
+        finally:
+            app.EGRESS = saved
+            path.unlink(missing_ok=True)
+
+        health = app.app.test_client().get('/api/health').get_json()
+        if set(health.get('bandwidth', {})) != {'ingress', 'egress'}:
+            print("✗ /api/health should report the bandwidth allocations")
+            return False
+
+        print("✓ Bandwidth is split by class, idle shares are reused and transfers are paced")
+        return True
+    except Exception as e:
+        print(f"✗ Bandwidth governor test failed: {e}")
+        return False
+
+def test_circuit_breaker():
+    """Test per-site circuit breaking, half-open probing and strategy fallback"""
+    try:
+        import tempfile
+        import time
+        import app
+        from pathlib import Path
+
+        with tempfile.TemporaryDirectory() as tmp:
+            store = app.SQLiteStateStore(Path(tmp) / 'state.sqlite3')
+            breaker = app.CircuitBreaker(store, window=60, min_calls=3, error_rate=0.5, cooldown=0.1)
+
+            for _ in range(3):
+                breaker.record('Youtube', 'enhanced', ok=False)
+            if breaker.choose('Youtube') != ('simple', False):
+                print("✗ Breaker should open after repeated enhanced failures")
+                return False
+            if breaker.choose('Vimeo') != ('enhanced', False):
+                print("✗ Other sites should keep the enhanced strategy")
+                return False
+
+            time.sleep(0.15)
+            if breaker.choose('Youtube') != ('enhanced', True) or breaker.choose('Youtube')[0] != 'simple':
+                print("✗ Exactly one half-open probe should be let through")
+                return False
+            breaker.record('Youtube', 'enhanced', ok=True)
+            if breaker.state('Youtube') != 'closed':
+                print("✗ A successful probe should close the breaker")
+                return False
+
+            # breakers of two workers sharing one store lose no events
+            import threading
+            other = app.CircuitBreaker(store, window=60, min_calls=1000, error_rate=0.5, cooldown=0.1)
+            def outcomes(b):
+                for _ in range(25):
+                    b.record('Dailymotion', 'simple', ok=True)
+            workers = [threading.Thread(target=outcomes, args=(b,)) for b in (breaker, other) * 2]
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+            if len(store.get('breaker', 'Dailymotion')['events']['simple']) != 100:
+                print("✗ Concurrent breaker updates should not overwrite each other")
+                return False
+
+            # retries inside one request fall back to simple on the last attempt
+            calls = []
+            def attempt(strategy):
+                calls.append(strategy)
+                if strategy == 'enhanced':
+                    raise RuntimeError('transient')
+                return 'ok'
+
+            backoff = app.RETRY_BACKOFF_BASE
+            app.RETRY_BACKOFF_BASE = 0.01
+            try:
+                result = app.run_with_strategy(
+                    'https://www.youtube.com/watch?v=breakerTest', attempt, attempts=3, breaker=breaker
+                )
+            finally:
+                app.RETRY_BACKOFF_BASE = backoff
+            if result != ('ok', 'simple') or calls != ['enhanced', 'enhanced', 'simple']:
+                print(f"✗ Unexpected retry plan: {calls} -> {result}")
+                return False
+            if breaker.snapshot()['Youtube']['strategies']['simple']['ok'] != 1:
+                print("✗ Served strategy not counted")
+                return False
+
+            # no free extraction slot: fail at once, without blaming the site
+            def busy(strategy):
+                calls.append(strategy)
+                raise app.Overloaded()
+
+            calls.clear()
+            before = breaker.snapshot()
+            try:
+                app.run_with_strategy('https://www.youtube.com/watch?v=busyTest', busy, breaker=breaker)
+            except app.Overloaded:
+                pass
+            if calls != ['enhanced'] or breaker.snapshot() != before:
+                print(f"✗ Overloaded should not be retried or recorded: {calls}")
+                return False
+
+        print("✓ Circuit breaker opens per site, probes and recovers")
+        return True
+    except Exception as e:
+        print(f"✗ Circuit breaker test failed: {e}")
+        return False
+
+def test_metrics():
+    """Test that /metrics exposes the hot-path Prometheus metrics"""
+    try:
+        import app
+
+        client = app.app.test_client()
+        resp = client.get('/metrics')
+        if resp.status_code != 200 or not resp.content_type.startswith('text/plain'):
+            print(f"✗ /metrics returned {resp.status_code} {resp.content_type}")
+            return False
+
+        body = resp.get_data(as_text=True)
+        for name in (
+            'ytdownloadx_extract_seconds',
+            'ytdownloadx_download_bytes_per_second',
+            'ytdownloadx_postprocess_seconds',
+            'ytdownloadx_send_seconds',
+            'ytdownloadx_queue_depth',
+            'ytdownloadx_active_jobs',
+            'ytdownloadx_cache_requests_total',
+            'ytdownloadx_errors_total',
+            'ytdownloadx_breaker_state',
+        ):
+            if f'# TYPE {name} ' not in body:
+                print(f"✗ Missing metric: {name}")
+                return False
+
+        print("✓ /metrics exposes extraction, transfer, ffmpeg, queue and cache metrics")
+        return True
+    except Exception as e:
+        print(f"✗ Metrics test failed: {e}")
+        return False
+
+def test_request_timing():
+    """Test Server-Timing headers, JSON logs, admin profiling and quiet yt-dlp options"""
+    try:
+        import json
+        import logging
+        import tempfile
+        import app
+        from pathlib import Path
+
+        opts, _ = app.get_ydl_opts_enhanced(download=False)
+        if opts['verbose'] or opts.get('listformats') or opts.get('forcejson') or opts['logger'] is not app.YTDLP_LOGGER:
+            print("✗ yt-dlp output should be opt-in (YTDLP_VERBOSE)")
+            return False
+
+        info = {'id': 'timingTest1', 'title': 'Timing', 'duration': 10, 'formats': []}
+        fetch = app.fetch_metadata
+        app.fetch_metadata = lambda u: app.build_metadata_response(info)
+        env = {'REMOTE_ADDR': '203.0.113.21'}
+        client = app.app.test_client()
+        try:
+            resp = client.get('/api/metadata', query_string={'url': 'https://www.youtube.com/watch?v=timingTest1'},
+                              headers={'X-Request-ID': 'req-42'}, environ_base=env)
+        finally:
+            app.fetch_metadata = fetch
+        timing = resp.headers.get('Server-Timing', '')
+        if resp.headers.get('X-Request-ID') != 'req-42' or 'render;dur=' not in timing or 'total;dur=' not in timing:
+            print(f"✗ Missing request id / Server-Timing phases: {timing!r}")
+            return False
+
+        record = logging.LogRecord('ytdownloadx', logging.INFO, __file__, 1, 'GET %s', ('/x',), None)
+        record.fields = {'phases_ms': {'extract': 1.5}}
+        line = json.loads(app.JsonLogFormatter().format(record))
+        if line['message'] != 'GET /x' or line['phases_ms'] != {'extract': 1.5}:
+            print(f"✗ Unexpected JSON log line: {line}")
+            return False
+
+        saved = app.ADMIN_TOKEN, app.PROFILE_DIR
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                app.ADMIN_TOKEN, app.PROFILE_DIR = '', Path(tmp)
+                if client.get('/admin/profiling').status_code != 404:
+                    print("✗ Admin routes should not exist without ADMIN_TOKEN")
+                    return False
+                app.ADMIN_TOKEN = 'secret'
+                if client.get('/admin/profiling', headers={'X-Admin-Token': 'wrong'}).status_code != 403:
+                    print("✗ Wrong admin token should be refused")
+                    return False
+                admin = {'X-Admin-Token': 'secret'}
+                profiled = client.get('/api/status/nope', headers={**admin, 'X-Profile': '1'})
+                name = profiled.headers.get('X-Profile')
+                if not name or not (Path(tmp) / name).exists():
+                    print("✗ Requested profile was not saved")
+                    return False
+                report = client.get(f'/admin/profiles/{name}', query_string={'format': 'text'}, headers=admin)
+                listing = client.get('/admin/profiling', headers=admin).get_json()
+                if report.status_code != 200 or b'cumulative' not in report.data or listing['profiles'][0]['name'] != name:
+                    print("✗ Profiles should be listed and downloadable")
+                    return False
+                if client.post('/admin/profiling', json={'sample_rate': 2}, headers=admin).status_code != 400:
+                    print("✗ Sample rates outside 0..1 should be rejected")
+                    return False
+                if client.post('/admin/profiling', json={'sample_rate': 0.25}, headers=admin).get_json()['sample_rate'] != 0.25:
+                    print("✗ Sample rate not stored")
+                    return False
+            finally:
+                app.STATE_STORE.delete('settings', 'profile_sample_rate')
+                app._PROFILE_RATE.update(rate=app.PROFILE_SAMPLE_RATE, read_at=0.0)
+                app.ADMIN_TOKEN, app.PROFILE_DIR = saved
+
+        print("✓ Requests report phase timings; profiles are sampled on demand")
+        return True
+    except Exception as e:
+        print(f"✗ Request timing test failed: {e}")
+        return False
+
+def test_ydl_pool():
+    """Test that yt-dlp contexts are reused without leaking per-request options"""
+    try:
+        import app
+
+        pool = app.YDLPool(size=2, max_uses=3)
+        opts, _ = app.final_opts(download=True, kind='mp4')
+        calls = []
+        hooked = {**opts, 'progress_hooks': [calls.append]}
+
+        with pool.lease(hooked) as first:
+            first.params['fixup'] = 'never'
+            first_tmpl = first.params['outtmpl']['default']
+            first._progress_hooks[0]({'status': 'downloading'})
+        other, _ = app.final_opts(download=True, kind='mp4')
+        with pool.lease(other) as second, pool.lease(other) as third:
+            if second is not first or third is first:
+                print("✗ Idle context not reused (or handed out twice)")
+                return False
+            if second.params['outtmpl']['default'] == first_tmpl or 'fixup' in second.params:
+                print("✗ Options of a previous lease leaked into the next one")
+                return False
+            if second.params is third.params:
+                print("✗ Pooled contexts share one params dict")
+                return False
+            second._progress_hooks[0]({'status': 'downloading'})
+        if len(calls) != 1:
+            print("✗ Progress hooks of a finished lease are still called")
+            return False
+
+        try:
+            with pool.lease(other) as failed:
+                raise RuntimeError('boom')
+        except RuntimeError:
+            pass
+        with pool.lease(other) as after:
+            if after is failed:
+                print("✗ A context that raised was returned to the pool")
+                return False
+
+        stats = pool.stats()
+        if stats['reused'] < 2 or stats['idle'] > 2:
+            print(f"✗ Unexpected pool stats: {stats}")
+            return False
+
+        print("✓ yt-dlp contexts are pooled and reset between requests")
+        return True
+    except Exception as e:
+        print(f"✗ yt-dlp pool test failed: {e}")
+        return False
+
+def test_benchmark_helpers():
+    """Test the percentile and baseline comparison helpers of benchmark.py"""
+    try:
+        import io
+        from contextlib import redirect_stdout
+        import benchmark
+
+        if benchmark.percentile([], 50) is not None:
+            print("✗ Percentile of no samples should be None")
+            return False
+        samples = [float(n) for n in range(1, 101)]
+        if benchmark.percentile(samples, 50) != 50.5 or benchmark.percentile(samples, 100) != 100:
+            print("✗ Percentile interpolation is wrong")
+            return False
+
+        base = benchmark.summarize('metadata_mp4', 4, [0.1] * 10, [], 1.0, 0, 100e6)
+        baseline = {'meta': {'commit': 'abc'}, 'results': [base]}
+        same = benchmark.summarize('metadata_mp4', 4, [0.11] * 10, [], 1.05, 0, 100e6)
+        slower = benchmark.summarize('metadata_mp4', 4, [0.2] * 10, [], 2.0, 0, 100e6)
+        with redirect_stdout(io.StringIO()):
+            if not benchmark.compare([same], baseline, 0.2):
+                print("✗ Small change reported as a regression")
+                return False
+            if benchmark.compare([slower], baseline, 0.2):
+                print("✗ Doubled p95 not reported as a regression")
+                return False
+
+        print("✓ Benchmark percentiles and baseline comparison work")
+        return True
+    except Exception as e:
+        print(f"✗ Benchmark helpers test failed: {e}")
+        return False
+
+def test_postprocess_stage():
+    """Test that ffmpeg work is queued shortest-first and runs in worker processes"""
+    try:
+        import shutil
+        import subprocess
+        import tempfile
+        import threading
+        import time
+        from pathlib import Path
+        import app
+
+        stage = app.PostprocessStage(workers=1, aging=0)
+        order, finished = [], threading.Event()
+
+        def done(result, error, waited):
+            order.append(result)
+            if len(order) == 4:
+                finished.set()
+
+        # the first task occupies the only worker while the rest queue up
+        stage.submit('block', time.sleep, (0.5,), 0, done)
+        time.sleep(0.2)
+        for cost in (5, 1, 3):
+            stage.submit(f'job{cost}', abs, (-cost,), cost, done)
+        if not finished.wait(30) or order[1:] != [1, 3, 5]:
+            print(f"✗ Expected shortest job first, got {order}")
+            return False
+
+        aging = app.PostprocessStage(workers=1, aging=10)
+        now = time.monotonic()
+        aging._queue = [
+            {'job_id': 'short', 'cost': 1, 'queued_at': now},
+            {'job_id': 'long', 'cost': 5, 'queued_at': now - 1},
+        ]
+        if aging._take()['job_id'] != 'long':
+            print("✗ A job that waited long enough should overtake shorter ones")
+            return False
+
+        if shutil.which('ffmpeg'):
+            src = Path(tempfile.mkdtemp()) / 'clip.mp4'
+            subprocess.run(
+                ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'sine=duration=1',
+                 '-c:a', 'aac', str(src)],
+                check=True,
+            )
+            fn, args, cost = app.plan_postprocess({'duration': 1}, src, 'mp3')
+            result = stage._pool.submit(fn, *args).result(timeout=60)
+            if not result['path'].endswith('.mp3') or src.exists():
+                print(f"✗ Expected the source converted to mp3, got {result}")
+                return False
+
+        print("✓ Postprocessing runs shortest-first in its own process pool")
+        return True
+    except Exception as e:
+        print(f"✗ Postprocess stage test failed: {e}")
+        return False
+
+def test_asgi_mode():
+    """Test the asyncio serving mode: routes, SSE wake-ups, backpressure"""
+    try:
+        import asyncio
+        import json
+        import socket
+        import threading
+        import time
+        import urllib.error
+        import urllib.request
+        import uvicorn
+        import app
+        import asgi
+
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        server = uvicorn.Server(uvicorn.Config(asgi.app, host='127.0.0.1', port=port, log_level='warning'))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        deadline = time.time() + 10
+        while not server.started and time.time() < deadline:
+            time.sleep(0.05)
+        base = f'http://127.0.0.1:{port}'
+
+        data = bytes(range(256)) * 40
+        path = app.DOWNLOAD_DIR / 'asgitest_clip.mp4'
+        path.write_bytes(data)
+        app.DOWNLOAD_MANIFEST.add('asgitest', path, title='clip', filename='clip.mp4')
+        try:
+            health = json.load(urllib.request.urlopen(base + '/api/health', timeout=5))
+            if 'asgi' not in health or health['status'] != 'ok':
+                print("✗ /api/health is missing the executor stats")
+                return False
+            if urllib.request.urlopen(base + '/about', timeout=5).status != 200:
+                print("✗ Flask routes are not mounted")
+                return False
+
+            req = urllib.request.Request(base + '/files/asgitest', headers={'Range': 'bytes=10-19'})
+            resp = urllib.request.urlopen(req, timeout=5)
+            if resp.status != 206 or resp.read() != data[10:20]:
+                print(f"✗ Range request returned {resp.status}")
+                return False
+            req = urllib.request.Request(base + '/files/asgitest', headers={'If-None-Match': resp.headers['ETag']})
+            try:
+                urllib.request.urlopen(req, timeout=5)
+                print("✗ Matching If-None-Match should return 304")
+                return False
+            except urllib.error.HTTPError as e:
+                if e.code != 304:
+                    raise
+
+            # update_job from a worker thread must wake the SSE stream right away
+            job = app.create_job('https://example.com/asgi', 'mp4', 'best')
+            threading.Timer(
+                0.3, app.update_job, args=(job['job_id'],), kwargs={'status': 'completed', 'filename': 'x.mp4'}
+            ).start()
+            started = time.time()
+            events = []
+            with urllib.request.urlopen(f"{base}/api/progress/{job['job_id']}", timeout=10) as stream:
+                for line in stream:
+                    if line.startswith(b'data:'):
+                        events.append(json.loads(line[5:]))
+                        if events[-1]['status'] == 'completed':
+                            break
+            if events[-1].get('download_url') != f"/download/{job['job_id']}/x.mp4" or time.time() - started > 3:
+                print("✗ SSE stream did not deliver the completed job promptly")
+                return False
+        finally:
+            server.should_exit = True
+            thread.join(5)
+            app.DOWNLOAD_MANIFEST.remove('asgitest')
+            path.unlink(missing_ok=True)
+
+        async def saturate():
+            pool = asgi.BoundedExecutor('test', 1, 1)
+            gate = threading.Event()
+            ran = []
+            running = asyncio.ensure_future(pool.run(gate.wait, 5))
+            queued = asyncio.ensure_future(pool.run(ran.append, 'queued'))
+            await asyncio.sleep(0.05)
+            try:
+                await pool.run(ran.append, 'third')
+                busy = False
+            except asgi.ServerBusy:
+                busy = True
+            queued.cancel()  # client went away while the call was queued
+            await asyncio.gather(queued, return_exceptions=True)
+            gate.set()
+            await running
+            await asyncio.sleep(0.05)
+            return busy, ran, pool.stats()
+
+        busy, ran, stats = asyncio.run(saturate())
+        if not busy or ran or stats['pending'] != 0 or stats['rejected'] != 1:
+            print(f"✗ Bounded executor: busy={busy} ran={ran} stats={stats}")
+            return False
+
+        print("✓ ASGI mode serves files and SSE, rejects when full and drops cancelled calls")
+        return True
+    except Exception as e:
+        print(f"✗ ASGI mode test failed: {e}")
+        return False
+
 def main():
     """Run all tests"""
     print("=" * 50)
@@ -111,7 +1803,32 @@ def main():
         ("Import Test", test_imports),
         ("App Structure Test", test_app_structure),
         ("Routes Test", test_routes),
-        ("Format Selector Test", test_format_selector)
+        ("Format Selector Test", test_format_selector),
+        ("Job Progress Test", test_job_progress),
+        ("Metadata Cache Test", test_metadata_cache),
+        ("Playlist Pagination Test", test_playlist_pagination),
+        ("Metadata Views Test", test_metadata_views),
+        ("Metadata Batch Test", test_metadata_batch),
+        ("Two-Phase Metadata Test", test_two_phase_metadata),
+        ("Image Service Test", test_image_service),
+        ("Download Cache Test", test_download_cache),
+        ("Clip Download Test", test_clip_downloads),
+        ("MP4 Pipeline Test", test_mp4_pipeline),
+        ("Streamable Format Test", test_streamable_formats),
+        ("Playlist ZIP Test", test_playlist_zip),
+        ("Download Manifest Test", test_download_manifest),
+        ("File Delivery Test", test_file_delivery),
+        ("State Store Test", test_state_store),
+        ("Resumable Jobs Test", test_resumable_jobs),
+        ("Admission Control Test", test_admission_control),
+        ("Bandwidth Governor Test", test_bandwidth_governor),
+        ("Circuit Breaker Test", test_circuit_breaker),
+        ("Metrics Test", test_metrics),
+        ("Request Timing Test", test_request_timing),
+        ("yt-dlp Pool Test", test_ydl_pool),
+        ("Benchmark Helpers Test", test_benchmark_helpers),
+        ("ASGI Mode Test", test_asgi_mode),
+        ("Postprocess Stage Test", test_postprocess_stage)
     ]
     
     results = []